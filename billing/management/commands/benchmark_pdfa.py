@@ -0,0 +1,51 @@
+# coding: utf-8
+
+"""
+Benchmark PDF/A conversion of bills, one Ghostscript process per bill versus batch conversion used by bill pdf jobs
+
+@author: Sébastien Renard (sebastien.renard@digitalfox.org)
+@license: AGPL v3 or newer (http://www.gnu.org/licenses/agpl-3.0.html)
+"""
+import time
+
+from django.core.management import BaseCommand
+
+from weasyprint import HTML
+
+from billing.utils import pdfa_convert, BILL_PDF_BATCH_SIZE
+
+BILL_COUNTS = (1, 10, 100)
+
+
+def synthetic_bill_pdf(n_lines, seed=0):
+    """Render a small bill like pdf with some text and a table
+    @return: pdf bytes"""
+    lines = "".join("<tr><td>Consultant %s</td><td>%s</td><td>%s €</td></tr>" % (i, i % 20 + 1, (seed + i) * 100)
+                    for i in range(n_lines))
+    html = "<h1>Invoice %s</h1><p>enioka</p><table>%s</table>" % (seed, lines)
+    return HTML(string=html).write_pdf()
+
+
+class Command(BaseCommand):
+    help = "Benchmark PDF/A conversion of synthetic bills. Report per bill latency with and without batch conversion"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--bills", type=int, nargs="+", default=BILL_COUNTS, help="bill counts to benchmark")
+        parser.add_argument("--lines", type=int, default=20, help="number of lines of synthetic bills")
+        parser.add_argument("--batch-size", type=int, default=BILL_PDF_BATCH_SIZE, help="number of bills converted together")
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        self.stdout.write("bills\tper process (ms/bill)\tbatch of %s (ms/bill)\tspeedup" % batch_size)
+        for n_bills in options["bills"]:
+            pdfs = [synthetic_bill_pdf(options["lines"], seed) for seed in range(n_bills)]
+            start = time.time()
+            for pdf in pdfs:
+                pdfa_convert([pdf])
+            single_time = time.time() - start
+            start = time.time()
+            for i in range(0, n_bills, batch_size):
+                pdfa_convert(pdfs[i:i + batch_size])
+            batch_time = time.time() - start
+            self.stdout.write("%s\t%.1f\t%.1f\t%.1fx" % (n_bills, 1000 * single_time / n_bills, 1000 * batch_time / n_bills,
+                                                           single_time / batch_time))
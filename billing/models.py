@@ -14,20 +14,23 @@ from base64 import b64encode
 from io import BytesIO
 
 from django.db import models
-from django.db.models import Sum, Min, Max, Count
+from django.db.models import Sum, Min, Max, Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.utils.translation import gettext_lazy as _
 from django.core.files.storage import FileSystemStorage
 from django.urls import reverse
 from django.conf import settings
+from django.core.cache import cache
 
 from auditlog.models import AuditlogHistoryField
 
 from leads.models import Lead
-from staffing.models import Mission, Timesheet
+from staffing.models import Mission
 from people.models import Consultant
 from expense.models import Expense
 from crm.models import Supplier, Subsidiary
-from billing.utils import compute_bill, compute_internal_bill, get_bill_id_from_path
+from billing.utils import compute_bill, compute_internal_bill, get_bill_id_from_path, supplier_bills_expected_billing, \
+    BILL_PDF_JOB_CACHE_KEY
 from core.utils import sanitizeName, nextMonth
 from core.models import CLIENT_BILL_LANG, INTERNAL_BILL_LANG
 from people.tasks import compute_consultant_tasks
@@ -116,7 +119,7 @@ class AbstractBill(models.Model):
     def bill_data(self):
         """Return bill data in formatted way to be included inline in a html page"""
         response = ""
-        if self.bill_file:
+        if self.bill_file and self.bill_file.storage.exists(self.bill_file.name):
             data = BytesIO()
             for chunk in self.bill_file.chunks():
                 data.write(chunk)
@@ -126,6 +129,10 @@ class AbstractBill(models.Model):
 
         return response
 
+    def pdf_generation_status(self):
+        """Status of background bill file generation: pending, running, done, error or None if not recently generated"""
+        return cache.get(BILL_PDF_JOB_CACHE_KEY % (self._meta.model_name, self.id))
+
     def save(self, *args, **kwargs):
         super(AbstractBill, self).save(*args, **kwargs)  # Save it
         if "force_insert" in kwargs: kwargs.pop("force_insert")
@@ -182,6 +189,19 @@ class AbstractLeadBill(AbstractBill):
         ordering = ["lead__client__organisation__company", "creation_date"]
 
 
+class ClientBillQuerySet(models.QuerySet):
+    def with_totals(self):
+        """Annotate bills with details and expenses totals computed by database. They are used by prestationsTotal,
+        expensesTotal, expensesTotalWithTaxes and taxes instead of querying each bill details in bill lists"""
+        details = BillDetail.objects.filter(bill=OuterRef("pk")).order_by().values("bill")
+        expenses = BillExpense.objects.filter(bill=OuterRef("pk")).order_by().values("bill")
+        total = lambda qs, field: Coalesce(Subquery(qs.annotate(total=Sum(field)).values("total")), Decimal(0),
+                                           output_field=models.DecimalField(max_digits=10, decimal_places=2))
+        return self.annotate(prestations_total=total(details, "amount"),
+                             expenses_total=total(expenses, "amount"),
+                             expenses_total_with_taxes=total(expenses, "amount_with_vat"))
+
+
 class ClientBill(AbstractLeadBill):
     CLIENT_BILL_STATE = (
         ('0_DRAFT', _("Draft")),
@@ -210,27 +230,32 @@ class ClientBill(AbstractLeadBill):
         else:
             return str(self.lead)
 
+    objects = ClientBillQuerySet.as_manager()
+
     def taxes(self):
         """Return taxes subtotal grouped by taxe rate like this [[20, 1923.23], [10, 152]]"""
-        taxes = {}
-        for detail in self.billdetail_set.all():
-            taxes[detail.vat] = taxes.get(detail.vat, 0) + (detail.amount_with_vat - detail.amount)
-        for billexpense in self.billexpense_set.all():
-            if not self.vat in taxes:
-                taxes[self.vat] = 0
-            taxes[self.vat] += billexpense.amount_with_vat - billexpense.amount
+        taxes = dict(bill_taxes(self.billdetail_set))
+        expenses_taxes = self.expensesTotalWithTaxes() - self.expensesTotal()
+        if expenses_taxes:
+            taxes[self.vat] = taxes.get(self.vat, 0) + expenses_taxes
         return list(taxes.items())
 
     def expensesTotalWithTaxes(self):
         """Returns the total sum (with added taxes) of all expenses of this bill"""
-        return sum([b.amount_with_vat for b in self.billexpense_set.all()])
+        if hasattr(self, "expenses_total_with_taxes"):  # See ClientBillQuerySet.with_totals()
+            return self.expenses_total_with_taxes
+        return list(self.billexpense_set.aggregate(Sum("amount_with_vat")).values())[0] or 0
 
     def expensesTotal(self):
         """Returns the total sum (without added taxes) of all expenses of this bill"""
+        if hasattr(self, "expenses_total"):
+            return self.expenses_total
         return list(self.billexpense_set.aggregate(Sum("amount")).values())[0] or 0
 
     def prestationsTotal(self):
         """Returns total of this bill without taxes and expenses"""
+        if hasattr(self, "prestations_total"):
+            return self.prestations_total
         return list(self.billdetail_set.aggregate(Sum("amount")).values())[0] or 0
 
     def get_absolute_url(self):
@@ -281,10 +306,7 @@ class InternalBill(AbstractBill):
 
     def taxes(self):
         """Return taxes subtotal grouped by taxe rate like this [[20, 1923.23], [10, 152]]"""
-        taxes = {}
-        for detail in self.internalbilldetail_set.all():
-            taxes[detail.vat] = taxes.get(detail.vat, 0) + (detail.amount_with_vat - detail.amount)
-        return list(taxes.items())
+        return bill_taxes(self.internalbilldetail_set)
 
     def save(self, *args, **kwargs):
         super(InternalBill, self).save(*args, **kwargs)  # Save it to create pk
@@ -325,26 +347,8 @@ class SupplierBill(AbstractLeadBill):
     supplier_bill_id = models.CharField(_("Supplier Bill id"), max_length=200)
 
     def expected_billing(self):
-        """Expected billing amount for supplier / lead of this bill"""
-        total_expected = 0
-        already_paid = SupplierBill.objects.filter(supplier=self.supplier, lead=self.lead,
-                                                   state__in=("1_VALIDATED", "2_PAID"))
-        already_paid = already_paid.aggregate(Sum("amount"))["amount__sum"] or 0
-
-        # Add spent time on missions of this lead
-        for mission in self.lead.mission_set.all():
-            rates = dict([(i.id, j[1] or 0) for i, j in mission.consultant_rates().items()])  # switch to consultant id
-            timesheets = Timesheet.objects.filter(mission=mission, working_date__lt=date.today().replace(day=1))
-            for consultant in mission.consultants().filter(subcontractor=True, subcontractor_company=self.supplier):
-                days = timesheets.filter(consultant=consultant).aggregate(Sum("charge"))["charge__sum"] or 0
-                total_expected += days * rates.get(consultant.id, 0)
-
-        # Add supplier expenses
-        supplier_consultants = [c.trigramme.lower() for c in self.supplier.consultant_set.all()]
-        expenses = Expense.objects.filter(lead=self.lead, state__in=("VALIDATED", "CONTROLLED"), user__username__in=supplier_consultants)
-        total_expected += float(expenses.aggregate(Sum("amount"))["amount__sum"] or 0)
-
-        return total_expected - float(already_paid)
+        """Expected billing amount for supplier / lead of this bill. See supplier_bills_expected_billing() for many bills"""
+        return supplier_bills_expected_billing([self])[self.id]
 
     def save(self, *args, **kwargs):
         # Save it first to define pk and allow browsing relationship
@@ -365,6 +369,14 @@ class SupplierBill(AbstractLeadBill):
         unique_together = (("supplier", "supplier_bill_id"),)
 
 
+def bill_taxes(details):
+    """Taxes of bill details grouped by VAT rate computed by database
+    @param details: bill details queryset
+    @return: list of (VAT rate, taxes amount)"""
+    details = details.order_by("vat").values_list("vat").annotate(taxes=Sum(F("amount_with_vat") - F("amount")))
+    return [(vat, taxes) for vat, taxes in details if taxes is not None]
+
+
 class AbstractBillDetail(models.Model):
     """Common fields for (client)BillDetail and internalBillDetail"""
     mission = models.ForeignKey(Mission, on_delete=models.CASCADE)
@@ -381,7 +393,9 @@ class AbstractBillDetail(models.Model):
         abstract = True
         ordering = ("mission", "month", "consultant")
 
-    def save(self, *args, **kwargs):
+    def compute_amount(self):
+        """Compute amount and amount with VAT from unit price, quantity and VAT rate.
+        Called by save and before bulk creation"""
         if self.unit_price and self.quantity:
             self.amount = Decimal(self.unit_price) * Decimal(self.quantity)
         else:
@@ -395,6 +409,9 @@ class AbstractBillDetail(models.Model):
             self.amount = self.amount_with_vat / (1 + self.vat / 100)
         else:
             self.amount_with_vat = 0
+
+    def save(self, *args, **kwargs):
+        self.compute_amount()
         super(AbstractBillDetail, self).save(*args, **kwargs)  # Save it
 
 
@@ -5,8 +5,6 @@ Pydici billing tables
 @license: AGPL v3 or newer (http://www.gnu.org/licenses/agpl-3.0.html)
 """
 
-from itertools import chain
-
 from django.db.models import Q
 from django.utils.safestring import mark_safe
 from django.urls import reverse
@@ -16,7 +14,6 @@ from core.decorator import PydiciFeatureMixin, PydiciNonPublicdMixin
 from core.utils import to_int_or_round
 from billing.views import BillingRequestMixin
 from billing.models import ClientBill, SupplierBill, InternalBill
-from people.models import Consultant
 from crm.utils import get_subsidiary_from_session
 
 
@@ -95,6 +92,8 @@ class ClientBillInCreationTableDT(BillTableDT):
 
     def get_initial_queryset(self):
         qs = ClientBill.objects.filter(state__in=("0_DRAFT", "0_PROPOSED"))
+        qs = qs.select_related("lead__subsidiary", "lead__responsible", "lead__client__organisation__company")
+        qs = qs.prefetch_related("billdetail_set__mission__responsible")
         qs = self._filter_on_subsidiary(qs)
         return qs
 
@@ -107,11 +106,11 @@ class ClientBillInCreationTableDT(BillTableDT):
 
     def render_column(self, row, column):
         if column == "responsible":
-            # Get missions and lead responsibles
-            responsibles = ClientBill.objects.filter(id=row.id).values_list("billdetail__mission__responsible__id", "lead__responsible__id")
-            responsibles = set(chain(*responsibles))  # flatten it
-            responsibles = Consultant.objects.filter(id__in=responsibles)
-            return ", ".join([str(c) for c in responsibles])
+            # Get missions and lead responsibles from prefetched bill details
+            responsibles = {detail.mission.responsible for detail in row.billdetail_set.all()}
+            responsibles.add(row.lead.responsible)
+            responsibles.discard(None)
+            return ", ".join([str(c) for c in sorted(responsibles, key=lambda c: c.name)])
         elif column == "bill_id":  # Use edit link instead of default detail display
             return "<a href='%s'>%s</a>" % (reverse("billing:client_bill", args=[row.id]), row.bill_id)
         else:
@@ -126,7 +125,7 @@ class ClientBillArchiveTableDT(BillTableDT):
 
     def get_initial_queryset(self):
         qs = ClientBill.objects.exclude(state__in=("0_DRAFT", "0_PROPOSED"))
-        qs = qs.select_related("lead")
+        qs = qs.select_related("lead__subsidiary", "lead__client__organisation__company")
         qs = self._filter_on_subsidiary(qs)
         if self.kwargs.get("company_id"):  # If provided, filter on client company
             qs = qs.filter(lead__client__organisation__company_id=self.kwargs["company_id"])
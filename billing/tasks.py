@@ -0,0 +1,76 @@
+# coding: utf-8
+
+"""
+Module that handle asynchronous tasks
+@author: Sébastien Renard (sebastien.renard@digitalfox.org)
+@license: AGPL v3 or newer (http://www.gnu.org/licenses/agpl-3.0.html)
+"""
+
+import os
+import time
+
+from django.apps import apps
+from django.urls import reverse
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.auth.models import User
+
+from celery import shared_task
+
+from core.utils import create_fake_request
+from billing.utils import render_bill_pdf, format_bills_pdf, attach_bill_pdf, dequeue_bill_pdf, BILL_PDF_JOB_CACHE_KEY, \
+    BILL_PDF_BATCH_SIZE
+
+
+@shared_task
+def generate_bill_pdf_job(bill_model, bill_id, user_id):
+    """Generate bill pdf file in background and attach it to the bill, replacing current one if any.
+    Other queued bills are generated in the same batch, so they share the same Ghostscript process for PDF/A conversion.
+    Job status (pending, running, done or error) is kept in cache. See queue_bill_pdf()
+    @param bill_model: bill model name (clientbill or internalbill)
+    @param bill_id: bill id
+    @param user_id: id of user that requested generation. Bill is rendered on their behalf"""
+    jobs = [(bill_model, bill_id, user_id)]
+    jobs.extend(job for job in dequeue_bill_pdf(BILL_PDF_BATCH_SIZE - 1) if job[:2] != (bill_model, bill_id))
+    # Skip bills already taken by another job
+    jobs = [job for job in jobs if cache.get(BILL_PDF_JOB_CACHE_KEY % job[:2]) not in ("running", "done")]
+    for job in jobs:
+        cache.set(BILL_PDF_JOB_CACHE_KEY % job[:2], "running", settings.BILL_PDF_JOB_TIMEOUT)
+
+    errors = []
+    rendered = []  # (job, bill, filename, pdf without PDF/A formatting)
+    for job in jobs:
+        try:
+            bill = apps.get_model("billing", job[0]).objects.get(id=job[1])
+            url_name = "billing:bill_pdf" if job[0] == "clientbill" else "billing:internal_bill_pdf"
+            # Host is used to build absolute url of static resources
+            request = create_fake_request(user=User.objects.get(id=job[2]), url=reverse(url_name, args=[job[1]]), public_host=True)
+            rendered.append((job, bill, *render_bill_pdf(bill, request, pdfa=False)))
+        except Exception as e:
+            cache.set(BILL_PDF_JOB_CACHE_KEY % job[:2], "error", settings.BILL_PDF_JOB_TIMEOUT)
+            errors.append(e)
+
+    try:
+        pdfs = format_bills_pdf([pdf for job, bill, filename, pdf in rendered], [bill for job, bill, filename, pdf in rendered])
+    except Exception:
+        pdfs = None  # Format bills one by one to isolate the failing one
+    for i, (job, bill, filename, pdf) in enumerate(rendered):
+        try:
+            attach_bill_pdf(bill, filename, pdfs[i] if pdfs else format_bills_pdf([pdf], [bill])[0])
+            cache.set(BILL_PDF_JOB_CACHE_KEY % job[:2], "done", settings.BILL_PDF_JOB_TIMEOUT)
+        except Exception as e:
+            cache.set(BILL_PDF_JOB_CACHE_KEY % job[:2], "error", settings.BILL_PDF_JOB_TIMEOUT)
+            errors.append(e)
+    if errors:
+        raise errors[0]
+
+
+@shared_task
+def purge_bill_annex_cache():
+    """Remove cached bill annexes that have not been used for BILL_ANNEX_CACHE_DAYS days. See cached_annex()"""
+    limit = time.time() - settings.BILL_ANNEX_CACHE_DAYS * 24 * 3600
+    for root, dirs, files in os.walk(settings.BILL_ANNEX_CACHE_PATH):
+        for name in files:
+            annex_path = os.path.join(root, name)
+            if os.path.getmtime(annex_path) < limit:
+                os.remove(annex_path)
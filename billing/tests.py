@@ -5,9 +5,17 @@ Test cases for billing module
 @license: AGPL v3 or newer (http://www.gnu.org/licenses/agpl-3.0.html)
 """
 from datetime import date
+from decimal import Decimal
 import json
-
-from django.test import TestCase, TransactionTestCase
+from unittest.mock import patch
+import os
+import tempfile
+import subprocess
+from io import BytesIO
+from base64 import b64encode
+
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.db import IntegrityError
 from django.db.models import Sum
@@ -15,15 +23,21 @@ from django.urls import reverse
 from django.contrib.auth.models import User
 from django.utils.translation import gettext as _
 
+from pypdf import PdfWriter
+
 from crm.models import Supplier, Subsidiary
-from billing.models import SupplierBill, ClientBill, BillDetail
+from billing.models import SupplierBill, ClientBill, BillDetail, BillExpense
 from billing.forms import BillDetailForm
 from leads.models import Lead
-from staffing.models import Timesheet, Mission, FinancialCondition
-from people.models import Consultant
+from expense.models import Expense, ExpenseCategory
+from staffing.models import Timesheet, Mission, FinancialCondition, Staffing
+from people.models import Consultant, RateObjective
 from core.tests import PYDICI_FIXTURES, setup_test_user_features, TEST_USERNAME
 from core.utils import previousMonth, nextMonth, get_parameter
-from billing.utils import get_client_billing_control_pivotable_data, get_billing_info
+from billing.utils import get_client_billing_control_pivotable_data, get_billing_info, queue_bill_pdf, ghostscript_slot, \
+    GHOSTSCRIPT_SLOT_CACHE_KEY, cached_annex, timesheet_annex_digest, pdfa_convert, update_bill_from_timesheet, \
+    outstanding_billing, client_billing_aging, supplier_bills_expected_billing, attach_bill_pdf
+from billing.tasks import generate_bill_pdf_job, purge_bill_annex_cache
 
 
 class BillingModelTest(TransactionTestCase):
@@ -155,6 +169,27 @@ class BillingModelTest(TransactionTestCase):
         self.assertEqual(bill2.client_deal_id, "123")  # multiple mission. Use lead client deal id
 
 
+    def test_bill_totals(self):
+        lead = Lead.objects.get(id=1)
+        mission = lead.mission_set.first()
+        bill = ClientBill(lead=lead, vat=Decimal(20))
+        bill.save()
+        BillDetail(bill=bill, mission=mission, quantity=2, unit_price=1000, vat=Decimal(20)).save()
+        BillDetail(bill=bill, mission=mission, quantity=1, unit_price=500, vat=Decimal(10)).save()
+        BillExpense(bill=bill, amount=100).save()
+        bill.save()
+        self.assertEqual(bill.amount, 2600)
+        self.assertEqual(bill.amount_with_vat, 3070)
+        for b in (ClientBill.objects.get(id=bill.id), ClientBill.objects.with_totals().get(id=bill.id)):
+            self.assertEqual(b.prestationsTotal(), 2500)
+            self.assertEqual(b.expensesTotal(), 100)
+            self.assertEqual(b.expensesTotalWithTaxes(), 120)
+            self.assertEqual(sorted(b.taxes()), [(10, 50), (20, 420)])
+        bill = ClientBill.objects.with_totals().get(id=bill.id)
+        with self.assertNumQueries(1):  # Only details taxes are queried
+            bill.prestationsTotal(), bill.expensesTotal(), bill.expensesTotalWithTaxes(), bill.taxes()
+
+
 class TestBillingViews(TestCase):
     fixtures = PYDICI_FIXTURES
 
@@ -342,6 +377,241 @@ class TestBillingUtils(TestCase):
         billing_info = get_billing_info(timesheet_data, apply_internal_markup=True)
         self.assertEqual(len(billing_info), 1)
         self.assertEqual(billing_info[0][1][0], 8000 * (1 - get_parameter("INTERNAL_MARKUP") / 100))
+        # Internal mission without rate use consultant objective rate. All is computed with a few queries
+        internal = Mission(subsidiary=s, nature="NONPROD", probability=100, billing_mode="TIME_SPENT")
+        internal.save()
+        RateObjective.objects.create(consultant=c, start_date=date(2000, 1, 1), rate=500, rate_type="DAILY_RATE")
+        RateObjective.objects.create(consultant=c, start_date=date(2001, 1, 1), rate=600, rate_type="DAILY_RATE")
+        Timesheet(mission=internal, consultant=c, working_date=previousMonth(date.today()), charge=2).save()
+        timesheet_data = Timesheet.objects.filter(mission__in=[m, internal], consultant=c).order_by("mission__lead", "consultant")
+        timesheet_data = list(timesheet_data.values_list("mission", "consultant").annotate(Sum("charge")))
+        with self.assertNumQueries(4):  # missions, consultants, financial conditions and objective rates
+            billing_info = get_billing_info(timesheet_data)
+        self.assertEqual(len(billing_info), 2)
+        self.assertEqual(billing_info[0][0], None)
+        self.assertEqual(billing_info[0][1][0], 1200)
+        self.assertEqual(billing_info[1][1][0], 8000)
+
+
+    def test_update_bill_from_timesheet(self):
+        s = Subsidiary(name="test", code="T")
+        s.save()
+        c1 = Consultant.objects.get(id=1)
+        c2 = Consultant.objects.get(id=2)
+        lead = Lead(subsidiary=s, client_id=1)
+        lead.save()
+        m = Mission(lead=lead, subsidiary=s, nature="PROD", probability=100, billing_mode="TIME_SPENT")
+        m.save()
+        FinancialCondition.objects.create(mission=m, consultant=c1, daily_rate=1000)
+        FinancialCondition.objects.create(mission=m, consultant=c2, daily_rate=500)
+        for month in (date(2023, 1, 1), date(2023, 2, 1), date(2023, 3, 1)):
+            Timesheet.objects.create(mission=m, consultant=c1, working_date=month, charge=1)
+            Timesheet.objects.create(mission=m, consultant=c1, working_date=month.replace(day=10), charge=0.5)
+            Timesheet.objects.create(mission=m, consultant=c2, working_date=month, charge=2)
+        bill = ClientBill.objects.create(lead=lead)
+        update_bill_from_timesheet(bill, m, date(2023, 1, 1), date(2023, 3, 1))
+        details = bill.billdetail_set.order_by("month", "consultant_id")
+        self.assertListEqual(list(details.values_list("month", "consultant", "quantity", "amount")),
+                             [(date(2023, 1, 1), 1, 1.5, 1500), (date(2023, 1, 1), 2, 2, 1000),
+                              (date(2023, 2, 1), 1, 1.5, 1500), (date(2023, 2, 1), 2, 2, 1000)])
+        self.assertEqual(bill.amount, 5000)
+        self.assertEqual(bill.amount_with_vat, 5000 * (1 + bill.vat / 100))
+
+    def test_outstanding_billing(self):
+        lead = Lead.objects.get(id=1)
+        ClientBill.objects.all().delete()
+        today = date(2023, 4, 15)
+        months = [date(2023, 1, 1), date(2023, 2, 1), date(2023, 3, 1), date(2023, 4, 1)]
+        # Paid in time, paid late, unpaid and overdue, not yet due
+        ClientBill.objects.bulk_create([
+            ClientBill(bill_id="1", lead=lead, state="2_PAID", amount=100, creation_date=date(2022, 12, 1),
+                       due_date=date(2023, 1, 10), payment_date=date(2023, 1, 5)),
+            ClientBill(bill_id="2", lead=lead, state="2_PAID", amount=200, creation_date=date(2023, 1, 1),
+                       due_date=date(2023, 1, 31), payment_date=date(2023, 3, 10)),
+            ClientBill(bill_id="3", lead=lead, state="1_SENT", amount=400, creation_date=date(2023, 1, 15),
+                       due_date=date(2023, 2, 15)),
+            ClientBill(bill_id="4", lead=lead, state="1_SENT", amount=800, creation_date=date(2023, 4, 1),
+                       due_date=date(2023, 5, 1))])
+        outstanding, outstanding_overdue = outstanding_billing(ClientBill.objects.all(), months, today=today)
+        self.assertListEqual(outstanding, [300, 600, 600, 1200])
+        self.assertListEqual(outstanding_overdue, [0, 400, 600, 400])
+        aging = client_billing_aging(ClientBill.objects.all(), today=today)
+        self.assertEqual(len(aging), 1)
+        self.assertListEqual(aging[0]["aging"], [800, 0, 400, 0, 0])  # 59 days overdue
+        self.assertEqual(aging[0]["total"], 1200)
+        self.assertEqual(aging[0]["dso"], 90 * 1200 // 1200)  # Only last bill is in DSO period
+
+    def test_supplier_bills_expected_billing(self):
+        lead = Lead(subsidiary_id=1, client_id=1)
+        lead.save()
+        mission = Mission(lead=lead, subsidiary_id=1, nature="PROD", probability=100)
+        mission.save()
+        supplier = Supplier.objects.get(id=1)
+        c = Consultant.objects.get(id=2)
+        c.subcontractor = True
+        c.subcontractor_company = supplier
+        c.save()
+        FinancialCondition.objects.create(mission=mission, consultant=c, daily_rate=800, bought_daily_rate=500)
+        Timesheet.objects.create(mission=mission, consultant=c, working_date=previousMonth(date.today()), charge=3)
+        Timesheet.objects.create(mission=mission, consultant=c, working_date=date.today(), charge=1)  # Not yet expected
+        bills = []
+        for i, state in enumerate(("1_VALIDATED", "1_RECEIVED", "1_RECEIVED")):
+            bill = SupplierBill(lead=lead, supplier=supplier, supplier_bill_id=str(i), amount=100, state=state)
+            bill.save()
+            bills.append(bill)
+        for state in ("VALIDATED", "REQUESTED"):
+            Expense.objects.create(user=User.objects.get(username=c.trigramme.lower()), lead=lead, description="train", category=ExpenseCategory.objects.get(id=1),
+                                   amount=50, chargeable=True, expense_date=date.today(), state=state)
+        with self.assertNumQueries(5):
+            expected_billing = supplier_bills_expected_billing(bills)
+        self.assertDictEqual(expected_billing, {bill.id: 1500 + 50 - 100 for bill in bills})
+        self.assertEqual(bills[0].expected_billing(), 1450)
+
+    def test_queue_bill_pdf(self):
+        bill = ClientBill.objects.create(lead=Lead.objects.get(id=1))
+        other_bill = ClientBill.objects.create(lead=Lead.objects.get(id=1))
+        self.assertIsNone(bill.pdf_generation_status())
+        with patch("billing.tasks.generate_bill_pdf_job.delay") as delay_mock:
+            with self.captureOnCommitCallbacks(execute=True):
+                queue_bill_pdf(bill, self.test_user)
+                queue_bill_pdf(other_bill, self.test_user)
+                self.assertEqual(bill.pdf_generation_status(), "pending")
+                delay_mock.assert_not_called()  # Job is started when transaction is committed
+            delay_mock.assert_any_call("clientbill", bill.id, self.test_user.id)
+            self.assertEqual(delay_mock.call_count, 2)
+        with patch("billing.tasks.render_bill_pdf", return_value=("bill.pdf", b"pdf")) as render_mock, \
+                patch("billing.tasks.format_bills_pdf", side_effect=lambda pdfs, bills: [b"pdfa"] * len(pdfs)) as format_mock, \
+                patch("billing.tasks.attach_bill_pdf") as attach_mock:
+            generate_bill_pdf_job("clientbill", bill.id, self.test_user.id)
+            # Both queued bills are generated and formatted together
+            self.assertEqual([call[0][0] for call in render_mock.call_args_list], [bill, other_bill])
+            self.assertEqual(render_mock.call_args[0][1].user, self.test_user)
+            self.assertFalse(render_mock.call_args[1]["pdfa"])
+            format_mock.assert_called_once_with([b"pdf", b"pdf"], [bill, other_bill])
+            attach_mock.assert_any_call(other_bill, "bill.pdf", b"pdfa")
+            self.assertEqual(bill.pdf_generation_status(), "done")
+            self.assertEqual(other_bill.pdf_generation_status(), "done")
+            # Second job has nothing left to do
+            render_mock.reset_mock()
+            generate_bill_pdf_job("clientbill", other_bill.id, self.test_user.id)
+            render_mock.assert_not_called()
+            # Errors
+            with patch("billing.tasks.generate_bill_pdf_job.delay"), self.captureOnCommitCallbacks(execute=True):
+                queue_bill_pdf(bill, self.test_user)
+            render_mock.side_effect = ValueError
+            with self.assertRaises(ValueError):
+                generate_bill_pdf_job("clientbill", bill.id, self.test_user.id)
+            self.assertEqual(bill.pdf_generation_status(), "error")
+
+    def test_attach_bill_pdf(self):
+        bill = ClientBill.objects.create(lead=Lead.objects.get(id=1))
+        with tempfile.TemporaryDirectory() as bill_path, patch.object(bill.bill_file.storage, "location", bill_path):
+            attach_bill_pdf(bill, "bill.pdf", b"first")
+            name = bill.bill_file.name
+            ClientBill.objects.filter(id=bill.id).update(client_comment="edited meanwhile")
+            attach_bill_pdf(bill, "bill.pdf", b"second")  # Replaced, with the same name
+            self.assertEqual(bill.bill_file.name, name)
+            self.assertEqual(os.listdir(os.path.dirname(bill.bill_file.path)), [os.path.basename(name)])
+            self.assertEqual(ClientBill.objects.get(id=bill.id).bill_file.read(), b"second")
+            self.assertEqual(ClientBill.objects.get(id=bill.id).client_comment, "edited meanwhile")
+            self.assertIn(b64encode(b"second").decode(), bill.bill_data())
+            bill.bill_file.name = "2000/01/%s/old.pdf" % bill.id  # File from another month
+            os.makedirs(os.path.dirname(bill.bill_file.path))
+            with open(bill.bill_file.path, "wb") as old_file:
+                old_file.write(b"old")
+            old_path = bill.bill_file.path
+            attach_bill_pdf(bill, "bill.pdf", b"third")
+            self.assertEqual(ClientBill.objects.get(id=bill.id).bill_file.read(), b"third")
+            self.assertFalse(os.path.exists(old_path))
+            bill.bill_file.name = "2000/01/%s/missing.pdf" % bill.id
+            self.assertEqual(bill.bill_data(), "")  # Missing file does not break bill pages
+
+    @override_settings(BILL_PDF_GHOSTSCRIPT_PROCESSES=2)
+    def test_ghostscript_slot(self):
+        with ghostscript_slot():
+            self.assertTrue(cache.get(GHOSTSCRIPT_SLOT_CACHE_KEY % 0))
+            with ghostscript_slot():
+                self.assertTrue(cache.get(GHOSTSCRIPT_SLOT_CACHE_KEY % 1))
+                with self.assertRaises(TimeoutError):  # All slots are busy
+                    with ghostscript_slot(wait=0.2):
+                        pass
+            self.assertIsNone(cache.get(GHOSTSCRIPT_SLOT_CACHE_KEY % 1))
+        self.assertIsNone(cache.get(GHOSTSCRIPT_SLOT_CACHE_KEY % 0))
+        with patch("billing.utils.cache.add", return_value=False):  # Unreachable cache
+            with self.assertRaises(TimeoutError):
+                with ghostscript_slot(wait=0.2):
+                    pass
+        with patch("billing.utils.cache.add", return_value=True) as add_mock:
+            with ghostscript_slot(timeout=60):
+                self.assertGreater(add_mock.call_args[0][2], 60)  # Slot outlives process
+
+
+    def test_pdfa_convert(self):
+        def blank_pdf(pages):
+            pdf = PdfWriter()
+            for i in range(pages):
+                pdf.add_blank_page(100, 100)
+            buffer = BytesIO()
+            pdf.write(buffer)
+            return buffer.getvalue()
+
+        def fake_gs(cmd, input=None, returncode=0, **kwargs):
+            # Copy input to output, "forgetting" second output file
+            if input:
+                return subprocess.CompletedProcess(cmd, returncode, stdout=input + b"%PDFA")
+            files = cmd[cmd.index("-dPDFACompatibilityPolicy=1") + 1:]
+            for output, input_path in zip(files[::2], files[1::2]):
+                if not output.endswith("out1.pdf"):
+                    with open(input_path, "rb") as gs_in, open(output.split("=")[1], "wb") as gs_out:
+                        gs_out.write(gs_in.read())
+            return subprocess.CompletedProcess(cmd, returncode)
+
+        pdfs = [blank_pdf(1), blank_pdf(2), blank_pdf(3)]
+        with patch("billing.utils.subprocess.run", side_effect=fake_gs) as gs_mock:
+            self.assertEqual(pdfa_convert(pdfs[:1]), [pdfs[0] + b"%PDFA"])
+            self.assertEqual(gs_mock.call_args[1]["input"], pdfs[0])  # Through pipes
+            gs_mock.reset_mock()
+            self.assertEqual(pdfa_convert(pdfs), [pdfs[0], pdfs[1] + b"%PDFA", pdfs[2]])
+            self.assertEqual(gs_mock.call_count, 2)  # One batch for all and one for missing output
+            gs_mock.reset_mock()
+            gs_mock.side_effect = lambda cmd, **kwargs: fake_gs(cmd, returncode=0 if kwargs.get("input") else 1, **kwargs)
+            self.assertEqual(pdfa_convert(pdfs), [pdf + b"%PDFA" for pdf in pdfs])  # Failed batch is converted one by one
+            self.assertEqual(gs_mock.call_count, 4)
+            gs_mock.side_effect = lambda cmd, **kwargs: fake_gs(cmd, returncode=1, **kwargs)
+            with self.assertRaises(subprocess.CalledProcessError):  # Failure is not attached as bill file
+                pdfa_convert(pdfs[:1])
+        self.assertFalse(cache.get(GHOSTSCRIPT_SLOT_CACHE_KEY % 0))  # Slot is released
+
+    def test_cached_annex(self):
+        mission = Mission.objects.get(id=1)
+        c = Consultant.objects.get(id=1)
+        start, end = date(2010, 1, 1), date(2010, 2, 1)
+        digest = timesheet_annex_digest(mission, start, end)
+        self.assertEqual(digest, timesheet_annex_digest(mission, start, end))
+        timesheet = Timesheet.objects.create(mission=mission, consultant=c, working_date=date(2010, 2, 28), charge=1)
+        self.assertNotEqual(digest, timesheet_annex_digest(mission, start, end))
+        timesheet.delete()
+        self.assertEqual(digest, timesheet_annex_digest(mission, start, end))
+        Timesheet.objects.create(mission=mission, consultant=c, working_date=date(2010, 3, 1), charge=1)  # Out of range
+        self.assertEqual(digest, timesheet_annex_digest(mission, start, end))
+        new_consultant = Consultant.objects.exclude(id__in=mission.consultants()).first()
+        Staffing.objects.create(mission=mission, consultant=new_consultant, staffing_date=date(2010, 3, 1), charge=1)
+        self.assertNotEqual(digest, timesheet_annex_digest(mission, start, end))
+
+        with tempfile.TemporaryDirectory() as cache_path, self.settings(BILL_ANNEX_CACHE_PATH=cache_path, BILL_ANNEX_CACHE_DAYS=1):
+            renders = []
+            def render():
+                renders.append(1)
+                return b"pdf"
+            self.assertEqual(cached_annex(digest, render), b"pdf")
+            self.assertEqual(cached_annex(digest, render), b"pdf")
+            self.assertEqual(len(renders), 1)  # Rendered once
+            annex_path = os.path.join(cache_path, digest[:2], "%s.pdf" % digest)
+            purge_bill_annex_cache()
+            self.assertTrue(os.path.exists(annex_path))
+            os.utime(annex_path, (0, 0))  # Not used for a long time
+            purge_bill_annex_cache()
+            self.assertFalse(os.path.exists(annex_path))
 
 
 class TestBillDetailForm(TestCase):
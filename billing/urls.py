@@ -12,6 +12,7 @@ import billing.tables as t
 
 billing_urls = [ re_path(r'^bill_review$', v.bill_review, name="bill_review"),
                  re_path(r'^client_billing_control$', v.client_billing_control_pivotable, name='client_billing_control_pivotable'),
+                 re_path(r'^client_billing_control/data$', v.client_billing_control_pivotable_data, name='client_billing_control_pivotable_data'),
                  re_path(r'^bill_delay$', v.bill_delay, name="bill_delay"),
                  re_path(r'^bill/(?P<bill_id>\d+)/mark_bill_paid$', v.mark_bill_paid, name="mark_bill_paid"),
                  re_path(r'^bill/file/(?P<nature>.+)/(?P<bill_id>\d+)$', v.bill_file, name="bill_file"),
@@ -10,55 +10,98 @@ appropriate to live in Billing models or view
 import json
 from os import path
 import os
+import hashlib
 import subprocess
 import tempfile
+import time
+from contextlib import contextmanager
+from datetime import date, timedelta
+from decimal import Decimal
+from io import BytesIO
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from itertools import accumulate
 
 
 from django.apps import apps
-from django.db.models import Sum, Count
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Sum, Count, Q
 from django.db.models.functions import TruncMonth
 from django.utils.translation import gettext as _
+from django.utils import translation
 from django.core.files.base import ContentFile
 from django.template.loader import get_template
 
 from core.utils import to_int_or_round, nextMonth, get_fiscal_year, get_parameter
 
 import facturx
+from pypdf import PdfReader
+from pypdf.errors import PdfReadError
+
+
+BILL_PDF_JOB_CACHE_KEY = "PYDICI_BILL_PDF_JOB_%s_%s"  # Bill model name and bill id
+BILL_PDF_QUEUE_CACHE_KEY = "PYDICI_BILL_PDF_QUEUE"  # Bills waiting for pdf generation
+BILL_PDF_QUEUE_LOCK_CACHE_KEY = "PYDICI_BILL_PDF_QUEUE_LOCK"
+BILL_PDF_BATCH_SIZE = 20  # Maximum number of bills generated together, with a single Ghostscript process
+GHOSTSCRIPT_SLOT_CACHE_KEY = "PYDICI_GHOSTSCRIPT_SLOT_%s"
+GHOSTSCRIPT_TIMEOUT = 120  # Ghostscript process time limit (in seconds)
+GHOSTSCRIPT_SLOT_MARGIN = 30  # Slot is held this long after process time limit before being released (in seconds)
+GHOSTSCRIPT_SLOT_WAIT = 300  # Maximum wait for a free Ghostscript slot (in seconds)
+BILLING_AGING_DAYS = (0, 30, 60, 90)  # Upper bounds of overdue days of client bills aging buckets
+BILLING_DSO_DAYS = 90  # Billing period (in days) used to compute days sales outstanding
+BILL_ANNEX_CACHE_VERSION = 1  # Increment to invalidate cached annexes when their rendering change
 
 
 def get_billing_info(timesheet_data, apply_internal_markup=False):
     """compute billing information from this timesheet data
+    Missions, leads, consultants, financial conditions and objective rates are fetched in bulk
+    whatever the number of timesheet rows.
     @:param timesheet_data: value queryset with mission, consultant and charge in days
     @:param apply_internal_markup: use internal markkup rate. Default is False
     @:return billing information as a tuple (lead, (lead total, (mission total, billing data)) """
     Mission = apps.get_model("staffing", "Mission")
     Consultant = apps.get_model("people", "Consultant")
+    FinancialCondition = apps.get_model("staffing", "FinancialCondition")
+    timesheet_data = list(timesheet_data)
+    if not timesheet_data:
+        return []
+    missions = Mission.objects.select_related("lead").in_bulk({row[0] for row in timesheet_data})
+    consultants = Consultant.objects.in_bulk({row[1] for row in timesheet_data})
+    rates = FinancialCondition.objects.filter(mission_id__in=missions.keys(), consultant_id__in=consultants.keys())
+    rates = {(mission_id, consultant_id): rate for mission_id, consultant_id, rate in rates.values_list("mission_id", "consultant_id", "daily_rate")}
+
+    # for internal mission, default to objective rate if mission rate is not defined
+    undefined_rates = {consultant_id for mission_id, consultant_id, charge in timesheet_data
+                       if not rates.get((mission_id, consultant_id)) and missions[mission_id].nature == "NONPROD"}
+    objective_rates = {}
+    if undefined_rates:
+        from people.models import RateObjectiveIndex  # Local to avoid circular import
+        objectives = RateObjectiveIndex(undefined_rates).resolve(undefined_rates, [date.today()], rate_type="DAILY_RATE")
+        objective_rates = {consultant_id: objective.rate or 0 for (consultant_id, day), objective in objectives.items() if objective}
+
+    if apply_internal_markup:
+        markup = (100 - get_parameter("INTERNAL_MARKUP")) / 100
+    else:
+        markup = 1
+
     billing_data = {}
     for mission_id, consultant_id, charge in timesheet_data:
-        mission = Mission.objects.select_related("lead").get(id=mission_id)
-        if mission.lead:
-            lead = mission.lead
-        else:
-            lead = None
-        consultant = Consultant.objects.get(id=consultant_id)
-        rates = mission.consultant_rates()
-        if rates[consultant][0] == 0 and mission.nature == "NONPROD":
-            # for internal mission, default to objective rate if mission rate is not defined
-            consultant_rate = consultant.get_rate_objective(rate_type="DAILY_RATE")
-            rates[consultant] = [consultant_rate.rate if consultant_rate else 0]
-        if apply_internal_markup:
-            markup = (100 - get_parameter("INTERNAL_MARKUP")) / 100
-        else:
-            markup = 1
+        mission = missions[mission_id]
+        lead = mission.lead
+        consultant = consultants[consultant_id]
+        rate = rates.get((mission_id, consultant_id), 0)
+        if rate == 0 and mission.nature == "NONPROD":
+            rate = objective_rates.get(consultant_id, 0)
         if lead not in billing_data:
             billing_data[lead] = [0.0, {}]  # Lead Total and dict of mission
         if mission not in billing_data[lead][1]:
             billing_data[lead][1][mission] = [0.0, []]  # Mission Total and detail per consultant
-        total = charge * rates[consultant][0] * markup
+        total = charge * rate * markup
         billing_data[lead][0] += total
         billing_data[lead][1][mission][0] += total
-        billing_data[lead][1][mission][1].append(
-            [consultant, to_int_or_round(charge, 2), rates[consultant][0] * markup, total])
+        billing_data[lead][1][mission][1].append([consultant, to_int_or_round(charge, 2), rate * markup, total])
 
     # Sort data
     billing_data = list(billing_data.items())
@@ -69,17 +112,14 @@ def get_billing_info(timesheet_data, apply_internal_markup=False):
 def compute_bill(bill):
     """Compute client bill amount according to its details. Should only be called by clientBill model save method"""
     if bill.state in ("0_DRAFT", "0_PROPOSED"):
-        amount = 0
-        amount_with_vat = 0
-        for bill_detail in bill.billdetail_set.all():
-            if bill_detail.amount:
-                amount += bill_detail.amount
-            if bill_detail.amount_with_vat:
-                amount_with_vat += bill_detail.amount_with_vat
+        totals = bill.billdetail_set.aggregate(Sum("amount"), Sum("amount_with_vat"))
+        amount = totals["amount__sum"] or 0
+        amount_with_vat = totals["amount_with_vat__sum"] or 0
 
         # Add expenses
-        amount += bill.expensesTotal()
-        amount_with_vat += bill.expensesTotalWithTaxes()
+        expenses = bill.billexpense_set.aggregate(Sum("amount"), Sum("amount_with_vat"))
+        amount += expenses["amount__sum"] or 0
+        amount_with_vat += expenses["amount_with_vat__sum"] or 0
 
         if amount != 0:
             bill.amount = amount
@@ -95,13 +135,9 @@ def compute_bill(bill):
 def compute_internal_bill(bill):
     """Compute internal bill amount according to its details. Should only be called by InternalBill model save method"""
     if bill.state in ("0_DRAFT"):
-        amount = 0
-        amount_with_vat = 0
-        for bill_detail in bill.internalbilldetail_set.all():
-            if bill_detail.amount:
-                amount += bill_detail.amount
-            if bill_detail.amount_with_vat:
-                amount_with_vat += bill_detail.amount_with_vat
+        totals = bill.internalbilldetail_set.aggregate(Sum("amount"), Sum("amount_with_vat"))
+        amount = totals["amount__sum"] or 0
+        amount_with_vat = totals["amount_with_vat__sum"] or 0
 
         if amount != 0:
             bill.amount = amount
@@ -115,7 +151,8 @@ def compute_internal_bill(bill):
 
 
 def update_bill_from_timesheet(bill, mission, start_date, end_date):
-    """Populate bill (client or internal)detail for given mission from timesheet of given interval"""
+    """Populate bill (client or internal)detail for given mission from timesheet of given interval.
+    Timesheet is fetched with one query grouped by month and consultant and details are created in bulk"""
     ClientBill = apps.get_model("billing", "clientbill")
     InternalBill = apps.get_model("billing", "internalbill")
     if isinstance(bill, ClientBill):
@@ -127,20 +164,30 @@ def update_bill_from_timesheet(bill, mission, start_date, end_date):
     else:
         raise ValueError("Not a client or internal bill")
 
-    month = start_date
-    while month < end_date:
-        timesheet_data = mission.timesheet_set.filter(working_date__gte=month, working_date__lt=nextMonth(month))
-        timesheet_data = timesheet_data .order_by("mission", "consultant").values_list("mission", "consultant").annotate(Sum("charge"))
-        if not timesheet_data:
-            month = nextMonth(month)
-            continue
-        billing_info = list((get_billing_info(timesheet_data, apply_internal_markup=markup)[0][1][1].values()))[0][1]
-        for consultant, quantity, unit_price, total in billing_info:
-            if isinstance(bill, InternalBill) and consultant.company != bill.seller:
+    # Whole months are billed, from start_date month up to the month before end_date
+    end = end_date if end_date.day == 1 else nextMonth(end_date)
+    timesheet_data = mission.timesheet_set.filter(working_date__gte=start_date, working_date__lt=end)
+    timesheet_data = timesheet_data.annotate(month=TruncMonth("working_date")).order_by("month", "consultant_id")
+    timesheet_data = list(timesheet_data.values_list("month", "consultant_id").annotate(Sum("charge")))
+    if timesheet_data:
+        # Unit price does not depend on month. Get it once for each consultant
+        charges = defaultdict(float)
+        for month, consultant_id, charge in timesheet_data:
+            charges[consultant_id] += charge
+        billing_info = get_billing_info([(mission.id, consultant_id, charge) for consultant_id, charge in charges.items()],
+                                        apply_internal_markup=markup)
+        billing_info = list(billing_info[0][1][1].values())[0][1]
+        unit_prices = {consultant.id: (consultant, unit_price) for consultant, quantity, unit_price, total in billing_info}
+        details = []
+        for month, consultant_id, charge in timesheet_data:
+            consultant, unit_price = unit_prices[consultant_id]
+            if isinstance(bill, InternalBill) and consultant.company_id != bill.seller_id:
                 continue
-            billDetail = LineDetail(bill=bill, mission=mission, month=month, consultant=consultant, quantity=quantity, unit_price=unit_price)
-            billDetail.save()
-        month = nextMonth(month)
+            detail = LineDetail(bill=bill, mission=mission, month=max(month, start_date), consultant=consultant,
+                                quantity=to_int_or_round(charge, 2), unit_price=unit_price)
+            detail.compute_amount()
+            details.append(detail)
+        LineDetail.objects.bulk_create(details)
     bill.save()  # save again to update bill amount according to its details
     return bill
 
@@ -168,7 +215,22 @@ def bill_pdf_filename(bill):
 def get_client_billing_control_pivotable_data(filter_on_subsidiary=None, filter_on_company=None,
                                               filter_on_responsible=None,
                                               filter_on_lead=None, only_active=False):
-    """Compute pivotable to check lead/mission billing."""
+    """Compute pivotable to check lead/mission billing.
+    @return: json list of rows. See client_billing_control_pivotable_rows()"""
+    return json.dumps(list(client_billing_control_pivotable_rows(filter_on_subsidiary=filter_on_subsidiary,
+                                                                 filter_on_company=filter_on_company,
+                                                                 filter_on_responsible=filter_on_responsible,
+                                                                 filter_on_lead=filter_on_lead,
+                                                                 only_active=only_active)))
+
+
+def client_billing_control_pivotable_rows(filter_on_subsidiary=None, filter_on_company=None,
+                                          filter_on_responsible=None,
+                                          filter_on_lead=None, only_active=False):
+    """Generate pivotable rows to check lead/mission billing.
+    Data is retrieved with a few grouped queries (bills, expenses, monthly turnover per mission/consultant)
+    for all leads at once and merged in memory. Rows are generated one by one to be streamed.
+    @return: generator of dict"""
     # local import to avoid circurlar weirdness
     ClientBill = apps.get_model("billing", "ClientBill")
     BillDetail = apps.get_model("billing", "BillDetail")
@@ -176,8 +238,9 @@ def get_client_billing_control_pivotable_data(filter_on_subsidiary=None, filter_
     Lead = apps.get_model("leads", "Lead")
     Expense = apps.get_model("expense", "Expense")
     Consultant = apps.get_model("people", "Consultant")
+    Mission = apps.get_model("staffing", "Mission")
+    MonthlyTurnover = apps.get_model("staffing", "MonthlyTurnover")
 
-    data = []
     bill_state = ("0_PROPOSED", "1_SENT", "2_PAID")  # Only consider clients bills in those statuses
     leads = Lead.objects.all()
     if filter_on_subsidiary:
@@ -192,8 +255,38 @@ def get_client_billing_control_pivotable_data(filter_on_subsidiary=None, filter_
     if only_active:
         leads = leads.filter(mission__active=True).distinct()
 
+    leads_id = leads.values("id")
     leads = leads.select_related("client__organisation__company",
-                                 "business_broker__company", "subsidiary")
+                                 "business_broker__company", "subsidiary", "responsible__manager")
+
+    # Legacy bills non-related to specific mission (i.e. not using pydici billing, just header and pdf payload)
+    legacy_bills = defaultdict(list)
+    bills = ClientBill.objects.filter(lead__in=leads_id, state__in=bill_state).annotate(Count("billdetail"), Count("billexpense"))
+    for legacy_bill in bills.filter(billdetail__count=0, billexpense__count=0):
+        legacy_bills[legacy_bill.lead_id].append(legacy_bill)
+
+    # Chargeable expenses and expenses bills per lead and month
+    lead_expenses = defaultdict(list)
+    expenses = Expense.objects.filter(lead__in=leads_id, chargeable=True)
+    bill_expenses = BillExpense.objects.filter(bill__lead__in=leads_id, bill__state__in=bill_state).exclude(expense_date=None)
+    for qs, lead_field, label, way in ((expenses, "lead", _("Expense"), 1), (bill_expenses, "bill__lead", _("Expense bill"), -1)):
+        qs = qs.annotate(month=TruncMonth("expense_date")).order_by(lead_field, "month").values(lead_field, "month")
+        for lead_id, month, amount in qs.annotate(Sum("amount")).values_list(lead_field, "month", "amount__sum"):
+            lead_expenses[lead_id].append((month, amount, label, way))
+
+    # Missions with their bills, financial conditions and done work per consultant and month
+    lead_missions = defaultdict(list)
+    missions = Mission.objects.filter(lead__in=leads_id).select_related("responsible")
+    for mission in missions:
+        lead_missions[mission.lead_id].append(mission)
+    mission_bills = defaultdict(list)
+    for bill_detail in BillDetail.objects.filter(mission__lead__in=leads_id, bill__state__in=bill_state).select_related("bill", "consultant"):
+        mission_bills[bill_detail.mission_id].append(bill_detail)
+    done_work = defaultdict(dict)  # Done work amount per (consultant id, month) for each mission
+    turnovers = MonthlyTurnover.objects.filter(mission__lead__in=leads_id).values_list("mission_id", "consultant_id", "month", "amount")
+    for mission_id, consultant_id, month, amount in turnovers:
+        done_work[mission_id][(consultant_id, month)] = amount
+    consultants = Consultant.objects.in_bulk({consultant_id for work in done_work.values() for consultant_id, month in work})
 
     for lead in leads:
         lead_data = {_("deal id"): lead.deal_id,
@@ -204,87 +297,190 @@ def get_client_billing_control_pivotable_data(filter_on_subsidiary=None, filter_
                      _("responsible"): str(lead.responsible),
                      _("manager"): str(lead.responsible.manager if lead.responsible else "-"),
                      _("consultant"): "-"}
-        # Add legacy bills non-related to specific mission (i.e. not using pydici billing, just header and pdf payload)
-        legacy_bills = ClientBill.objects.filter(lead=lead, state__in=bill_state).annotate(Count("billdetail"), Count("billexpense")).filter(billdetail__count=0, billexpense__count=0)
-        for legacy_bill in legacy_bills:
+        for mission in lead_missions[lead.id]:
+            mission.lead = lead  # Avoid fetching lead again for mission name
+        # Add legacy bills
+        for legacy_bill in legacy_bills[lead.id]:
             legacy_bill_data = lead_data.copy()
             legacy_bill_data[_("amount")] = - float(legacy_bill.amount or 0)
             legacy_bill_data[_("month")] = legacy_bill.creation_date.replace(day=1).isoformat()
             legacy_bill_data[_("fiscal year")] = get_fiscal_year(legacy_bill.creation_date.replace(day=1))
             legacy_bill_data[_("type")] = _("Service bill")
             legacy_bill_data[_("mission")] = "-"
-            mission = lead.mission_set.first()
-            if mission:  # default to billing mode of first mission. Not 100% accurate...
-                legacy_bill_data[_("billing mode")] = mission.get_billing_mode_display()
-            data.append(legacy_bill_data)
+            if lead_missions[lead.id]:  # default to billing mode of first mission. Not 100% accurate...
+                legacy_bill_data[_("billing mode")] = lead_missions[lead.id][0].get_billing_mode_display()
+            yield legacy_bill_data
         # Add chargeable expense
-        expenses = Expense.objects.filter(lead=lead, chargeable=True)
-        bill_expenses = BillExpense.objects.filter(bill__lead=lead, bill__state__in=bill_state).exclude(expense_date=None)
-        for qs, label, way in ((expenses, _("Expense"), 1), (bill_expenses, _("Expense bill"), -1)):
-            qs = qs.annotate(month=TruncMonth("expense_date")).order_by("month").values("month")
-            for month, amount in qs.annotate(Sum("amount")).values_list("month", "amount__sum"):
-                expense_data = lead_data.copy()
-                expense_data[_("month")] = month.isoformat()
-                expense_data[_("fiscal year")] = get_fiscal_year(month)
-                expense_data[_("type")] = label
-                expense_data[_("billing mode")] = _("Chargeable expense")
-                expense_data[_("amount")] = float(amount) * way
-                expense_data[_("mission")] = "-"
-                expense_data[_("state")] = "-"
-                data.append(expense_data)
+        for month, amount, label, way in lead_expenses[lead.id]:
+            expense_data = lead_data.copy()
+            expense_data[_("month")] = month.isoformat()
+            expense_data[_("fiscal year")] = get_fiscal_year(month)
+            expense_data[_("type")] = label
+            expense_data[_("billing mode")] = _("Chargeable expense")
+            expense_data[_("amount")] = float(amount) * way
+            expense_data[_("mission")] = "-"
+            expense_data[_("state")] = "-"
+            yield expense_data
         # Add new-style client bills and done work per mission
-        for mission in lead.mission_set.all().select_related("responsible"):
-            done_work_total = 0  # Track total done work across month and consultant to ensure it does not exceed fixed price amount
+        for mission in lead_missions[lead.id]:
             mission_data = lead_data.copy()
             mission_data[_("mission")] = mission.short_name()
-            mission_data[_("responsible")] = str(mission.lead.responsible)
+            mission_data[_("responsible")] = str(lead.responsible)
             mission_data[_("billing mode")] = mission.get_billing_mode_display()
             mission_data[_("state")] = _("active") if mission.active else _("archived")
             # Add fixed price bills
             if mission.billing_mode == "FIXED_PRICE":
-                for billDetail in BillDetail.objects.filter(mission=mission, bill__state__in=bill_state):
+                for billDetail in mission_bills[mission.id]:
                     mission_fixed_price_data = mission_data.copy()
                     mission_fixed_price_data[_("month")] = billDetail.bill.creation_date.replace(day=1).isoformat()
                     mission_fixed_price_data[_("fiscal year")] = get_fiscal_year(billDetail.bill.creation_date.replace(day=1))
                     mission_fixed_price_data[_("type")] = _("Service bill")
                     mission_fixed_price_data[_("amount")] = -float(billDetail.amount or 0)
-                    data.append(mission_fixed_price_data)
-            # Add done work and time spent bills
-            consultants = Consultant.objects.filter(timesheet__mission=mission).distinct()
-            for month in mission.timesheet_set.dates("working_date", "month", order="ASC"):
-                next_month = nextMonth(month)
-                for consultant in consultants:
-                    mission_month_consultant_data = mission_data.copy()
-                    turnover = float(mission.done_work_period(month, next_month, include_external_subcontractor=True,
-                                     include_internal_subcontractor=True, filter_on_consultant=consultant)[1])
-                    if mission.billing_mode == "FIXED_PRICE" and mission.price:
-                        if done_work_total >= 1000 * mission.price:
-                            turnover = 0  # Sorry, no more money on this one
-                        else:
-                            turnover = min(turnover, float(1000 * mission.price) - done_work_total)
-                        done_work_total += turnover
-
-                    mission_month_consultant_data[_("consultant")] = str(consultant)
-                    mission_month_consultant_data[_("month")] = month.isoformat()
-                    mission_month_consultant_data[_("fiscal year")] = get_fiscal_year(month)
-                    mission_month_consultant_data[_("amount")] = turnover
-                    mission_month_consultant_data[_("type")] = _("Done work")
-                    data.append(mission_month_consultant_data)
+                    yield mission_fixed_price_data
+            # Add done work for each month and consultant of mission
+            work = done_work[mission.id]
+            months = sorted({month for consultant_id, month in work})
+            mission_consultants = sorted({consultants[consultant_id] for consultant_id, month in work}, key=lambda c: c.name)
+            keys = [(consultant, month) for month in months for consultant in mission_consultants]
+            turnovers = [float(work.get((consultant.id, month), 0)) for consultant, month in keys]
+            if mission.billing_mode == "FIXED_PRICE" and mission.price:
+                # Done work cannot exceed fixed price amount: cap cumulated done work and get back monthly values
+                cumulated = [min(total, float(1000 * mission.price)) for total in accumulate(turnovers)]
+                turnovers = [current - previous for current, previous in zip(cumulated, [0] + cumulated[:-1])]
+            for (consultant, month), turnover in zip(keys, turnovers):
+                mission_month_consultant_data = mission_data.copy()
+                mission_month_consultant_data[_("consultant")] = str(consultant)
+                mission_month_consultant_data[_("month")] = month.isoformat()
+                mission_month_consultant_data[_("fiscal year")] = get_fiscal_year(month)
+                mission_month_consultant_data[_("amount")] = turnover
+                mission_month_consultant_data[_("type")] = _("Done work")
+                yield mission_month_consultant_data
             if mission.billing_mode == "TIME_SPENT":  # Add bills for time spent mission
-                for billed_detail in BillDetail.objects.filter(mission=mission, bill__state__in=bill_state).select_related("consultant"):
+                for billed_detail in mission_bills[mission.id]:
                     mission_month_bill_data = mission_data.copy()
                     mission_month_bill_data[_("month")] = billed_detail.month.isoformat()
                     mission_month_bill_data[_("fiscal year")] = get_fiscal_year(billed_detail.month)
                     mission_month_bill_data[_("amount")] = -float(billed_detail.amount or 0)
                     mission_month_bill_data[_("type")] = _("Service bill")
                     mission_month_bill_data[_("consultant")] = str(billed_detail.consultant)
-                    data.append(mission_month_bill_data)
+                    yield mission_month_bill_data
 
-    return json.dumps(data)
 
 
-def generate_bill_pdf(bill, request):
-    """Generate bill pdf file and update bill object with file path"""
+def supplier_bills_expected_billing(bills):
+    """Expected billing amount for supplier / lead of each supplier bill: subcontractors time spent on lead missions
+    (up to previous month) at bought rate plus supplier validated expenses on lead, minus bills already validated or paid.
+    Computed with a few grouped queries whatever the number of bills
+    @param bills: list or queryset of supplier bills
+    @return: dict with bill id as key and expected amount as value"""
+    SupplierBill = apps.get_model("billing", "SupplierBill")
+    Timesheet = apps.get_model("staffing", "Timesheet")
+    FinancialCondition = apps.get_model("staffing", "FinancialCondition")
+    Consultant = apps.get_model("people", "Consultant")
+    Expense = apps.get_model("expense", "Expense")
+    bills = list(bills)
+    if not bills:
+        return {}
+    leads_id = {bill.lead_id for bill in bills}
+    suppliers_id = {bill.supplier_id for bill in bills}
+    expected = defaultdict(float)  # (supplier id, lead id) as key
+
+    # Subcontractors time spent at bought rate
+    rates = FinancialCondition.objects.filter(mission__lead_id__in=leads_id).order_by("id")
+    rates = {(mission_id, consultant_id): rate or 0 for mission_id, consultant_id, rate in
+             rates.values_list("mission_id", "consultant_id", "bought_daily_rate")}
+    timesheets = Timesheet.objects.filter(mission__lead_id__in=leads_id, working_date__lt=date.today().replace(day=1),
+                                          consultant__subcontractor=True, consultant__subcontractor_company_id__in=suppliers_id)
+    timesheets = timesheets.values_list("consultant__subcontractor_company_id", "mission__lead_id", "mission_id", "consultant_id")
+    for supplier_id, lead_id, mission_id, consultant_id, days in timesheets.annotate(Sum("charge")).order_by():
+        expected[(supplier_id, lead_id)] += days * rates.get((mission_id, consultant_id), 0)
+
+    # Supplier expenses
+    consultants = Consultant.objects.filter(subcontractor_company_id__in=suppliers_id)
+    suppliers_users = {trigramme.lower(): supplier_id for trigramme, supplier_id in
+                       consultants.values_list("trigramme", "subcontractor_company_id")}  # Trigramme is unique
+    expenses = Expense.objects.filter(lead_id__in=leads_id, state__in=("VALIDATED", "CONTROLLED"),
+                                      user__username__in=suppliers_users.keys())
+    for username, lead_id, amount in expenses.values_list("user__username", "lead_id").annotate(Sum("amount")).order_by():
+        supplier_id = suppliers_users.get(username.lower())  # Username filter may be case insensitive according to collation
+        if supplier_id:
+            expected[(supplier_id, lead_id)] += float(amount or 0)
+
+    # Already validated or paid
+    already_paid = SupplierBill.objects.filter(supplier_id__in=suppliers_id, lead_id__in=leads_id, state__in=("1_VALIDATED", "2_PAID"))
+    for supplier_id, lead_id, amount in already_paid.values_list("supplier_id", "lead_id").annotate(Sum("amount")).order_by():
+        expected[(supplier_id, lead_id)] -= float(amount or 0)
+
+    return {bill.id: expected[(bill.supplier_id, bill.lead_id)] for bill in bills}
+
+
+def outstanding_billing(bills, months, today=None):
+    """Outstanding and overdue outstanding amount of client bills for each month. Computed with one pass over bills:
+    each bill adds its amount to the range of months where it is outstanding (interval sweep)
+    @param bills: client bills queryset
+    @param months: ordered list of months (first day of month)
+    @param today: date used to define overdue bills. Default is today
+    @return: (outstanding, outstanding overdue) amounts lists, one amount per month"""
+    today = today or date.today()
+    ends = [nextMonth(month) for month in months]
+    outstanding = [Decimal(0)] * (len(months) + 1)  # Amounts variation at month start
+    outstanding_overdue = [Decimal(0)] * (len(months) + 1)
+    bills = bills.filter(due_date__lte=ends[-1]).exclude(payment_date__lt=months[0])
+    for due_date, payment_date, amount in bills.values_list("due_date", "payment_date", "amount"):
+        if not amount:
+            continue
+        # Bill is outstanding from month where due date is reached up to month where it is paid
+        first = bisect_left(ends, due_date)
+        last = bisect_right(months, payment_date) if payment_date else len(months)
+        if first < last:
+            outstanding[first] += amount
+            outstanding[last] -= amount
+        # Bill is overdue if not paid in time. It is counted up to now if not paid yet, else only when it is paid
+        if due_date <= today and (payment_date is None or payment_date > due_date):
+            if payment_date:
+                first = max(first, bisect_left(ends, payment_date))
+            if first < last:
+                outstanding_overdue[first] += amount
+                outstanding_overdue[last] -= amount
+    return ([float(amount) for amount in accumulate(outstanding[:-1])],
+            [float(amount) for amount in accumulate(outstanding_overdue[:-1])])
+
+
+def client_billing_aging(bills, today=None):
+    """Outstanding amount of client bills for each client company, split by overdue delay,
+    along with days sales outstanding (DSO) computed on last BILLING_DSO_DAYS days of billing
+    @param bills: client bills queryset
+    @param today: date used to define overdue bills. Default is today
+    @return: list of dict with client, aging (amount for not due, 1-30, 31-60, 61-90 and more than 90 days overdue),
+    total and dso (None if nothing was billed recently) sorted by descending total"""
+    today = today or date.today()
+    dso_start = today - timedelta(BILLING_DSO_DAYS)
+    aging = defaultdict(lambda: [Decimal(0)] * (len(BILLING_AGING_DAYS) + 1))
+    billed = defaultdict(Decimal)
+    bills = bills.filter(Q(payment_date__isnull=True) | Q(payment_date__gt=today) | Q(creation_date__gte=dso_start))
+    bills = bills.values_list("lead__client__organisation__company__name", "creation_date", "due_date", "payment_date", "amount")
+    for client, creation_date, due_date, payment_date, amount in bills:
+        if not amount:
+            continue
+        if creation_date >= dso_start:
+            billed[client] += amount
+        if payment_date is None or payment_date > today:
+            aging[client][bisect_left(BILLING_AGING_DAYS, (today - due_date).days)] += amount
+    result = []
+    for client, amounts in aging.items():
+        total = sum(amounts)
+        dso = round(float(total / billed[client]) * BILLING_DSO_DAYS) if billed[client] else None
+        result.append({"client": client, "aging": [float(amount) for amount in amounts], "total": float(total), "dso": dso})
+    result.sort(key=lambda row: row["total"], reverse=True)
+    return result
+
+
+def render_bill_pdf(bill, request, pdfa=True):
+    """Render bill pdf file
+    @param bill: client or internal bill
+    @param request: request used to render the bill
+    @param pdfa: make it PDF/A compliant with factur-x information. If False, it must be done later with format_bills_pdf()
+    @return: bill file name, pdf bytes"""
     from billing.views import BillPdf, InternalBillPdf  # Local to avoid circular import
     ClientBill = apps.get_model("billing", "clientbill")
     InternalBill = apps.get_model("billing", "internalbill")
@@ -298,11 +494,140 @@ def generate_bill_pdf(bill, request):
         raise ValueError("Not a client or internal bill")
     fake_http_request = request
     fake_http_request.method = "GET"
-    response = PdfView.as_view()(fake_http_request, bill_id=bill.id)
-    pdf = response.rendered_content
-    content = ContentFile(pdf, name=filename)
-    bill.bill_file.save(filename, content)
-    bill.save()
+    response = PdfView.as_view(pdfa=pdfa)(fake_http_request, bill_id=bill.id)
+    return filename, response.rendered_content
+
+
+def attach_bill_pdf(bill, filename, pdf):
+    """Attach pdf to bill, replacing current bill file if any. Current file stays readable until the new one is attached.
+    Only bill file is updated in database to avoid overwriting changes made on bill meanwhile
+    @param bill: client or internal bill
+    @param filename: bill file name
+    @param pdf: pdf content"""
+    storage = bill.bill_file.storage
+    target_name = bill.bill_file.field.generate_filename(bill, filename)
+
+    def attach(name):
+        bill.bill_file.name = storage.save(name, ContentFile(pdf), max_length=bill.bill_file.field.max_length)
+        bill._meta.model.objects.filter(id=bill.id).update(bill_file=bill.bill_file.name)
+
+    old_name = bill.bill_file.name or None
+    attach(target_name)
+    if old_name and old_name != bill.bill_file.name:
+        storage.delete(old_name)
+        if bill.bill_file.name != target_name:
+            # Current file was holding target name. Now it is free, use it to keep bill file name stable
+            new_name = bill.bill_file.name
+            attach(target_name)
+            storage.delete(new_name)
+
+
+def queue_bill_pdf(bill, user):
+    """Queue bill pdf file generation in background. Generated file replace current bill file.
+    @param bill: client or internal bill
+    @param user: user that request generation. Used to render the bill"""
+    from billing.tasks import generate_bill_pdf_job  # Local to avoid circular import
+    bill_model = bill._meta.model_name
+    cache.set(BILL_PDF_JOB_CACHE_KEY % (bill_model, bill.id), "pending", settings.BILL_PDF_JOB_TIMEOUT)
+
+    def start_job():
+        # Queued bills are generated in batch by the first job that runs. See dequeue_bill_pdf()
+        with bill_pdf_queue_lock():
+            queue = [job for job in cache.get(BILL_PDF_QUEUE_CACHE_KEY) or [] if job[:2] != (bill_model, bill.id)]
+            queue.append((bill_model, bill.id, user.id))
+            cache.set(BILL_PDF_QUEUE_CACHE_KEY, queue, settings.BILL_PDF_JOB_TIMEOUT)
+        generate_bill_pdf_job.delay(bill_model, bill.id, user.id)
+
+    # Wait for commit to ensure bill and its details are up to date when job starts
+    transaction.on_commit(start_job)
+
+
+def dequeue_bill_pdf(count=BILL_PDF_BATCH_SIZE):
+    """Take bills waiting for pdf generation. See queue_bill_pdf()
+    @param count: maximum number of bills to take
+    @return: list of (bill model name, bill id, user id)"""
+    with bill_pdf_queue_lock():
+        queue = cache.get(BILL_PDF_QUEUE_CACHE_KEY) or []
+        cache.set(BILL_PDF_QUEUE_CACHE_KEY, queue[count:], settings.BILL_PDF_JOB_TIMEOUT)
+    return queue[:count]
+
+
+@contextmanager
+def bill_pdf_queue_lock(wait=10):
+    """Lock bill pdf generation queue, shared in cache by web and celery workers
+    @param wait: maximum wait for the lock (in seconds). TimeoutError is raised after"""
+    deadline = time.time() + wait
+    while not cache.add(BILL_PDF_QUEUE_LOCK_CACHE_KEY, True, wait):  # Lock is released after wait if process crashes
+        if time.time() > deadline:
+            raise TimeoutError("Bill pdf queue is still locked after %s seconds" % wait)
+        time.sleep(0.05)
+    try:
+        yield
+    finally:
+        cache.delete(BILL_PDF_QUEUE_LOCK_CACHE_KEY)
+
+
+@contextmanager
+def ghostscript_slot(timeout=GHOSTSCRIPT_TIMEOUT, wait=GHOSTSCRIPT_SLOT_WAIT):
+    """Wait for a free Ghostscript slot. Slots are shared in cache to bound the number of concurrent
+    Ghostscript processes across web and celery workers (see BILL_PDF_GHOSTSCRIPT_PROCESSES)
+    @param timeout: Ghostscript process time limit (in seconds). Slot outlives it and is released if process crashes
+    @param wait: maximum wait for a free slot (in seconds). TimeoutError is raised after"""
+    deadline = time.time() + wait
+    while True:
+        for slot in range(settings.BILL_PDF_GHOSTSCRIPT_PROCESSES):
+            key = GHOSTSCRIPT_SLOT_CACHE_KEY % slot
+            if cache.add(key, True, timeout + GHOSTSCRIPT_SLOT_MARGIN):
+                try:
+                    yield
+                finally:
+                    cache.delete(key)
+                return
+        if time.time() > deadline:
+            raise TimeoutError("No Ghostscript slot available after %s seconds" % wait)
+        time.sleep(0.1)
+
+
+def timesheet_annex_digest(mission, start, end):
+    """Digest of everything that is displayed in mission timesheet report annex from start to end month (included)
+    @return: hex digest"""
+    Timesheet = apps.get_model("staffing", "Timesheet")
+    timesheets = Timesheet.objects.filter(mission=mission, working_date__gte=start, working_date__lt=nextMonth(end))
+    timesheets = timesheets.order_by("working_date", "consultant_id").values_list("consultant_id", "consultant__name",
+                                                                                  "working_date", "charge")
+    # Report has a row for each mission consultant, even staffed ones without timesheet
+    consultants = mission.consultants().order_by("name", "id").values_list("id", "name")
+    content = [BILL_ANNEX_CACHE_VERSION, "timesheet", translation.get_language(), mission.id, mission.full_name(),
+               mission.subsidiary.code, start, end, list(consultants), list(timesheets)]
+    return hashlib.sha256(json.dumps(content, default=str).encode()).hexdigest()
+
+
+def file_digest(field_file):
+    """Digest of a file field content
+    @return: hex digest"""
+    digest = hashlib.sha256()
+    for chunk in field_file.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cached_annex(digest, render):
+    """Content addressed cache of rendered bill annexes. Annex is rendered only if no annex with the same
+    digest has been rendered before. Unused annexes are purged by purge_bill_annex_cache task
+    @param digest: hex digest of annex content. See timesheet_annex_digest()
+    @param render: function without argument that renders the annex pdf
+    @return: pdf bytes"""
+    annex_path = path.join(settings.BILL_ANNEX_CACHE_PATH, digest[:2], "%s.pdf" % digest)
+    if path.exists(annex_path):
+        os.utime(annex_path)  # Mark it as used
+        with open(annex_path, "rb") as annex_file:
+            return annex_file.read()
+    pdf = render()
+    os.makedirs(path.dirname(annex_path), exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=path.dirname(annex_path), delete=False) as annex_file:
+        annex_file.write(pdf)
+    os.replace(annex_file.name, annex_path)  # Atomic to avoid concurrent generation to read partial file
+    return pdf
 
 
 def get_bill_id_from_path(name):
@@ -310,20 +635,56 @@ def get_bill_id_from_path(name):
     return os.path.split(path.dirname(name))[1]
 
 
-def format_bill_pdf(pdf_buffer, bill):
-    """Make it PDF/A-3B compliant and add optional factur-x embedded information
-    @param pdf_buffer: PDF buffer as a BytesIO object
-    @return: PDF buffer as a BytesIO object"""
-    # Make it PDF/A-3B compliant
-    cmd = "gs -q -dPDFA=3 -dBATCH -dNOPAUSE -sColorConversionStrategy=UseDeviceIndependentColor -sDEVICE=pdfwrite -dPDFACompatibilityPolicy=1 -sOutputFile=- -"
-    try:
-        pdf_buffer.seek(0)  # Be kind, rewind
-        gs_in = tempfile.TemporaryFile()
-        gs_out = tempfile.TemporaryFile()
-        gs_in.write(pdf_buffer.getvalue())
-        gs_in.seek(0)
-        subprocess.run(cmd.split(), stdin=gs_in, stdout=gs_out)
-        gs_out.seek(0)
+def pdfa_convert(pdfs):
+    """Make pdf files PDF/A-3B compliant with Ghostscript. All files are converted by the same Ghostscript process
+    to avoid paying process start-up for each file. One file is converted through pipes, many files through
+    memory backed temporary files if available. Files badly converted by batch are converted again one by one
+    @param pdfs: list of pdf bytes
+    @return: list of PDF/A-3B pdf bytes"""
+    cmd = ["gs", "-q", "-dPDFA=3", "-dBATCH", "-dNOPAUSE", "-sColorConversionStrategy=UseDeviceIndependentColor",
+           "-sDEVICE=pdfwrite", "-dPDFACompatibilityPolicy=1"]
+    if not pdfs:
+        return []
+    if len(pdfs) == 1:
+        cmd.extend(["-sOutputFile=-", "-"])
+        with ghostscript_slot():
+            gs = subprocess.run(cmd, input=pdfs[0], stdout=subprocess.PIPE, timeout=GHOSTSCRIPT_TIMEOUT)
+        if gs.returncode != 0 or not gs.stdout:
+            raise subprocess.CalledProcessError(gs.returncode, cmd, output=gs.stdout)
+        return [gs.stdout]
+    tmp_dir = "/dev/shm" if path.isdir("/dev/shm") else None  # Avoid disk io when tmpfs is available
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as gs_dir:
+        for i, pdf in enumerate(pdfs):
+            with open(path.join(gs_dir, "in%s.pdf" % i), "wb") as gs_in:
+                gs_in.write(pdf)
+            # Output file is switched before each input file
+            cmd.extend(["-sOutputFile=%s" % path.join(gs_dir, "out%s.pdf" % i), path.join(gs_dir, "in%s.pdf" % i)])
+        timeout = GHOSTSCRIPT_TIMEOUT * len(pdfs)
+        with ghostscript_slot(timeout):
+            gs = subprocess.run(cmd, timeout=timeout)
+        result = []
+        for i, pdf in enumerate(pdfs):
+            out_path = path.join(gs_dir, "out%s.pdf" % i)
+            try:
+                if gs.returncode != 0:
+                    raise ValueError("Ghostscript failed with code %s" % gs.returncode)
+                with open(out_path, "rb") as gs_out:
+                    converted = gs_out.read()
+                if len(PdfReader(BytesIO(converted)).pages) != len(PdfReader(BytesIO(pdf)).pages):
+                    raise ValueError("Pages are missing in %s" % out_path)
+            except (OSError, ValueError, PdfReadError):
+                converted = pdfa_convert([pdf])[0]
+            result.append(converted)
+    return result
+
+
+def format_bills_pdf(pdfs, bills):
+    """Make them PDF/A-3B compliant and add optional factur-x embedded information. PDF/A conversion is done in batch
+    @param pdfs: list of pdf bytes, as rendered by render_bill_pdf() without PDF/A formatting
+    @param bills: list of bills, in the same order as pdfs
+    @return: list of PDF bytes"""
+    result = []
+    for pdf, bill in zip(pdfa_convert(pdfs), bills):
         # Add factur-x information
         if bill.add_facturx_data:
             facturx_xml = get_template("billing/invoice-factur-x.xml").render({"bill": bill})
@@ -335,10 +696,13 @@ def format_bill_pdf(pdf_buffer, bill):
                 "subject": "Factur-X invoice %s dated %s issued by enioka"
                 % (bill.bill_id, bill.creation_date),
             }
-            pdf = facturx.generate_from_binary(gs_out.read(), facturx_xml, pdf_metadata=pdf_metadata, lang=bill.lang)
-        else:
-            pdf = gs_out.read()
-    finally:
-        gs_out.close()
-        gs_in.close()
-    return pdf
+            pdf = facturx.generate_from_binary(pdf, facturx_xml, pdf_metadata=pdf_metadata, lang=bill.lang)
+        result.append(pdf)
+    return result
+
+
+def format_bill_pdf(pdf_buffer, bill):
+    """Make it PDF/A-3B compliant and add optional factur-x embedded information
+    @param pdf_buffer: PDF buffer as a BytesIO object
+    @return: PDF bytes"""
+    return format_bills_pdf([pdf_buffer.getvalue()], [bill])[0]
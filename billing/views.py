@@ -8,9 +8,10 @@ Pydici billing views. Http request are processed here.
 from datetime import date, timedelta
 import mimetypes
 import json
+import hashlib
 from io import BytesIO
-import os
 from decimal import Decimal
+from collections import defaultdict
 
 from os.path import basename
 
@@ -18,7 +19,7 @@ from django.shortcuts import render
 from django.urls import reverse, reverse_lazy
 from django.utils.translation import gettext as _
 from django.utils import translation
-from django.http import HttpResponseRedirect, HttpResponse, Http404
+from django.http import HttpResponseRedirect, HttpResponse, Http404, StreamingHttpResponse
 from django.db.models import Sum, Q, F, Min, Max, Count
 from django.db.models.functions import TruncMonth
 from django.views.generic import TemplateView
@@ -32,7 +33,8 @@ from django_weasyprint.views import WeasyTemplateResponse, WeasyTemplateView
 from pypdf import PdfWriter, PdfReader
 
 from billing.utils import get_billing_info, update_bill_from_timesheet, update_client_bill_from_proportion, \
-    bill_pdf_filename, get_client_billing_control_pivotable_data, generate_bill_pdf, format_bill_pdf
+    bill_pdf_filename, client_billing_control_pivotable_rows, queue_bill_pdf, format_bill_pdf, timesheet_annex_digest, \
+    file_digest, cached_annex, outstanding_billing, client_billing_aging, supplier_bills_expected_billing
 from billing.models import ClientBill, SupplierBill, BillDetail, BillExpense, InternalBill, InternalBillDetail
 from leads.models import Lead
 from people.models import Consultant
@@ -41,7 +43,7 @@ from staffing.models import Timesheet, Mission
 from staffing.views import MissionTimesheetReportPdf
 from crm.models import Subsidiary
 from crm.utils import get_subsidiary_from_session
-from core.utils import get_fiscal_years_from_qs, get_parameter, user_has_feature
+from core.utils import get_fiscal_years_from_qs, user_has_feature, pivotable_columnar_json
 from core.utils import COLORS, nextMonth, previousMonth, get_fiscal_year
 from core.decorator import pydici_non_public, PydiciNonPublicdMixin, pydici_feature, PydiciFeatureMixin
 from billing.forms import BillDetailInlineFormset, BillExpenseFormSetHelper, BillExpenseInlineFormset, BillExpenseForm
@@ -122,6 +124,13 @@ def supplier_bills_validation(request):
     if subsidiary:
         supplier_overdue_bills = supplier_overdue_bills.filter(lead__subsidiary=subsidiary)
         supplier_soondue_bills = supplier_soondue_bills.filter(lead__subsidiary=subsidiary)
+
+    # Compute expected billing of all bills at once
+    supplier_overdue_bills = list(supplier_overdue_bills)
+    supplier_soondue_bills = list(supplier_soondue_bills)
+    expected_billing = supplier_bills_expected_billing(supplier_overdue_bills + supplier_soondue_bills)
+    supplier_overdue_bills = [(bill, expected_billing[bill.id]) for bill in supplier_overdue_bills]
+    supplier_soondue_bills = [(bill, expected_billing[bill.id]) for bill in supplier_soondue_bills]
     return render(request, "billing/supplier_bills_validation.html",
                   {"supplier_soondue_bills": supplier_soondue_bills,
                    "supplier_overdue_bills": supplier_overdue_bills,
@@ -233,7 +242,7 @@ class Bill(PydiciNonPublicdMixin, TemplateView):
     def get_context_data(self, **kwargs):
         context = super(Bill, self).get_context_data(**kwargs)
         try:
-            bill = ClientBill.objects.get(id=kwargs.get("bill_id"))
+            bill = ClientBill.objects.with_totals().get(id=kwargs.get("bill_id"))
             context["bill"] = bill
             context["expenses_image_receipt"] = []
             for expenseDetail in bill.billexpense_set.all():
@@ -260,21 +269,14 @@ class BillAnnexPDFTemplateResponse(WeasyTemplateResponse):
             bill_pdf = super(BillAnnexPDFTemplateResponse, self).rendered_content
             merger = PdfWriter()
             merger.append(PdfReader(BytesIO(bill_pdf)))
-            # Add expense receipt
-            for billExpense in bill.billexpense_set.all():
-                if billExpense.expense and billExpense.expense.receipt_content_type() == "application/pdf":
-                    merger.append(PdfReader(billExpense.expense.receipt.file))
-            # Add timesheet
-            if bill.include_timesheet:
-                fake_http_request = self._request
-                fake_http_request.method = "GET"
-                for mission in Mission.objects.filter(billdetail__bill=bill).annotate(Min("billdetail__month"), Max("billdetail__month")).distinct():
-                    response = MissionTimesheetReportPdf.as_view()(fake_http_request, mission=mission,
-                                                                   start=mission.billdetail__month__min,
-                                                                   end=mission.billdetail__month__max)
-                    merger.append(BytesIO(response.rendered_content))
+            annex_pdf = self.annex_pdf(bill)
+            if annex_pdf:
+                merger.append(PdfReader(BytesIO(annex_pdf)))
             merger.write(target)
-            pdf = format_bill_pdf(target, bill)
+            if self.context_data.get("pdfa", True):
+                pdf = format_bill_pdf(target, bill)
+            else:  # Formatted later, in batch
+                pdf = target.getvalue()
             target.close()
         finally:
             translation.activate(old_lang)
@@ -282,8 +284,53 @@ class BillAnnexPDFTemplateResponse(WeasyTemplateResponse):
         return pdf
 
 
+    def annex_pdf(self, bill):
+        """Expense receipts and timesheets annexes merged in one pdf or None if bill has no annex.
+        Rendered annexes are cached according to their content. Only changed annexes are rendered again
+        and merged annexes are reused as is if nothing changed"""
+        annexes = []  # (digest, render function)
+        # Add expense receipt
+        for billExpense in bill.billexpense_set.select_related("expense"):
+            expense = billExpense.expense
+            if expense and expense.receipt_content_type() == "application/pdf":
+                annexes.append((file_digest(expense.receipt), expense.receipt))
+        # Add timesheet
+        if bill.include_timesheet:
+            fake_http_request = self._request
+            fake_http_request.method = "GET"
+            for mission in Mission.objects.filter(billdetail__bill=bill).annotate(Min("billdetail__month"), Max("billdetail__month")).distinct():
+                def render_timesheet_annex(mission=mission):
+                    response = MissionTimesheetReportPdf.as_view()(fake_http_request, mission=mission,
+                                                                   start=mission.billdetail__month__min,
+                                                                   end=mission.billdetail__month__max)
+                    return response.rendered_content
+                digest = timesheet_annex_digest(mission, mission.billdetail__month__min, mission.billdetail__month__max)
+                annexes.append((digest, render_timesheet_annex))
+        if not annexes:
+            return None
+
+        def merge():
+            merger = PdfWriter()
+            for digest, annex in annexes:
+                if callable(annex):
+                    merger.append(PdfReader(BytesIO(cached_annex(digest, annex))))
+                else:  # Expense receipt file
+                    merger.append(PdfReader(annex.file))
+            merged = BytesIO()
+            merger.write(merged)
+            return merged.getvalue()
+
+        return cached_annex(hashlib.sha256("".join(digest for digest, annex in annexes).encode()).hexdigest(), merge)
+
+
 class BillPdf(Bill, WeasyTemplateView):
     response_class = BillAnnexPDFTemplateResponse
+    pdfa = True  # PDF/A and factur-x formatting. Disabled when bills are formatted in batch. See format_bills_pdf()
+
+    def get_context_data(self, **kwargs):
+        context = super(BillPdf, self).get_context_data(**kwargs)
+        context["pdfa"] = self.pdfa
+        return context
 
     def get_filename(self):
         bill = self.get_context_data(**self.kwargs)["bill"]
@@ -316,7 +363,10 @@ class InternalBillAnnexPDFTemplateResponse(WeasyTemplateResponse):
             bill = self.context_data["bill"]
             translation.activate(bill.lang)
             bill_pdf = super(InternalBillAnnexPDFTemplateResponse, self).rendered_content
-            pdf = format_bill_pdf(BytesIO(bill_pdf), bill)
+            if self.context_data.get("pdfa", True):
+                pdf = format_bill_pdf(BytesIO(bill_pdf), bill)
+            else:  # Formatted later, in batch
+                pdf = bill_pdf
         finally:
             translation.activate(old_lang)
         return pdf
@@ -324,6 +374,12 @@ class InternalBillAnnexPDFTemplateResponse(WeasyTemplateResponse):
 
 class InternalBillPdf(InternalBillView, WeasyTemplateView):
     response_class = InternalBillAnnexPDFTemplateResponse
+    pdfa = True  # PDF/A and factur-x formatting. Disabled when bills are formatted in batch. See format_bills_pdf()
+
+    def get_context_data(self, **kwargs):
+        context = super(InternalBillPdf, self).get_context_data(**kwargs)
+        context["pdfa"] = self.pdfa
+        return context
 
     def get_filename(self):
         bill = self.get_context_data(**self.kwargs)["bill"]
@@ -390,14 +446,12 @@ def client_bill(request, bill_id=None):
                         messages.add_message(request, messages.WARNING, _("Using custom user file to replace current bill"))
                     elif bill.billexpense_set.exists() or bill.billdetail_set.exists():
                         # bill file exist but authorized admin change information and do not provide custom file. Let's generate again bill file
-                        messages.add_message(request, messages.WARNING, _("A new bill is generated and replace the previous one"))
-                        if os.path.exists(bill.bill_file.path):
-                            os.remove(bill.bill_file.path)
-                        generate_bill_pdf(bill, request)
+                        messages.add_message(request, messages.WARNING, _("A new bill is being generated and will replace the previous one"))
+                        queue_bill_pdf(bill, request.user)
                 else:
                     # Bill file still not exist. Let's create it
-                    messages.add_message(request, messages.INFO, _("A new bill file has been generated"))
-                    generate_bill_pdf(bill, request)
+                    messages.add_message(request, messages.INFO, _("A new bill file is being generated"))
+                    queue_bill_pdf(bill, request.user)
             return HttpResponseRedirect(success_url)
     else:
         if bill:
@@ -618,14 +672,12 @@ def internal_bill(request, bill_id=None):
                         messages.add_message(request, messages.WARNING, _("Using custom user file to replace current bill"))
                     elif bill.internalbilldetail_set.exists():
                         # bill file exist but authorized admin change information and do not provide custom file. Let's generate again bill file
-                        messages.add_message(request, messages.WARNING, _("A new bill is generated and replace the previous one"))
-                        if os.path.exists(bill.bill_file.path):
-                            os.remove(bill.bill_file.path)
-                        generate_bill_pdf(bill, request)
+                        messages.add_message(request, messages.WARNING, _("A new bill is being generated and will replace the previous one"))
+                        queue_bill_pdf(bill, request.user)
                 else:
                     # Bill file still not exist. Let's create it
-                    messages.add_message(request, messages.INFO, _("A new bill file has been generated"))
-                    generate_bill_pdf(bill, request)
+                    messages.add_message(request, messages.INFO, _("A new bill file is being generated"))
+                    queue_bill_pdf(bill, request.user)
             return HttpResponseRedirect(success_url)
     else:
         if bill:
@@ -873,8 +925,7 @@ def lead_billing(request, lead_id):
 @pydici_non_public
 @pydici_feature("reports")
 def client_billing_control_pivotable(request):
-    """Check lead/mission billing."""
-    subsidiary = get_subsidiary_from_session(request)
+    """Check lead/mission billing. Data is loaded asynchronously. See client_billing_control_pivotable_data"""
     responsible_id = request.GET.get("responsible")
     if responsible_id:
         responsible = Consultant.objects.get(id=responsible_id)
@@ -884,16 +935,32 @@ def client_billing_control_pivotable(request):
     for i in range(6):
         month_to_exclude.append(nextMonth(month_to_exclude[-1]))
     month_to_exclude = [m.isoformat() for m in month_to_exclude]
-    data = get_client_billing_control_pivotable_data(filter_on_subsidiary=subsidiary,
-                                                     filter_on_responsible=responsible,
-                                                     only_active=True)
+    data_url = reverse("billing:client_billing_control_pivotable_data")
+    if responsible:
+        data_url += "?responsible=%s" % responsible.id
     return render(request, "billing/client_billing_control_pivotable.html",
-                  {"data": data,
+                  {"data_url": data_url,
                    "responsible": responsible,
                    "month_to_exclude": month_to_exclude,
                    "derivedAttributes": "{}"})
 
 
+@pydici_non_public
+@pydici_feature("reports")
+def client_billing_control_pivotable_data(request):
+    """Stream lead/mission billing check pivot data as columnar json"""
+    subsidiary = get_subsidiary_from_session(request)
+    responsible_id = request.GET.get("responsible")
+    if responsible_id:
+        responsible = Consultant.objects.get(id=responsible_id)
+    else:
+        responsible = None
+    rows = client_billing_control_pivotable_rows(filter_on_subsidiary=subsidiary,
+                                                 filter_on_responsible=responsible,
+                                                 only_active=True)
+    return StreamingHttpResponse(pivotable_columnar_json(rows), content_type="application/json")
+
+
 @pydici_non_public
 @pydici_feature("reports")
 @cache_page(60 * 60)
@@ -923,7 +990,6 @@ def graph_yearly_billing(request):
     """Fiscal year billing per subsidiary"""
     bills = ClientBill.objects.filter(state__in=("1_SENT", "2_PAID"))
     years = get_fiscal_years_from_qs(bills, "creation_date")
-    month = int(get_parameter("FISCAL_YEAR_MONTH"))
     data = {}
     graph_data = []
     labels = []
@@ -936,12 +1002,14 @@ def graph_yearly_billing(request):
     for subsidiary in subsidiaries:
         data[subsidiary.name] = []
 
+    # Billing per month and subsidiary in one query, then summed per fiscal year
+    turnover = defaultdict(Decimal)
+    bills_per_month = bills.annotate(month=TruncMonth("creation_date")).values_list("month", "lead__subsidiary__name")
+    for bill_month, subsidiary_name, amount in bills_per_month.annotate(Sum("amount")).order_by():
+        turnover[(get_fiscal_year(bill_month), subsidiary_name)] += amount or 0
     for year in years:
-        turnover = {}
-        for subsidiary_name, amount in bills.filter(creation_date__gte=date(year, month, 1), creation_date__lt=date(year + 1, month, 1)).values_list("lead__subsidiary__name").annotate(Sum("amount")):
-            turnover[subsidiary_name] = float(amount)
         for subsidiary in subsidiaries:
-            data[subsidiary.name].append(turnover.get(subsidiary.name, 0))
+            data[subsidiary.name].append(float(turnover[(year, subsidiary.name)]))
 
     last_turnover = 0
     for current_turnover in [sum(i) for i in zip(*list(data.values()))]:  # Total per year
@@ -980,31 +1048,26 @@ def graph_yearly_billing(request):
 @pydici_feature("reports")
 @cache_page(60 * 60 * 4)
 def graph_outstanding_billing(request):
-    """Graph outstanding billing, including overdue clients bills"""
+    """Graph outstanding billing, including overdue clients bills, and outstanding billing aging per client"""
     end = nextMonth(date.today() + timedelta(45))
     current = (end - timedelta(30) * 24).replace(day=1)
-    today = date.today()
     months = []
-    outstanding = []
-    outstanding_overdue = []
-    graph_data = []
-    subsidiary = get_subsidiary_from_session(request)
     while current < end:
-        months.append(current.isoformat())
-        next_month = nextMonth(current)
-        bills = ClientBill.objects.filter(due_date__lte=next_month, state__in=("1_SENT", "2_PAID")).exclude(payment_date__lt=current)
-        if subsidiary:
-            bills = bills.filter(lead__subsidiary=subsidiary)
-        overdue_bills = bills.exclude(payment_date__lte=F("due_date")).exclude(payment_date__gt=next_month).exclude(due_date__gt=today)
-        outstanding.append(float(bills.aggregate(Sum("amount"))["amount__sum"] or 0))
-        outstanding_overdue.append(float(overdue_bills.aggregate(Sum("amount"))["amount__sum"] or 0))
-        current = next_month
-
-    graph_data.append(["x"] + months)
+        months.append(current)
+        current = nextMonth(current)
+    bills = ClientBill.objects.filter(state__in=("1_SENT", "2_PAID"))
+    subsidiary = get_subsidiary_from_session(request)
+    if subsidiary:
+        bills = bills.filter(lead__subsidiary=subsidiary)
+    outstanding, outstanding_overdue = outstanding_billing(bills, months)
+
+    graph_data = []
+    graph_data.append(["x"] + [month.isoformat() for month in months])
     graph_data.append([_("billing outstanding")] + outstanding)
     graph_data.append([_("billing outstanding overdue")] + outstanding_overdue)
 
     return render(request, "billing/graph_outstanding_billing.html",
                   {"graph_data": json.dumps(graph_data),
+                   "aging": client_billing_aging(bills),
                    "series_colors": COLORS,
                    "user": request.user})
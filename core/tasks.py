@@ -15,7 +15,7 @@ from django.utils.cache import get_cache_key
 from django.core.cache import cache
 from celery import shared_task
 
-from staffing.views import turnover_pivotable, graph_profile_rates
+from staffing.views import turnover_pivotable_data, graph_profile_rates
 from leads.views import graph_leads_pipe, leads_pivotable
 from people.views import graph_people_count
 from crm.views import clients_ranking
@@ -37,13 +37,10 @@ def view_warmup():
     subsidiaries_id = list(Subsidiary.objects.filter(mission__nature="PROD").distinct().values_list("id", flat=True))
     subsidiaries_id.append(0) # Add the "all" subsidiaries
     current_fiscal_year = get_fiscal_year(date.today())
-    ## Request env is important as it is used to build header cache key
-    hosts = [h for h in settings.ALLOWED_HOSTS if h != "localhost"]
-    env = {"SERVER_NAME": hosts[0] if hosts else "localhost", "SERVER_PORT": "443", "wsgi.url_scheme": "https"}
     for url_name, view, kwargs, subsidiary_context in (
-            ("staffing:turnover_pivotable", turnover_pivotable, {}, True),
-            ("staffing:turnover_pivotable_year", turnover_pivotable, { "year": current_fiscal_year }, True),
-            ("staffing:turnover_pivotable_year", turnover_pivotable, {"year": current_fiscal_year - 1 }, True),
+            ("staffing:turnover_pivotable_data", turnover_pivotable_data, {}, True),
+            ("staffing:turnover_pivotable_data_year", turnover_pivotable_data, { "year": current_fiscal_year }, True),
+            ("staffing:turnover_pivotable_data_year", turnover_pivotable_data, {"year": current_fiscal_year - 1 }, True),
             ("staffing:graph_profile_rates", graph_profile_rates, {}, True),
             ("leads:graph_leads_pipe", graph_leads_pipe, {}, True),
             ("people:graph_people_count", graph_people_count, {}, True),
@@ -57,7 +54,7 @@ def view_warmup():
             url = reverse(url_name, kwargs=kwargs)
             if c:
                 url += "?subsidiary_id=%s" % c
-            request = create_fake_request(user=user, url=url, env=env)
+            request = create_fake_request(user=user, url=url, public_host=True)  # Host is used to build header cache key
             if c: # inject subsidiary id in session to have proper subsidiary name in selector
                 request.session["subsidiary_id"] = c
             key = get_cache_key(request)
@@ -20,11 +20,13 @@ from selenium.webdriver.chrome.options import ChromiumOptions
 
 
 # Pydici modules
-from core.utils import monthWeekNumber, previousWeek, nextWeek, cumulateList, capitalize, get_parameter
+from core.utils import monthWeekNumber, previousWeek, nextWeek, cumulateList, capitalize, get_parameter, cacheable, cache_invalidate, \
+    pivotable_columnar_json, create_fake_request, explicit_refresh, disable_for_explicit_refresh
 from core.models import GroupFeature, FEATURES, Parameter
 
 # Python modules used by tests
 from datetime import date
+import json
 import os
 import os.path
 import re
@@ -332,6 +334,56 @@ class UtilsTest(TestCase):
         p.save()
         self.assertEqual(get_parameter(p.key), p.value)
 
+    def test_cacheable_dependencies(self):
+        class Counter(object):
+            def __init__(self, id):
+                self.id = id
+                self.count = 0
+
+            @cacheable("Counter.value%(id)s", depends=("counter:%(id)s", "counter:all"))
+            def value(self):
+                self.count += 1
+                return self.count
+
+        c1, c2 = Counter(1), Counter(2)
+        self.assertEqual(c1.value(), 1)
+        self.assertEqual(c1.value(), 1)  # Cached
+        self.assertEqual(c2.value(), 1)
+        cache_invalidate("counter:1")
+        self.assertEqual(c1.value(), 2)
+        self.assertEqual(c2.value(), 1)  # Still cached
+        cache_invalidate("counter:all")
+        self.assertEqual(c1.value(), 3)
+        self.assertEqual(c2.value(), 2)
+        cache_invalidate("counter:unknown")  # Invalidate something never cached is harmless
+
+    def test_pivotable_columnar_json(self):
+        rows = [{"month": "2024-01-01", "amount": 1.5, "type": "bill"},
+                {"month": "2024-02-01", "amount": 2, "type": None},
+                {"month": "2024-01-01", "type": "bill", "consultant": "john"}]
+        data = json.loads("".join(pivotable_columnar_json(rows, chunk_size=2)))
+        self.assertEqual(data["columns"], ["month", "amount", "type", "consultant"])
+        self.assertEqual(data["rows"], [[0, 1.5, 0], [1, 2], [0, None, 0, 0]])
+        self.assertEqual(data["dictionaries"], {"0": ["2024-01-01", "2024-02-01"], "2": ["bill"], "3": ["john"]})
+        self.assertEqual(json.loads("".join(pivotable_columnar_json([]))), {"rows": [], "columns": [], "dictionaries": {}})
+
+    def test_explicit_refresh(self):
+        calls = []
+        handler = disable_for_explicit_refresh(lambda sender, **kwargs: calls.append(sender))
+        handler("a")
+        with explicit_refresh():
+            handler("b")
+        handler("c")
+        self.assertEqual(calls, ["a", "c"])
+
+    @override_settings(ALLOWED_HOSTS=["localhost", "pydici.example.com"])
+    def test_create_fake_request(self):
+        user = User(username="fake")
+        self.assertEqual(create_fake_request(user=user).META["SERVER_NAME"], "testserver")
+        request = create_fake_request(user=user, url="/foo", public_host=True)
+        self.assertEqual(request.build_absolute_uri(), "https://pydici.example.com/foo")
+        self.assertEqual(request.user, user)
+
 
 class SeleniumTestCase(StaticLiveServerTestCase):
     """Parent class of Selenium based tests"""
@@ -12,6 +12,8 @@ import os
 from datetime import timedelta, date, datetime
 import unicodedata
 from functools import wraps
+from contextlib import contextmanager
+from contextvars import ContextVar
 import json
 from decimal import Decimal
 
@@ -293,12 +295,72 @@ def disable_for_loaddata(signal_handler):
     return wrapper
 
 
-def cacheable(cache_key, timeout=3600):
+_explicit_refresh = ContextVar("pydici_explicit_refresh", default=False)
+
+
+@contextmanager
+def explicit_refresh():
+    """Context where signal handlers decorated with disable_for_explicit_refresh are turned off.
+    Used for operations done on many objects at once, caller refreshes derived data explicitly once done"""
+    token = _explicit_refresh.set(True)
+    try:
+        yield
+    finally:
+        _explicit_refresh.reset(token)
+
+
+def disable_for_explicit_refresh(signal_handler):
+    """Decorator that turns off signal handlers within explicit_refresh() context"""
+    @wraps(signal_handler)
+    def wrapper(*args, **kwargs):
+        if _explicit_refresh.get():
+            return
+        signal_handler(*args, **kwargs)
+    return wrapper
+
+
+CACHE_GENERATION_KEY = "PYDICI_CACHE_GEN_%s"
+
+
+def cache_generations(dependencies):
+    """Return current generation counter of given cache dependencies. Missing counters are initialised.
+    @param dependencies: list of dependencies names, ex. consultant:12:timesheet
+    @return: list of generations, in the same order as dependencies"""
+    keys = [CACHE_GENERATION_KEY % dependency for dependency in dependencies]
+    generations = cache.get_many(keys)
+    for key in keys:
+        if key not in generations:
+            # Start from current time and not from 1 to avoid reusing generations of an evicted counter
+            cache.add(key, int(datetime.now().timestamp() * 1000), None)
+            generations[key] = cache.get(key)
+    return [generations[key] for key in keys]
+
+
+def cache_invalidate(*dependencies):
+    """Invalidate all values cached with given dependencies by incrementing their generation counter.
+    See cacheable()
+    @param dependencies: dependencies names, ex. consultant:12:timesheet"""
+    for dependency in dependencies:
+        try:
+            cache.incr(CACHE_GENERATION_KEY % dependency)
+        except ValueError:
+            # Counter does not exist yet, nothing has been cached with this dependency
+            pass
+
+
+def cacheable(cache_key, timeout=3600, depends=()):
     """Decorator to simplify model level method caching.
-    Adapted from http://djangosnippets.org/snippets/1130/"""
+    Adapted from http://djangosnippets.org/snippets/1130/
+    @param cache_key: cache key, formatted with object attributes, ex. "Mission.done_work%(id)s"
+    @param timeout: cache timeout in seconds
+    @param depends: dependencies names, formatted with object attributes, ex. "mission:%(id)s:timesheet".
+    Cached value is invalidated as soon as one of its dependency is invalidated with cache_invalidate()"""
     def paramed_decorator(func):
         def decorated(self):
             key = cache_key % self.__dict__
+            if depends:
+                generations = cache_generations([dependency % self.__dict__ for dependency in depends])
+                key += "_" + "_".join(str(generation) for generation in generations)
             res = cache.get(key)
             if res is None:
                 res = func(self)
@@ -447,6 +509,51 @@ def moving_average(items, n, round_digits=None):
     return result
 
 
+def pivotable_columnar_json(rows, chunk_size=500):
+    """Encode pivot table data as columnar json generated by chunks, suitable for a streaming response.
+    Columns names are given once, rows are arrays and string columns are dictionary encoded:
+    {"rows": [[0, 12.5], [1, 3.2, 0]], "columns": ["month", "amount", "type"], "dictionaries": {"0": ["2024-01-01", "2024-02-01"], "2": ["bill"]}}
+    Columns and dictionaries are discovered while rows are generated, hence given after rows.
+    None values and missing columns are encoded as null. See pivotable_decode() javascript function.
+    @param rows: iterable of dict with column name as key
+    @param chunk_size: number of rows per chunk
+    @return: generator of json strings"""
+    columns = {}  # Column index with column name as key
+    dictionaries = {}  # Values index with (type, value) as key for each dictionary encoded column index
+    typed = set()  # Columns index for which encoding is decided, according to first not None value
+    chunk = []
+    separator = ""
+    yield '{"rows": ['
+    for row in rows:
+        values = [None] * len(columns)
+        for name, value in row.items():
+            if name not in columns:
+                columns[name] = len(columns)
+                values.append(None)
+            index = columns[name]
+            if value is None:
+                continue
+            if index not in typed:
+                typed.add(index)
+                if isinstance(value, str):
+                    dictionaries[index] = {}  # Column is dictionary encoded if its first value is a string
+            if index in dictionaries:
+                value = dictionaries[index].setdefault((type(value), value), len(dictionaries[index]))
+            values[index] = value
+        while values and values[-1] is None:
+            values.pop()
+        chunk.append(json.dumps(values, separators=(",", ":")))
+        if len(chunk) >= chunk_size:
+            yield separator + ",".join(chunk)
+            separator = ","
+            chunk = []
+    if chunk:
+        yield separator + ",".join(chunk)
+    yield '], "columns": %s, "dictionaries": %s}' % (json.dumps(list(columns)),
+                                                      json.dumps({index: [value for value_type, value in values]
+                                                                  for index, values in dictionaries.items()}))
+
+
 def audit_log_is_real_change(value):
     """Ensure given change contains a real change we should display to user"""
     if len(value) != 2:  # Don't inspect m2m changes
@@ -459,12 +566,17 @@ def audit_log_is_real_change(value):
     except (ValueError, TypeError) as e:
         return True
 
-def create_fake_request(user=None, url="/", env=None):
-    """Create fake request to """
+def create_fake_request(user=None, url="/", env=None, public_host=False):
+    """Create fake request to
+    @param public_host: request the first public allowed host with https, like real users do. Used to build
+    absolute urls and cache keys"""
     if user is None:
         user = User.objects.get(id=1)
     if env is None:
         env = {}
+    if public_host:
+        hosts = [h for h in settings.ALLOWED_HOSTS if h != "localhost"]
+        env = dict({"SERVER_NAME": hosts[0] if hosts else "localhost", "SERVER_PORT": "443", "wsgi.url_scheme": "https"}, **env)
     f = RequestFactory()
     request = f.get(url, **env)
     request.user = user
@@ -27,7 +27,7 @@ from django_select2.views import AutoResponseView
 
 from core.decorator import pydici_non_public, pydici_feature, PydiciNonPublicdMixin, PydiciSubcontractordMixin
 from leads.models import Lead, Activity
-from people.models import Consultant
+from people.models import Consultant, RateObjectiveIndex
 from crm.models import Company, Contact
 from crm.utils import get_subsidiary_from_session
 from staffing.models import Mission, FinancialCondition, Staffing, Timesheet
@@ -259,6 +259,7 @@ def financial_control(request, start_date=None, end_date=None):
     missionsIds = set(list(missionsIdsFromStaffing) + list(missionsIdsFromTimesheet) + list(missionsIdsFromBoundaries))
     missions = Mission.objects.filter(id__in=missionsIds)
     missions = missions.distinct().select_related().prefetch_related("lead__client__organisation__company", "lead__responsible")
+    missions = missions.with_mission_id()
 
     def createMissionRow(mission, start_date, end_date):
         """Inner function to create mission row"""
@@ -296,13 +297,14 @@ def financial_control(request, start_date=None, end_date=None):
         missionRow.append(last_timesheet.isoformat() if last_timesheet else "")
         return missionRow
 
+    rate_objectives = RateObjectiveIndex()
     for mission in missions:
         missionRow = createMissionRow(mission, start_date, end_date)
         missionConsultants = mission.consultants().select_related().prefetch_related("staffing_manager")
         for consultant in missionConsultants:
             consultantRow = missionRow[:]  # copy
             daily_rate, bought_daily_rate = financialConditions.get("%s-%s" % (mission.id, consultant.id), [0, 0])
-            rateObjective = consultant.get_rate_objective(working_date=end_date, rate_type="DAILY_RATE")
+            rateObjective = rate_objectives.get(consultant, end_date, rate_type="DAILY_RATE")
             if rateObjective:
                 rateObjective = rateObjective.rate
             else:
@@ -7,7 +7,7 @@ Database access layer for pydici people module
 
 from django.db import models
 from django.utils.translation import gettext_lazy as _
-from django.db.models import F, Sum, Max, Count
+from django.db.models import F, Sum, Count
 from django.apps import apps
 from django.contrib.auth.models import User
 from django.urls import reverse
@@ -15,7 +15,8 @@ from django.core.cache import cache
 
 from taggit.managers import TaggableManager
 
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
+from bisect import bisect_right
 
 from core.utils import capitalize, cacheable, previousMonth, nextMonth, working_days
 from core.models import TaggedItem
@@ -25,6 +26,7 @@ from people.tasks import compute_consultant_tasks
 
 CONSULTANT_IS_IN_HOLIDAYS_CACHE_KEY = "Consultant.is_in_holidays%(id)s"
 TIMESHEET_IS_UP_TO_DATE_CACHE_KEY = "Consultant.timesheet_is_up_to_date%(id)s"
+CONSULTANT_TIMESHEET_DEPENDENCY = "consultant:%(id)s:timesheet"  # Invalidated on consultant timesheet change
 CONSULTANT_TASKS_CACHE_KEY = "CONSULTANT_TASKS_%s"
 RATE_OBJECTIVE_CACHE_KEY = "RATE_OBJ_%s_%s_%s"
 
@@ -167,23 +169,36 @@ class Consultant(models.Model):
         """Get consultant turnover in euros of done missions according to timesheet and rates between startDate (included) and enDate (excluded). Only PROD missions are considered.
         Fixed price mission margin (profit or loss) are considered.
         @param start_date: if None, from the creation of earth
-        @param end_date : if None, up to today
+        @param end_date : if None, up to today. Monthly turnover fact table is used when both dates are first day of month
         @:param clients: compute only turnover those clients. If None, all Clients are considered
         @return: turnover in euros"""
         from staffing.models import Mission  # Late import to avoid circular reference
+        # Whole months period can be read from monthly turnover fact table
+        whole_months = (start_date is None or start_date.day == 1) and end_date is not None and end_date.day == 1
         if start_date is None:
             start_date = date(1977, 2, 18)
         if end_date is None:
             end_date = date.today()
         turnover = 0
-        missions = Mission.objects.filter(timesheet__working_date__gte=start_date, timesheet__working_date__lt=end_date,
-                                          timesheet__consultant=self, financialcondition__consultant=self, nature="PROD")
+        if whole_months:
+            missions = Mission.objects.filter(monthlyturnover__month__gte=start_date, monthlyturnover__month__lt=end_date,
+                                              monthlyturnover__consultant=self, nature="PROD")
+        else:
+            missions = Mission.objects.filter(timesheet__working_date__gte=start_date, timesheet__working_date__lt=end_date,
+                                              timesheet__consultant=self, nature="PROD")
+            # Last financial condition wins, like in monthly turnover fact table
+            rates = dict(self.financialcondition_set.order_by("id").values_list("mission_id", "daily_rate"))
         if clients:
             missions = missions.filter(lead__client__in=clients)
-        missions = missions.order_by().annotate(charge__sum=Sum("timesheet__charge"))
-        missions = missions.annotate(rate=Max("financialcondition__daily_rate"))
+        if whole_months:
+            missions = missions.order_by().annotate(turnover=Sum("monthlyturnover__amount"))
+        else:
+            missions = missions.order_by().annotate(charge__sum=Sum("timesheet__charge"))
         for mission in missions:
-            mission_turnover = mission.charge__sum * (mission.rate or 0)
+            if whole_months:
+                mission_turnover = mission.turnover
+            else:
+                mission_turnover = mission.charge__sum * rates.get(mission.id, 0)
             if mission.billing_mode == "FIXED_PRICE":
                 done_work = mission.done_work_k()[1]
                 price = float(mission.price or 0)
@@ -261,7 +276,7 @@ class Consultant(models.Model):
         available = working_days(month, holidays=holidayDays(month), upToToday=False) - total
         return staffings, total, available
 
-    @cacheable(CONSULTANT_IS_IN_HOLIDAYS_CACHE_KEY, 6*3600)
+    @cacheable(CONSULTANT_IS_IN_HOLIDAYS_CACHE_KEY, 6*3600, depends=(CONSULTANT_TIMESHEET_DEPENDENCY,))
     def is_in_holidays(self):
         """True if consultant is in holiday today. Else False"""
         Timesheet = apps.get_model("staffing", "Timesheet")  # Get Timesheet with get_model to avoid circular imports
@@ -295,7 +310,7 @@ class Consultant(models.Model):
         ordering = ["name", ]
         verbose_name = _("Consultant")
 
-    @cacheable(TIMESHEET_IS_UP_TO_DATE_CACHE_KEY, 6 * 3600)
+    @cacheable(TIMESHEET_IS_UP_TO_DATE_CACHE_KEY, 6 * 3600, depends=(CONSULTANT_TIMESHEET_DEPENDENCY,))
     def timesheet_is_up_to_date(self):
         """return tuple (previous month late days, current month late days). (0, 0) means everything is up to date. Current day is not included"""
         Timesheet = apps.get_model("staffing", "Timesheet")  # Get Timesheet with get_model to avoid circular imports
@@ -344,6 +359,49 @@ class RateObjective(models.Model):
     rate_type = models.CharField(_("Rate type"), max_length=30, choices=RATE_TYPE)
 
 
+class RateObjectiveIndex(object):
+    """In memory index of consultants rate objectives. Objectives are loaded with a single query, sorted by starting
+    date per consultant and rate type, and resolved with binary search. Index is meant to live for a request or
+    a computation: use it instead of Consultant.get_rate_objective() when looking up many consultants or dates"""
+    def __init__(self, consultants=None):
+        """@param consultants: consultants (or consultants id) to index. None (default) is all consultants"""
+        self.start_dates = {}  # Sorted starting dates per (consultant id, rate type)
+        self.objectives = {}  # Rate objectives in the same order
+        objectives = RateObjective.objects.all()
+        if consultants is not None:
+            objectives = objectives.filter(consultant__in=consultants)
+        for objective in objectives.order_by("start_date", "id"):
+            key = (objective.consultant_id, objective.rate_type)
+            self.start_dates.setdefault(key, []).append(objective.start_date)
+            self.objectives.setdefault(key, []).append(objective)
+
+    def get(self, consultant, working_date=None, rate_type="DAILY_RATE"):
+        """Get the consultant rate objective for given date, like Consultant.get_rate_objective()
+        @param consultant: consultant or consultant id
+        @param working_date: date to consider. Default is today
+        @param rate_type: DAILY_RATE (default) or PROD_RATE
+        @return: RateObjective or None if no objective is defined at that date"""
+        if rate_type not in dict(RateObjective.RATE_TYPE):
+            raise ValueError("rate_type must be one of %s" % ", ".join(dict(RateObjective.RATE_TYPE).keys()))
+        if not working_date:
+            working_date = date.today()
+        elif isinstance(working_date, datetime):
+            working_date = working_date.date()
+        key = (getattr(consultant, "id", consultant), rate_type)
+        i = bisect_right(self.start_dates.get(key, []), working_date)
+        if i:
+            return self.objectives[key][i - 1]
+
+    def resolve(self, consultants, dates, rate_type="DAILY_RATE"):
+        """Get rate objectives of many consultants for many dates
+        @param consultants: consultants or consultants id
+        @param dates: dates to consider
+        @param rate_type: DAILY_RATE (default) or PROD_RATE
+        @return: dict with (consultant id, date) as key and RateObjective (or None) as value"""
+        return {(getattr(consultant, "id", consultant), working_date): self.get(consultant, working_date, rate_type)
+                for consultant in consultants for working_date in dates}
+
+
 class SalesMan(models.Model):
     """A salesman"""
     name = models.CharField(_("Name"), max_length=50)
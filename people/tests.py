@@ -12,7 +12,7 @@ from django.contrib.auth.models import User
 from django.core.cache import cache
 
 from crm.models import Subsidiary
-from people.models import Consultant, ConsultantProfile
+from people.models import Consultant, ConsultantProfile, RateObjective, RateObjectiveIndex
 from staffing.models import Mission, Timesheet, FinancialCondition
 from leads.models import Lead
 from core.utils import nextMonth, previousMonth
@@ -106,3 +106,37 @@ class PeopleModelTest(TestCase):
         self.assertEqual(c1.get_turnover(end_date=next_month, clients=[lead2.client]), 0)
         self.assertEqual(c1.get_turnover(end_date=next_month, clients=[lead2.client]) + c2.get_turnover(end_date=next_month, clients=[lead2.client]), 0)
 
+    def test_turnover_rates(self):
+        month = date(2015, 3, 1)
+        c1 = Consultant.objects.get(id=1)
+        mission = Mission(lead=Lead.objects.get(id=1), subsidiary_id=1, billing_mode="TIME_SPENT", nature="PROD", probability=100)
+        mission.save()
+        Timesheet(mission=mission, working_date=month, consultant=c1, charge=10).save()
+        # Several financial conditions: last one is used, whatever the period
+        FinancialCondition(consultant=c1, mission=mission, daily_rate=1000).save()
+        FinancialCondition(consultant=c1, mission=mission, daily_rate=1500).save()
+        cache.clear()
+        self.assertEqual(c1.get_turnover(month, nextMonth(month), clients=[mission.lead.client]), 10 * 1500)  # Whole month
+        self.assertEqual(c1.get_turnover(month, month.replace(day=15), clients=[mission.lead.client]), 10 * 1500)  # Partial month
+
+    def test_rate_objective_index(self):
+        c1 = Consultant.objects.get(id=1)
+        c2 = Consultant.objects.get(id=2)
+        RateObjective(consultant=c1, start_date=date(2019, 1, 1), rate=800, rate_type="DAILY_RATE").save()
+        RateObjective(consultant=c1, start_date=date(2020, 1, 1), rate=900, rate_type="DAILY_RATE").save()
+        RateObjective(consultant=c1, start_date=date(2019, 6, 1), rate=70, rate_type="PROD_RATE").save()
+        RateObjective(consultant=c2, start_date=date(2020, 6, 1), rate=None, rate_type="DAILY_RATE").save()
+        cache.clear()
+        dates = [date(2018, 12, 31), date(2019, 1, 1), date(2019, 7, 1), date(2020, 1, 1), date(2020, 7, 1), date.today()]
+        with self.assertNumQueries(1):
+            index = RateObjectiveIndex([c1, c2])
+            daily_rates = index.resolve([c1, c2], dates, rate_type="DAILY_RATE")
+            prod_rates = index.resolve([c1.id, c2.id], dates, rate_type="PROD_RATE")
+        for consultant in (c1, c2):
+            for working_date in dates:
+                self.assertEqual(daily_rates[(consultant.id, working_date)], consultant.get_rate_objective(working_date, rate_type="DAILY_RATE"))
+                self.assertEqual(prod_rates[(consultant.id, working_date)], consultant.get_rate_objective(working_date, rate_type="PROD_RATE"))
+        self.assertIsNone(daily_rates[(c1.id, date(2018, 12, 31))])
+        self.assertEqual(daily_rates[(c1.id, date(2019, 7, 1))].rate, 800)
+        self.assertEqual(index.get(c1, date(2020, 1, 1)).rate, 900)
+        self.assertRaises(ValueError, index.get, c1, date.today(), "BAD_RATE")
@@ -33,6 +33,17 @@ DOCUMENT_PROJECT_INPUT_DIR = "input"
 TIMESHEET_INPUT_METHOD = "cycle"
 TIMESHEET_DAY_DURATION = 8
 
+# Staffing optimiser
+OPTIMISER_MAX_TIME = 10  # Solver time limit (in seconds)
+OPTIMISER_WORKERS = 0  # Number of solver search workers. 0 means solver default (one per core)
+OPTIMISER_JOB_TIMEOUT = 3600  # Time (in seconds) optimiser job progress and solution are kept for review
+
+# Bill pdf generation
+BILL_PDF_JOB_TIMEOUT = 3600  # Time (in seconds) bill pdf generation status is kept
+BILL_PDF_GHOSTSCRIPT_PROCESSES = 2  # Maximum number of concurrent Ghostscript processes (PDF/A conversion)
+BILL_ANNEX_CACHE_PATH = os.path.join(PYDICI_ROOTDIR, "data", "bill", "annex_cache")  # Rendered bill annexes cache
+BILL_ANNEX_CACHE_DAYS = 90  # Cached bill annexes not used since this number of days are purged
+
 # Telegram integration
 TELEGRAM_IS_ENABLED = False  # Wether to enable or not Telegram notifications
 TELEGRAM_TOKEN = "123123:ABCABC"  # Your Bot Token.
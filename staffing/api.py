@@ -29,7 +29,7 @@ def mission_list(request, start_date=None, end_date=None):
     if (end_date - start_date).days > (2*366):
         return JsonResponse({"error": "timeframe cannot exceed 24 month" }, status=400)
 
-    missions = Mission.objects.filter(update_date__gte=start_date, update_date__lte=end_date)
+    missions = Mission.objects.filter(update_date__gte=start_date, update_date__lte=end_date).select_related("lead").with_mission_id()
     data = []
     for mission in missions:
         mission_data = {"mission_id": mission.mission_id(),
@@ -0,0 +1,81 @@
+# coding: utf-8
+
+"""
+Benchmark staffing optimiser model on synthetic teams and missions
+
+@author: Sébastien Renard (sebastien.renard@digitalfox.org)
+@license: AGPL v3 or newer (http://www.gnu.org/licenses/agpl-3.0.html)
+"""
+import random
+import time
+
+from django.core.management import BaseCommand
+
+from staffing.optim import build_pdc_model, solve_pdc
+
+TEAM_SIZES = (10, 50, 150)
+MISSION_COUNTS = (5, 20)
+N_MONTHS = 8
+
+
+def synthetic_problem(n_consultants, n_missions, n_months=N_MONTHS, seed=0):
+    """Generate a random but realistic optimiser problem
+    @return: dict of solve_pdc parameters"""
+    rnd = random.Random(seed)
+    consultants = ["C%03d" % i for i in range(n_consultants)]
+    missions = ["M%02d" % i for i in range(n_missions)]
+    months = ["m%s" % i for i in range(n_months)]
+    director_consultants = consultants[:max(1, n_consultants // 10)]
+    senior_consultants = consultants[len(director_consultants):len(director_consultants) + max(1, n_consultants // 4)]
+    consultants_freetime = {c: {month: rnd.randint(5, 20) for month in months} for c in consultants}
+    consultants_rates = {c: {m: rnd.randint(6, 18) * 100 for m in missions} for c in consultants}
+    # Missions use around 80% of team free time
+    capacity = sum(sum(freetime.values()) for freetime in consultants_freetime.values()) * 0.8 / n_missions / n_months
+    missions_charge = {}
+    missions_boundaries = {}
+    for mission in missions:
+        start = rnd.randint(0, n_months // 2)
+        end = rnd.randint(start + 1, n_months)
+        missions_charge[mission] = {month: int(rnd.uniform(0.5, 1.5) * capacity) if start <= i < end else 0
+                                    for i, month in enumerate(months)}
+        missions_boundaries[mission] = {"start": months[start] if start else None,
+                                        "end": months[end] if end < n_months else None}
+    missions_remaining = {m: int(sum(missions_charge[m].values()) * 2000) for m in missions}
+    predefined_assignment = {m: [rnd.choice(consultants)] for m in missions[::5]}
+    # Don't exclude directors as they may be needed to respect quotas, nor predefined consultants
+    exclusions = {}
+    for mission in missions[1::3]:
+        candidates = [c for c in consultants[len(director_consultants):] if c not in predefined_assignment.get(mission, [])]
+        exclusions[mission] = rnd.sample(candidates, n_consultants // 10)
+    return {"consultants": consultants, "senior_consultants": senior_consultants, "director_consultants": director_consultants,
+            "missions": missions, "months": months, "missions_charge": missions_charge, "missions_remaining": missions_remaining,
+            "missions_boundaries": missions_boundaries, "consultants_freetime": consultants_freetime,
+            "predefined_assignment": predefined_assignment, "exclusions": exclusions, "consultants_rates": consultants_rates}
+
+
+class Command(BaseCommand):
+    help = "Benchmark staffing optimiser on synthetic teams. Report model build time, solve time and model size"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--consultants", type=int, nargs="+", default=TEAM_SIZES, help="team sizes to benchmark")
+        parser.add_argument("--missions", type=int, nargs="+", default=MISSION_COUNTS, help="mission counts to benchmark")
+        parser.add_argument("--months", type=int, default=N_MONTHS, help="number of months to plan")
+        parser.add_argument("--max-time", type=float, default=10, help="solver time limit (in seconds)")
+        parser.add_argument("--workers", type=int, default=0, help="solver workers (0 means solver default)")
+        parser.add_argument("--seed", type=int, default=0, help="random seed of synthetic problems")
+
+    def handle(self, *args, **options):
+        solver_param = {"max_time": options["max_time"], "num_workers": options["workers"]}
+        self.stdout.write("consultants\tmissions\tvariables\tconstraints\tbuild (s)\tsolve (s)\tstatus\tscore")
+        for n_consultants in options["consultants"]:
+            for n_missions in options["missions"]:
+                problem = synthetic_problem(n_consultants, n_missions, options["months"], options["seed"])
+                start = time.time()
+                model, scores, staffing = build_pdc_model(**problem, solver_param=solver_param)
+                build_time = time.time() - start
+                proto = model.Proto()
+                solver, status, scores, staffing = solve_pdc(**problem, solver_param=solver_param)
+                score = sum(solver.Value(score) for score in scores) if status else "-"
+                self.stdout.write("%s\t%s\t%s\t%s\t%.2f\t%.2f\t%s\t%s" % (n_consultants, n_missions, len(proto.variables),
+                                                                         len(proto.constraints), build_time,
+                                                                         solver.WallTime(), solver.StatusName(), score))
@@ -0,0 +1,22 @@
+# coding: utf-8
+
+"""
+Rebuild monthly turnover fact table from timesheets and financial conditions
+
+@author: Sébastien Renard (sebastien.renard@digitalfox.org)
+@license: AGPL v3 or newer (http://www.gnu.org/licenses/agpl-3.0.html)
+"""
+
+from django.core.management import BaseCommand
+
+from staffing.models import refresh_monthly_turnover
+
+
+class Command(BaseCommand):
+    help = "Rebuild monthly turnover fact table. Needed after loading data without monthly turnover as signals are disabled by loaddata"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--missions", type=int, nargs="+", help="restrict to those missions id")
+
+    def handle(self, *args, **options):
+        refresh_monthly_turnover(options["missions"])
@@ -0,0 +1,53 @@
+# Generated by Django 4.2.30 on 2026-10-18 04:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Sum
+from django.db.models.functions import TruncMonth
+
+
+def compute_monthly_turnover(apps, schema_editor):
+    Timesheet = apps.get_model("staffing", "Timesheet")
+    FinancialCondition = apps.get_model("staffing", "FinancialCondition")
+    MonthlyTurnover = apps.get_model("staffing", "MonthlyTurnover")
+    daily_rates = {(mission_id, consultant_id): daily_rate for mission_id, consultant_id, daily_rate in
+                   FinancialCondition.objects.order_by("id").values_list("mission_id", "consultant_id", "daily_rate")}
+    timesheets = Timesheet.objects.annotate(month=TruncMonth("working_date"))
+    timesheets = timesheets.values_list("mission_id", "consultant_id", "month", "consultant__company_id", "consultant__subcontractor")
+    timesheets = timesheets.annotate(Sum("charge")).order_by()
+    MonthlyTurnover.objects.bulk_create([MonthlyTurnover(mission_id=mission_id, consultant_id=consultant_id, month=month, days=days,
+                                                         amount=days * daily_rates.get((mission_id, consultant_id), 0),
+                                                         subsidiary_id=subsidiary_id, subcontractor=subcontractor)
+                                         for mission_id, consultant_id, month, subsidiary_id, subcontractor, days in timesheets],
+                                        batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('people', '0011_consultant_tags'),
+        ('crm', '0026_remove_administrativecontact_default_fax_and_more'),
+        ('staffing', '0029_alter_holidaybalancetype_upstream_balance_type'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthlyTurnover',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(verbose_name='Month')),
+                ('days', models.FloatField(default=0, verbose_name='Days')),
+                ('amount', models.FloatField(default=0, verbose_name='Turnover')),
+                ('subcontractor', models.BooleanField(default=False, verbose_name='Subcontractor')),
+                ('consultant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='people.consultant')),
+                ('mission', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='staffing.mission')),
+                ('subsidiary', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='crm.subsidiary', verbose_name='Subsidiary')),
+            ],
+            options={
+                'verbose_name': 'Monthly turnover',
+                'indexes': [models.Index(fields=['month', 'mission'], name='staffing_mo_month_484cf8_idx'), models.Index(fields=['consultant', 'month'], name='staffing_mo_consult_0ec879_idx')],
+                'unique_together': {('mission', 'consultant', 'month')},
+            },
+        ),
+        migrations.RunPython(compute_monthly_turnover, migrations.RunPython.noop),
+    ]
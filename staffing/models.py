@@ -4,9 +4,11 @@ Database access layer for pydici staffing module
 @author: Sébastien Renard (sebastien.renard@digitalfox.org)
 @license: AGPL v3 or newer (http://www.gnu.org/licenses/agpl-3.0.html)
 """
-from django.db import models
-from django.db.models import Sum, Min, Max, F, Q
-from django.db.models.functions import TruncMonth
+from django.db import models, transaction
+from django.db.models import Sum, Min, Max, Count, F, Q, OuterRef, Subquery
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.db.models.functions import TruncMonth, Coalesce
 from django.utils.translation import gettext_lazy as _
 from django.utils.translation import gettext, pgettext
 from django.urls import reverse
@@ -16,9 +18,10 @@ from auditlog.models import AuditlogHistoryField
 from datetime import datetime, date, timedelta
 
 from leads.models import Lead
-from people.models import Consultant
+from people.models import Consultant, RateObjectiveIndex, CONSULTANT_TIMESHEET_DEPENDENCY
 from crm.models import MissionContact, Subsidiary
-from core.utils import cacheable, nextMonth, get_parameter, get_fiscal_year
+from core.utils import cacheable, cache_invalidate, nextMonth, get_parameter, get_fiscal_year, disable_for_loaddata, \
+    disable_for_explicit_refresh
 from people.tasks import compute_consultant_tasks
 
 
@@ -49,6 +52,29 @@ class MarketingProduct(models.Model):
         unique_together = [["code", "subsidiary"]]
 
 
+MISSION_CACHE_TIMEOUT = 24 * 3600  # Mission cache is invalidated on changes. See flush_mission_cache()
+MISSION_TIMESHEET_DEPENDENCY = "mission:%(id)s:timesheet"
+MISSION_STAFFING_DEPENDENCY = "mission:%(id)s:staffing"
+MISSION_RATES_DEPENDENCY = "mission:%(id)s:rates"
+MISSION_CACHE_DEPENDENCIES = (MISSION_TIMESHEET_DEPENDENCY, MISSION_STAFFING_DEPENDENCY, MISSION_RATES_DEPENDENCY)
+
+
+def flush_mission_cache(missions_id, dependencies=MISSION_CACHE_DEPENDENCIES):
+    """Invalidate missions cached data that depend on timesheet, staffing or financial conditions.
+    Signals take care of it when objects are saved or deleted one by one. It must be called explicitly after bulk operations
+    @param missions_id: list of missions id
+    @param dependencies: missions cache dependencies to invalidate. Default is all"""
+    cache_invalidate(*[dependency % {"id": mission_id} for mission_id in missions_id for dependency in dependencies])
+
+
+class MissionQuerySet(models.QuerySet):
+    def with_mission_id(self):
+        """Annotate missions with their rank among their lead missions. It is used by mission_id() instead of
+        querying each mission lead missions in mission lists"""
+        previous_missions = Mission.objects.filter(lead=OuterRef("lead"), id__lt=OuterRef("id")).order_by().values("lead")
+        return self.annotate(lead_rank=Coalesce(Subquery(previous_missions.annotate(rank=Count("id")).values("rank")), 0))
+
+
 class Mission(models.Model):
     MISSION_NATURE = (
             ('PROD',  gettext("Productive")),
@@ -93,6 +119,8 @@ class Mission(models.Model):
 
     history = AuditlogHistoryField()
 
+    objects = MissionQuerySet.as_manager()
+
     def __str__(self):
         if self.description and not self.lead:
             return str(self.description)
@@ -194,7 +222,7 @@ class Mission(models.Model):
         else:
             return []
 
-    @cacheable("Mission.consultant_rates%(id)s", 5)
+    @cacheable("Mission.consultant_rates%(id)s", MISSION_CACHE_TIMEOUT, depends=(MISSION_RATES_DEPENDENCY,))
     def consultant_rates(self):
         """@return: dict with consultant as key and (daily rate, bought daily rate) as value or 0 if not defined."""
         rates = {}
@@ -222,11 +250,13 @@ class Mission(models.Model):
             end = date.today()
         current = start
         exit_condition = False
+        consultants = list(consultants)
+        rate_objectives = RateObjectiveIndex(consultants)
         while True:
             for consultant in consultants:
                 if consultant not in rates:
                     rates[consultant] = []
-                objective_rate = consultant.get_rate_objective(current, rate_type="DAILY_RATE")
+                objective_rate = rate_objectives.get(consultant, current, rate_type="DAILY_RATE")
                 rates[consultant].append([current, objective_rate.rate if objective_rate else None])
             if exit_condition or current == end:
                 break
@@ -240,19 +270,26 @@ class Mission(models.Model):
         """:return: True if all rates are defined for consultants forecasted or that already consume time for this mission. Else False"""
         return set(self.consultants()).issubset(set(Consultant.objects.filter(financialcondition__mission=self)))
 
-    @cacheable("Mission.mission_id%(id)s", 120)
     def mission_id(self):
         """Compute mission id :
             if mission has lead, it is based on lead deal_id if exists
             else if mission deal_id is used or default to pk (id)"""
         if self.lead and self.lead.deal_id:
-            rank = list(self.lead.mission_set.order_by("id")).index(self)  # compute mission rank
+            if hasattr(self, "lead_rank"):  # See MissionQuerySet.with_mission_id()
+                rank = self.lead_rank
+            else:
+                rank = self._lead_rank()
             return self.lead.deal_id + chr(97 + rank)  # chr(97) is 'a'
         elif self.deal_id:
             return self.deal_id
         else:
             return str(self.id)
 
+    @cacheable("Mission.lead_rank%(id)s", 120)
+    def _lead_rank(self):
+        """Rank of mission among its lead missions. Use mission_id() that use precomputed rank when available"""
+        return self.lead.mission_set.filter(id__lt=self.id).count()
+
     def mission_analytic_code(self):
         """get analytic code of this mission. Mission id is used if not defined"""
         if self.analytic_code:
@@ -260,12 +297,36 @@ class Mission(models.Model):
         else:
             return self.mission_id()
 
-    @cacheable("Mission.done_work%(id)s", 10)
+    @cacheable("Mission.aggregates%(id)s", MISSION_CACHE_TIMEOUT, depends=MISSION_CACHE_DEPENDENCIES)
+    def _aggregates(self):
+        """Compute mission aggregates. Use aggregates() that handle cache expiration"""
+        aggregates = {"date": date.today(),
+                      "done_work": self.done_work_period(None, date.today()),
+                      "forecasted_work": self._forecasted_work()}
+        staffing_dates = self.staffing_set.aggregate(Min("staffing_date"), Max("staffing_date"))
+        timesheet_dates = self.timesheet_set.aggregate(Min("working_date"), Max("working_date"))
+        aggregates["staffing_start_date"] = staffing_dates["staffing_date__min"]
+        aggregates["staffing_end_date"] = staffing_dates["staffing_date__max"]
+        aggregates["timesheet_start_date"] = timesheet_dates["working_date__min"]
+        aggregates["timesheet_end_date"] = timesheet_dates["working_date__max"]
+        return aggregates
+
+    def aggregates(self):
+        """Precomputed mission aggregates: done and forecasted work, staffing and timesheet dates.
+        Aggregates are cached for a long time and invalidated when timesheet, staffing or financial conditions
+        change (see flush_mission_cache). As done and forecasted work depend on current day, aggregates
+        computed on a previous day are recomputed.
+        @return: dict"""
+        aggregates = self._aggregates()
+        if aggregates["date"] != date.today():
+            flush_mission_cache([self.id], (MISSION_TIMESHEET_DEPENDENCY, MISSION_STAFFING_DEPENDENCY))
+            aggregates = self._aggregates()
+        return aggregates
+
     def done_work(self):
         """Compute done work according to timesheet for this mission
-        Result is cached for few seconds
         @return: (done work in days, done work in euros)"""
-        return self.done_work_period(None, date.today())
+        return self.aggregates()["done_work"]
 
     def done_work_k(self):
         """Same as done_work, but with amount in keur"""
@@ -307,11 +368,13 @@ class Mission(models.Model):
                 amount += charge * rates[consultant_id]
         return days, amount
 
-    @cacheable("Mission.forecasted_work%(id)s", 10)
     def forecasted_work(self):
         """Compute forecasted work according to staffing for this mission
-        Result is cached for few seconds
         @return: (forecasted work in days, forecasted work in euros"""
+        return self.aggregates()["forecasted_work"]
+
+    def _forecasted_work(self):
+        """Compute forecasted work. Use forecasted_work() that use precomputed aggregates"""
         rates = dict([(i.id, j[0]) for i, j in self.consultant_rates().items()])  # switch to consultant id
         days = 0
         amount = 0
@@ -379,7 +442,9 @@ class Mission(models.Model):
         staffings = staffings.order_by("staffing_date")
         timesheetMonths = list(timesheets.dates("working_date", "month"))
         staffingMonths = list(staffings.dates("staffing_date", "month"))
-        for consultant in self.consultants():
+        consultants = self.consultants()
+        rate_objectives = RateObjectiveIndex(consultants)
+        for consultant in consultants:
             result[consultant] = 0  # Initialize margin over rate objective for this consultant
             timesheet_data = dict(timesheets.filter(consultant=consultant).annotate(month=TruncMonth("working_date")).values_list("month").annotate(Sum("charge")).order_by("month"))
             staffing_data = dict(staffings.filter(consultant=consultant).annotate(month=TruncMonth("staffing_date")).values_list("month").annotate(Sum("charge")).order_by("month"))
@@ -392,7 +457,7 @@ class Mission(models.Model):
                         result[consultant] += n_days * (consultant_rates[consultant][0] * (1 - get_parameter("SUBCONTRACTOR_BUDGET_MARGIN") / 100) - consultant_rates[consultant][1])
                 else:
                     # Compute objective margin on rate objective for this period
-                    objectiveRate = consultant.get_rate_objective(working_date=month, rate_type="DAILY_RATE")
+                    objectiveRate = rate_objectives.get(consultant, month, rate_type="DAILY_RATE")
                     if objectiveRate:
                         result[consultant] += n_days * (consultant_rates[consultant][0] - objectiveRate.rate)
 
@@ -404,46 +469,26 @@ class Mission(models.Model):
                         result[consultant] += n_days * (consultant_rates[consultant][0] * (1 - get_parameter("SUBCONTRACTOR_BUDGET_MARGIN")/100) - consultant_rates[consultant][1])
                 else:
                     # Compute objective margin on rate objective for this period
-                    objectiveRate = consultant.get_rate_objective(working_date=month, rate_type="DAILY_RATE")
+                    objectiveRate = rate_objectives.get(consultant, month, rate_type="DAILY_RATE")
                     if objectiveRate:
                         result[consultant] += n_days * (consultant_rates[consultant][0] - objectiveRate.rate)
         return result
 
-    @cacheable("Mission.staffing_start_date%(id)s", 10)
     def staffing_start_date(self):
         """Starting date (=oldest) staffing date of this mission. None if no staffing"""
-        start_dates = self.staffing_set.all().aggregate(Min("staffing_date")).values()
-        if start_dates:
-            return list(start_dates)[0]
-        else:
-            return None
+        return self.aggregates()["staffing_start_date"]
 
-    @cacheable("Mission.staffing_end_date%(id)s", 10)
     def staffing_end_date(self):
         """End date (=latest) staffing date of this mission. None if no staffing"""
-        end_dates = self.staffing_set.all().aggregate(Max("staffing_date")).values()
-        if end_dates:
-            return list(end_dates)[0]
-        else:
-            return None
+        return self.aggregates()["staffing_end_date"]
 
-    @cacheable("Mission.timesheet_start_date%(id)s", 10)
     def timesheet_start_date(self):
         """Starting date (=oldest) timesheet date of this mission. None if no timesheet"""
-        start_dates = self.timesheet_set.all().aggregate(Min("working_date")).values()
-        if start_dates:
-            return list(start_dates)[0]
-        else:
-            return None
+        return self.aggregates()["timesheet_start_date"]
 
-    @cacheable("Mission.timesheet_end_date%(id)s", 10)
     def timesheet_end_date(self):
         """End date (=latest) timesheet date of this mission. None if no timesheet"""
-        end_dates = self.timesheet_set.all().aggregate(Max("working_date")).values()
-        if end_dates:
-            return list(end_dates)[0]
-        else:
-            return None
+        return self.aggregates()["timesheet_end_date"]
 
     def pivotable_data(self, startDate=None, endDate=None):
         """Compute raw data for pivot table on that mission"""
@@ -633,3 +678,126 @@ class FinancialCondition(models.Model):
     class Meta:
         unique_together = (("consultant", "mission", "daily_rate"),)
         verbose_name = _("Financial condition")
+
+
+class MonthlyTurnover(models.Model):
+    """The turnover fact table: done days and turnover per month per consultant per mission.
+    It is derived from timesheets and financial conditions. See refresh_monthly_turnover()"""
+    mission = models.ForeignKey(Mission, on_delete=models.CASCADE)
+    consultant = models.ForeignKey(Consultant, on_delete=models.CASCADE)
+    month = models.DateField(_("Month"))
+    days = models.FloatField(_("Days"), default=0)
+    amount = models.FloatField(_("Turnover"), default=0)
+    subsidiary = models.ForeignKey(Subsidiary, verbose_name=_("Subsidiary"), null=True, on_delete=models.SET_NULL)  # Consultant company
+    subcontractor = models.BooleanField(_("Subcontractor"), default=False)
+
+    def __str__(self):
+        return "%s/%s (%s): %s" % (self.month.month, self.month.year, self.consultant_id, self.amount)
+
+    class Meta:
+        unique_together = (("mission", "consultant", "month"),)
+        indexes = [models.Index(fields=["month", "mission"]), models.Index(fields=["consultant", "month"])]
+        verbose_name = _("Monthly turnover")
+
+
+def refresh_monthly_turnover(missions_id=None, consultants_id=None, months=None):
+    """Recompute monthly turnover fact table from timesheets and financial conditions.
+    Signals take care of it when objects are saved or deleted one by one. It must be called explicitly after bulk operations
+    @param missions_id: list of missions id. None (default) is all missions
+    @param consultants_id: list of consultants id. None (default) is all consultants
+    @param months: list of months (first day of month). None (default) is all months"""
+    timesheets = Timesheet.objects.annotate(month=TruncMonth("working_date"))
+    turnovers = MonthlyTurnover.objects.all()
+    rates = FinancialCondition.objects.all()
+    if missions_id is not None:
+        timesheets = timesheets.filter(mission_id__in=missions_id)
+        turnovers = turnovers.filter(mission_id__in=missions_id)
+        rates = rates.filter(mission_id__in=missions_id)
+    if consultants_id is not None:
+        timesheets = timesheets.filter(consultant_id__in=consultants_id)
+        turnovers = turnovers.filter(consultant_id__in=consultants_id)
+        rates = rates.filter(consultant_id__in=consultants_id)
+    if months is not None:
+        timesheets = timesheets.filter(month__in=months)
+        turnovers = turnovers.filter(month__in=months)
+    # Last financial condition wins, like in Mission.consultant_rates()
+    daily_rates = {(mission_id, consultant_id): daily_rate for mission_id, consultant_id, daily_rate in
+                   rates.order_by("id").values_list("mission_id", "consultant_id", "daily_rate")}
+    timesheets = timesheets.values_list("mission_id", "consultant_id", "month", "consultant__company_id", "consultant__subcontractor")
+    timesheets = timesheets.annotate(Sum("charge")).order_by()
+    new_turnovers = [MonthlyTurnover(mission_id=mission_id, consultant_id=consultant_id, month=month, days=days,
+                                     amount=days * daily_rates.get((mission_id, consultant_id), 0),
+                                     subsidiary_id=subsidiary_id, subcontractor=subcontractor)
+                     for mission_id, consultant_id, month, subsidiary_id, subcontractor, days in timesheets]
+    with transaction.atomic():
+        turnovers.delete()
+        # Concurrent refresh of the same scope computes the same rows, just keep the first one
+        MonthlyTurnover.objects.bulk_create(new_turnovers, batch_size=1000, ignore_conflicts=True)
+
+
+@receiver(post_save, sender=Timesheet)
+@disable_for_loaddata
+@disable_for_explicit_refresh
+def flush_timesheet_cache_on_save(sender, instance, **kwargs):
+    flush_mission_cache([instance.mission_id], (MISSION_TIMESHEET_DEPENDENCY,))
+    cache_invalidate(CONSULTANT_TIMESHEET_DEPENDENCY % {"id": instance.consultant_id})
+
+
+@receiver(post_delete, sender=Timesheet)
+@disable_for_explicit_refresh
+def flush_timesheet_cache_on_delete(sender, instance, **kwargs):
+    flush_mission_cache([instance.mission_id], (MISSION_TIMESHEET_DEPENDENCY,))
+    cache_invalidate(CONSULTANT_TIMESHEET_DEPENDENCY % {"id": instance.consultant_id})
+
+
+@receiver(post_save, sender=Staffing)
+@disable_for_loaddata
+def flush_staffing_cache_on_save(sender, instance, **kwargs):
+    flush_mission_cache([instance.mission_id], (MISSION_STAFFING_DEPENDENCY,))
+
+
+@receiver(post_delete, sender=Staffing)
+def flush_staffing_cache_on_delete(sender, instance, **kwargs):
+    flush_mission_cache([instance.mission_id], (MISSION_STAFFING_DEPENDENCY,))
+
+
+@receiver(post_save, sender=FinancialCondition)
+@disable_for_loaddata
+def flush_rates_cache_on_save(sender, instance, **kwargs):
+    flush_mission_cache([instance.mission_id], (MISSION_RATES_DEPENDENCY,))
+
+
+@receiver(post_delete, sender=FinancialCondition)
+def flush_rates_cache_on_delete(sender, instance, **kwargs):
+    flush_mission_cache([instance.mission_id], (MISSION_RATES_DEPENDENCY,))
+
+
+@receiver(post_save, sender=Timesheet)
+@disable_for_loaddata
+@disable_for_explicit_refresh
+def refresh_monthly_turnover_on_timesheet_save(sender, instance, **kwargs):
+    refresh_monthly_turnover([instance.mission_id], [instance.consultant_id], [date(instance.working_date.year, instance.working_date.month, 1)])
+
+
+@receiver(post_delete, sender=Timesheet)
+@disable_for_explicit_refresh
+def refresh_monthly_turnover_on_timesheet_delete(sender, instance, **kwargs):
+    refresh_monthly_turnover([instance.mission_id], [instance.consultant_id], [date(instance.working_date.year, instance.working_date.month, 1)])
+
+
+@receiver(post_save, sender=FinancialCondition)
+@disable_for_loaddata
+def refresh_monthly_turnover_on_rates_save(sender, instance, **kwargs):
+    refresh_monthly_turnover([instance.mission_id], [instance.consultant_id])
+
+
+@receiver(post_delete, sender=FinancialCondition)
+def refresh_monthly_turnover_on_rates_delete(sender, instance, **kwargs):
+    refresh_monthly_turnover([instance.mission_id], [instance.consultant_id])
+
+
+@receiver(post_save, sender=Consultant)
+@disable_for_loaddata
+def update_monthly_turnover_on_consultant_save(sender, instance, **kwargs):
+    MonthlyTurnover.objects.filter(consultant=instance).exclude(subsidiary_id=instance.company_id, subcontractor=instance.subcontractor).update(
+        subsidiary_id=instance.company_id, subcontractor=instance.subcontractor)
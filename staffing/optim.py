@@ -7,6 +7,7 @@ Optimisation tools for pydici staffing module
 
 from datetime import datetime
 
+import numpy as np
 from ortools.sat.python import cp_model
 
 from django.utils.safestring import mark_safe
@@ -14,17 +15,40 @@ from django.utils.translation import gettext as _
 from django.utils.translation import  gettext_noop
 from django.utils.html import escape
 from django.db import transaction
+from django.conf import settings
 
-from core.utils import working_days, to_int_or_round
-from staffing.models import PublicHoliday, Staffing
+from core.utils import working_days, to_int_or_round, nextMonth
+from staffing.models import PublicHoliday, Staffing, Mission, flush_mission_cache, MISSION_STAFFING_DEPENDENCY
+from people.models import Consultant, RateObjectiveIndex
+from staffing.utils import staffing_nature_matrix
 
 OPTIM_NEWBIE_LIMIT = 2
 OPTIM_NEWBIE_SENIOR_LIMIT = 3
 OPTIM_SENIOR_DIRECTOR_LIMIT = 6
+OPTIM_SCORE_MAX = 10 ** 7
 
+OPTIMISER_JOB_CACHE_KEY = "PYDICI_OPTIMISER_JOB_%s"
 
-def solve_pdc(consultants, senior_consultants, director_consultants, missions, months, missions_charge, missions_remaining, missions_boundaries,
-              consultants_freetime, predefined_assignment, exclusions, consultants_rates, solver_param=None):
+
+class SolverProgressCallback(cp_model.CpSolverSolutionCallback):
+    """Report each intermediate solution found by the solver"""
+    def __init__(self, progress):
+        """@param progress: function called with solution count, objective value and wall time (sec.)"""
+        super().__init__()
+        self.progress = progress
+        self.solution_count = 0
+
+    def on_solution_callback(self):
+        self.solution_count += 1
+        self.progress(self.solution_count, self.ObjectiveValue(), self.WallTime())
+
+
+def build_pdc_model(consultants, senior_consultants, director_consultants, missions, months, missions_charge, missions_remaining,
+                    missions_boundaries, consultants_freetime, predefined_assignment, exclusions, consultants_rates, solver_param=None,
+                    hints=None):
+    """Build CP-SAT staffing model. See solve_pdc for parameters
+    @return: model, scores variables, staffing variables. Staffing is 0 (not a variable) when a consultant
+    cannot be staffed on a mission at a given month (exclusion, no free time or outside mission boundaries)"""
     # default value
     if solver_param is None:
         solver_param = {}
@@ -36,119 +60,113 @@ def solve_pdc(consultants, senior_consultants, director_consultants, missions, m
     people_per_mission_weight = solver_param.get("people_per_mission_weight", 1)
     freetime_weight = solver_param.get("freetime_weight", 1)
     newbie_consultants = [c for c in consultants if c not in senior_consultants and c not in director_consultants]
+    excluded = set((consultant, mission) for mission, excluded_consultants in exclusions.items() for consultant in excluded_consultants)
+    # Months where each mission can be staffed according to its boundaries
+    missions_months = {}
+    for mission in missions:
+        start = months.index(missions_boundaries[mission]["start"]) if missions_boundaries[mission]["start"] in months else 0
+        end = months.index(missions_boundaries[mission]["end"]) if missions_boundaries[mission]["end"] in months else len(months)
+        missions_months[mission] = set(months[start:end])
     # CP-SAT model
     model = cp_model.CpModel()
     # variable we are searching
     staffing = {}  # Per month
-    staffing_cum = {}  # cumulative staffing since mission beginning
     staffing_b = {}  # Bool indicating if consultant is staffed  (ie staffing >0) by month on this mission
     staffing_b_all = {}  # Bool indicating if consultant is staffed on this mission
-    staffing_mission_delta = {}  # Delta between proposition and forecast for mission/month
-    staffing_mission_cum_delta = {}  # Cumulated Delta between proposition and forecast for mission/month
-    staffing_mission_global_delta = {}  # Delta between proposition and forecast for mission accross all month
     for consultant in consultants:
-        if consultant not in staffing:
-            staffing[consultant] = {}
-            staffing_cum[consultant] = {}
-            staffing_b[consultant] = {}
-            staffing_b_all[consultant] = {}
+        staffing[consultant] = {}
+        staffing_b[consultant] = {}
+        staffing_b_all[consultant] = {}
         for mission in missions:
-            if mission not in staffing[consultant]:
-                staffing[consultant][mission] = {}
-                staffing_cum[consultant][mission] = {}
-                staffing_b[consultant][mission] = {}
-            for month_num, month in enumerate(months):
+            staffing[consultant][mission] = {}
+            staffing_b[consultant][mission] = {}
+            for month in months:
+                if (consultant, mission) in excluded or month not in missions_months[mission] or consultants_freetime[consultant][month] <= 0:
+                    staffing[consultant][mission][month] = 0  # No need for variables
+                    continue
                 # Define vars
                 staffing[consultant][mission][month] = model.NewIntVar(0, consultants_freetime[consultant][month],
                                                                        "staffing[%s,%s,%s]" % (consultant, mission, month))
-                staffing_cum[consultant][mission][month] = model.NewIntVar(0, sum(consultants_freetime[consultant].values()),
-                                                                           "staffing_cum[%s,%s,%s]" % (consultant, mission, month))
                 staffing_b[consultant][mission][month] = model.NewBoolVar(
                     "staffing_b[%s,%s,%s]" % (consultant, mission, month))
                 # Links vars staffing and staffing_b
                 model.Add(staffing[consultant][mission][month] > 0).OnlyEnforceIf(staffing_b[consultant][mission][month])
                 model.Add(staffing[consultant][mission][month] == 0).OnlyEnforceIf(
                     staffing_b[consultant][mission][month].Not())
-                # Links vars staffing and staffing_cum
-                model.Add(sum(staffing[consultant][mission][month] for month in months[:months.index(month) + 1]) ==
-                          staffing_cum[consultant][mission][month])
-
-            # Define vars staffing_b_all
-            staffing_b_all[consultant][mission] = model.NewBoolVar("staffing_b_all[%s,%s]" % (consultant, mission))
-            # Links vars staffing and staffing_b_all
-            model.Add(sum(staffing[consultant][mission][month] for month in months) > 0).OnlyEnforceIf(
-                staffing_b_all[consultant][mission])
-            model.Add(sum(staffing[consultant][mission][month] for month in months) == 0).OnlyEnforceIf(
-                staffing_b_all[consultant][mission].Not())
-
-    # Define monthly delta between proposition and forecast
+                # Use previous solution as a starting point
+                hint = (hints or {}).get(consultant, {}).get(mission, {}).get(month)
+                if hint is not None:
+                    hint = min(hint, consultants_freetime[consultant][month])
+                    model.AddHint(staffing[consultant][mission][month], hint)
+                    model.AddHint(staffing_b[consultant][mission][month], hint > 0)
+            if staffing_b[consultant][mission]:
+                # Define vars staffing_b_all. Consultant is staffed on mission if he is staffed at least one month
+                staffing_b_all[consultant][mission] = model.NewBoolVar("staffing_b_all[%s,%s]" % (consultant, mission))
+                model.AddMaxEquality(staffing_b_all[consultant][mission], list(staffing_b[consultant][mission].values()))
+
+    # Linear expressions reused by constraints and score
+    mission_month_total = {mission: {month: cp_model.LinearExpr.Sum([staffing[consultant][mission][month] for consultant in consultants])
+                                     for month in months} for mission in missions}
+    consultant_month_total = {consultant: {month: cp_model.LinearExpr.Sum([staffing[consultant][mission][month] for mission in missions])
+                                           for month in months} for consultant in consultants}
+    max_charge = sum(sum(consultants_freetime[consultant].values()) for consultant in consultants)
+
+    # Define monthly, cumulated and global delta between proposition and forecast
+    staffing_mission_delta = {}  # Delta between proposition and forecast for mission/month
+    staffing_mission_cum_delta = {}  # Cumulated Delta between proposition and forecast for mission/month
+    staffing_mission_global_delta = {}  # Delta between proposition and forecast for mission accross all month
     for mission in missions:
-        if mission not in staffing_mission_delta:
-            staffing_mission_delta[mission] = {}
-            staffing_mission_cum_delta[mission] = {}
+        staffing_mission_delta[mission] = {}
+        staffing_mission_cum_delta[mission] = {}
+        cum_staffing = 0
+        cum_charge = 0
         for month in months:
             staffing_mission_delta[mission][month] = model.NewIntVar(0, 1000,
                                                                      "staffing_mission_delta[%s,%s]" % (mission, month))
             staffing_mission_cum_delta[mission][month] = model.NewIntVar(0, 1000,
                                                                          "staffing_mission_cum_delta[%s,%s]" % (mission, month))
-            month_total = sum(staffing[consultant][mission][month] for consultant in consultants)
+            month_total = mission_month_total[mission][month]
             model.Add(month_total >= missions_charge[mission][month] - staffing_mission_delta[mission][month])
             model.Add(month_total <= missions_charge[mission][month] + staffing_mission_delta[mission][month])
-            cum_staffing = sum(staffing_cum[consultant][mission][month] for consultant in consultants)
-            cum_charge = sum(missions_charge[mission][month] for month in months[:months.index(month) + 1])
+            # Cumulated staffing is defined incrementally from previous month one
+            previous_cum_staffing = cum_staffing
+            cum_staffing = model.NewIntVar(0, max_charge, "staffing_mission_cum[%s,%s]" % (mission, month))
+            model.Add(cum_staffing == previous_cum_staffing + month_total)
+            cum_charge += missions_charge[mission][month]
             model.Add(cum_staffing >= cum_charge - staffing_mission_cum_delta[mission][month])
             model.Add(cum_staffing <= cum_charge + staffing_mission_cum_delta[mission][month])
-
-    # Define global delta between proposition and forecast
-    for mission in missions:
+        # Last cumulated staffing and charge are mission totals
         staffing_mission_global_delta[mission] = model.NewIntVar(-1000, 1000, "staffing_mission_global_delta[%s]" % mission)
-        s = []
-        mission_total = sum(missions_charge[mission][month] for month in months)
-        for month in months:
-            s.extend(staffing[consultant][mission][month] for consultant in consultants)
-        model.Add(sum(s) >= mission_total - staffing_mission_global_delta[mission])
-        model.Add(sum(s) <= mission_total + staffing_mission_global_delta[mission])
+        model.Add(cum_staffing >= cum_charge - staffing_mission_global_delta[mission])
+        model.Add(cum_staffing <= cum_charge + staffing_mission_global_delta[mission])
 
     # Each mission should have a noob, senior and director quota each month
     for mission in missions:
         for month in months:
-            newbie_charge = sum(staffing[consultant][mission][month] for consultant in newbie_consultants)
-            senior_charge = sum(staffing[consultant][mission][month] for consultant in senior_consultants)
-            director_charge = sum(staffing[consultant][mission][month] for consultant in director_consultants)
-            total_charge = newbie_charge + senior_charge + director_charge
+            newbie_charge = cp_model.LinearExpr.Sum([staffing[consultant][mission][month] for consultant in newbie_consultants])
+            senior_charge = cp_model.LinearExpr.Sum([staffing[consultant][mission][month] for consultant in senior_consultants])
+            director_charge = cp_model.LinearExpr.Sum([staffing[consultant][mission][month] for consultant in director_consultants])
+            total_charge = mission_month_total[mission][month]
             model.Add(total_charge * newbie_quota <= newbie_charge * 100)
             model.Add(total_charge * senior_quota <= senior_charge * 100)
             model.Add(total_charge * director_quota <= director_charge * 100)
 
     # All missions are done, but not overshoot
     for mission in missions:
-        s_amount = []
-        for month in months:
-            s_amount.extend(staffing[consultant][mission][month] * consultants_rates[consultant][mission] for consultant in consultants)
-        model.Add(sum(s_amount) <= missions_remaining[mission])  # Don't overshoot mission price
+        s_amount = [staffing[consultant][mission][month] * consultants_rates[consultant][mission]
+                    for consultant in consultants for month in months if month in staffing_b[consultant][mission]]
+        model.Add(cp_model.LinearExpr.Sum(s_amount) <= missions_remaining[mission])  # Don't overshoot mission price
 
     # Consultant have limited free time
     for consultant in consultants:
         for month in months:
-            model.Add(sum(staffing[consultant][mission][month] for mission in missions) <= consultants_freetime[consultant][
-                month])
+            model.Add(consultant_month_total[consultant][month] <= consultants_freetime[consultant][month])
 
     # Respect predefined assignment
     for mission, assigned_consultants in predefined_assignment.items():
         for consultant in assigned_consultants:
-            model.Add(sum(staffing[consultant][mission][month] for month in months) > 0)
-
-    # Respect exclusions
-    for mission, excluded_consultants in exclusions.items():
-        for consultant in excluded_consultants:
-            model.AddBoolAnd([staffing_b_all[consultant][mission].Not()])
-
-    # Respect mission boundaries
-    for mission in missions:
-        for i, month in enumerate(months):
-            if (missions_boundaries[mission]["start"] in months and i < months.index(missions_boundaries[mission]["start"])) or \
-                    (missions_boundaries[mission]["end"] in months and i >= months.index(missions_boundaries[mission]["end"])):
-                model.Add(staffing[consultant][mission][month] == 0)
+            # No solution if consultant cannot be staffed on this mission
+            model.AddBoolOr([staffing_b_all[consultant][mission]] if mission in staffing_b_all[consultant] else [])
 
     # define score components
     planning_score_items = []
@@ -167,44 +185,66 @@ def solve_pdc(consultants, senior_consultants, director_consultants, missions, m
                     planning_score_items.append(staffing_mission_delta[mission][month])
                 else:
                     # add penalty when charge is used outside forecast (late or too early work)
-                    planning_score_items.append(3 * sum(staffing[consultant][mission][month] for consultant in consultants))
+                    planning_score_items.append(3 * mission_month_total[mission][month])
             # Add score for global planning delta
             planning_score_items.append(4 * staffing_mission_global_delta[mission])
 
-    for consultant in consultants:
-        for month in months:
-            # optimise freetime and mission per people only if we have stuff to do
-            if sum(missions_charge[mission][month] for mission in missions) > 0:
+    for month in months:
+        # optimise freetime and mission per people only if we have stuff to do
+        if sum(missions_charge[mission][month] for mission in missions) > 0:
+            for consultant in consultants:
                 # reduce free time for newbies only
                 if consultant in newbie_consultants and freetime_weight > 0:
-                    charge = sum(staffing[consultant][mission][month] for mission in missions)
-                    freetime_score_items.append(consultants_freetime[consultant][month] - charge)
+                    freetime_score_items.append(consultants_freetime[consultant][month] - consultant_month_total[consultant][month])
                 # limit number of mission per people
-                mission_per_people_score_items.append(sum(staffing_b[consultant][mission][month] for mission in missions))
+                mission_per_people_score_items.extend(staffing_b[consultant][mission][month] for mission in missions
+                                                      if month in staffing_b[consultant][mission])
 
     # limit number of people per mission
     for mission in missions:
-        people_per_mission_score_items.append(5*sum(staffing_b_all[consultant][mission] for consultant in consultants))
+        people_per_mission_score_items.extend(5 * staffing_b_all[consultant][mission] for consultant in consultants
+                                              if mission in staffing_b_all[consultant])
 
     # Optim part
     # Define intermediate score
-    planning_score = model.NewIntVar(0, 1000, "planning_score")
-    freetime_score = model.NewIntVar(0, 1000, "freetime_score")
-    people_per_mission_score = model.NewIntVar(0, 1000, "people_per_mission_score")
-    mission_per_people_score = model.NewIntVar(0, 1000, "mission_per_people_score")
-    model.Add(planning_score == planning_weight * sum(planning_score_items))
-    model.Add(freetime_score == freetime_weight * sum(freetime_score_items))
-    model.Add(people_per_mission_score == people_per_mission_weight * sum(people_per_mission_score_items))
-    model.Add(mission_per_people_score == mission_per_people_weight * sum(mission_per_people_score_items))
+    planning_score = model.NewIntVar(0, OPTIM_SCORE_MAX, "planning_score")
+    freetime_score = model.NewIntVar(0, OPTIM_SCORE_MAX, "freetime_score")
+    people_per_mission_score = model.NewIntVar(0, OPTIM_SCORE_MAX, "people_per_mission_score")
+    mission_per_people_score = model.NewIntVar(0, OPTIM_SCORE_MAX, "mission_per_people_score")
+    model.Add(planning_score == planning_weight * cp_model.LinearExpr.Sum(planning_score_items))
+    model.Add(freetime_score == freetime_weight * cp_model.LinearExpr.Sum(freetime_score_items))
+    model.Add(people_per_mission_score == people_per_mission_weight * cp_model.LinearExpr.Sum(people_per_mission_score_items))
+    model.Add(mission_per_people_score == mission_per_people_weight * cp_model.LinearExpr.Sum(mission_per_people_score_items))
 
     score = planning_score + freetime_score + mission_per_people_score + people_per_mission_score
     # optimise model to have minimum score
     model.Minimize(score)
 
+    return model, [planning_score, freetime_score, people_per_mission_score, mission_per_people_score], staffing
+
+
+def solve_pdc(consultants, senior_consultants, director_consultants, missions, months, missions_charge, missions_remaining, missions_boundaries,
+              consultants_freetime, predefined_assignment, exclusions, consultants_rates, solver_param=None, progress=None,
+              hints=None):
+    """Solve staffing problem with CP-SAT
+    @param solver_param: dict of quota, score weights and solver limits (max_time in sec., num_workers). See defaults in build_pdc_model
+    @param progress: optional function called on each intermediate solution. See SolverProgressCallback
+    @param hints: previous solution values (see solver_solution_values) used as solver starting point. Input data may have changed since
+    @return: solver, status (bool), scores variables, staffing variables"""
+    if solver_param is None:
+        solver_param = {}
+    model, scores, staffing = build_pdc_model(consultants, senior_consultants, director_consultants, missions, months,
+                                              missions_charge, missions_remaining, missions_boundaries, consultants_freetime,
+                                              predefined_assignment, exclusions, consultants_rates, solver_param, hints)
     # Solve it
     solver = cp_model.CpSolver()
-    solver.parameters.max_time_in_seconds = 10.0  # Limit to 10 secs
-    status = solver.Solve(model) in (cp_model.OPTIMAL, cp_model.FEASIBLE)
+    solver.parameters.max_time_in_seconds = float(solver_param.get("max_time", settings.OPTIMISER_MAX_TIME))
+    solver.parameters.num_workers = solver_param.get("num_workers", settings.OPTIMISER_WORKERS)
+    if progress:
+        status = solver.Solve(model, SolverProgressCallback(progress))
+    else:
+        status = solver.Solve(model)
+    status = status in (cp_model.OPTIMAL, cp_model.FEASIBLE)
     # Declare status and score string to make them translatable
     gettext_noop("FEASIBLE")
     gettext_noop("OPTIMAL")
@@ -212,7 +252,7 @@ def solve_pdc(consultants, senior_consultants, director_consultants, missions, m
     gettext_noop("freetime_score")
     gettext_noop("people_per_mission_score")
     gettext_noop("mission_per_people_score")
-    return solver, status, [planning_score, freetime_score, people_per_mission_score, mission_per_people_score], staffing
+    return solver, status, scores, staffing
 
 
 def display_solver_solution(solver, scores, staffing, consultants, missions, months, missions_charge, consultants_freetime):
@@ -241,8 +281,17 @@ def display_solver_solution(solver, scores, staffing, consultants, missions, mon
         print()
 
 
-def solver_solution_format(solver, staffing, consultants, missions, staffing_dates, missions_charge, consultants_freetime, consultant_rates):
-    """Prepare solver solution for template rendering. Returns staffing_array and mission_remaining_array"""
+def solver_solution_values(solver, staffing):
+    """Extract solver solution values so it can be stored and used without the solver
+    @return: dict {consultant: {mission: {month: charge}}} with same keys as staffing variables"""
+    return {consultant: {mission: {month: int(solver.Value(var)) for month, var in months.items()}
+                         for mission, months in consultant_staffing.items()}
+            for consultant, consultant_staffing in staffing.items()}
+
+
+def solver_solution_format(solution, consultants, missions, staffing_dates, missions_charge, consultants_freetime, consultant_rates):
+    """Prepare solver solution for template rendering. Returns staffing_array and mission_remaining_array
+    @param solution: solver solution values. See solver_solution_values()"""
     results = []
     missions_remaining_results = []
     class_optim_ok = "optim_ok"
@@ -251,7 +300,7 @@ def solver_solution_format(solver, staffing, consultants, missions, staffing_dat
     for mission in missions:
         mission_id = mission.mission_id()
         mission_link = mark_safe("<a href='%s#tab-timesheet'>%s</a>" % (mission.get_absolute_url(), escape(mission)))
-        new_forecast = sum([solver.Value(staffing[consultant.trigramme][mission_id][month[1]]) * consultant_rates[consultant.trigramme][mission_id] / 1000
+        new_forecast = sum([solution[consultant.trigramme][mission_id][month[1]] * consultant_rates[consultant.trigramme][mission_id] / 1000
                             for consultant in consultants for month in staffing_dates])
         new_target_remaining = mission.remaining(mode="current") - new_forecast
         missions_remaining_results.append([mission_link,
@@ -265,7 +314,7 @@ def solver_solution_format(solver, staffing, consultants, missions, staffing_dat
             charges = []
             display_consultant = False
             for month in staffing_dates:
-                charge = solver.Value(staffing[consultant.trigramme][mission_id][month[1]])
+                charge = solution[consultant.trigramme][mission_id][month[1]]
                 try:
                     delta = charge - Staffing.objects.get(mission=mission, consultant=consultant, staffing_date=month[0]).charge
                 except Staffing.DoesNotExist:
@@ -289,7 +338,7 @@ def solver_solution_format(solver, staffing, consultants, missions, staffing_dat
         all_charges = []
         results.append([""] * (len(staffing_dates) + 2))
         for month in staffing_dates:
-            mission_charge = sum(solver.Value(staffing[consultant.trigramme][mission_id][month[1]]) for consultant in consultants)
+            mission_charge = sum(solution[consultant.trigramme][mission_id][month[1]] for consultant in consultants)
             if mission_charge > 0 or missions_charge[mission_id][month[1]] > 0:
                 if abs(missions_charge[mission_id][month[1]] - mission_charge) < 2:
                     class_optim = class_optim_ok
@@ -308,7 +357,7 @@ def solver_solution_format(solver, staffing, consultants, missions, staffing_dat
         all_charges = []
         for month in staffing_dates:
             consultant_charge = sum(
-                solver.Value(staffing[consultant.trigramme][mission.mission_id()][month[1]]) for mission in missions)
+                solution[consultant.trigramme][mission.mission_id()][month[1]] for mission in missions)
             if consultants_freetime[consultant.trigramme][month[1]] - consultant_charge < 2:
                 class_optim = class_optim_warn
             else:
@@ -319,32 +368,40 @@ def solver_solution_format(solver, staffing, consultants, missions, staffing_dat
     return results, missions_remaining_results
 
 
+def consultant_freetime_matrix(consultants, months, exclude_missions=None, projections="full"):
+    """Compute consultants free days for each month. Staffing is loaded with a single query whatever the number of consultants and months
+    @param consultants: list of consultants. Matrix rows follow this order
+    @param months: sorted list of months (first day of month as date). Matrix columns follow this order
+    @param exclude_missions: missions whose staffing is not deduced from free time (typically missions we want to plan)
+    @param projections: none, balanced or full. Similar to pdc review concept. Use mission probability
+    @return: numpy int array (consultants x months) of free days"""
+    holidays_days = set(PublicHoliday.objects.filter(day__gte=months[0], day__lt=nextMonth(months[-1])).values_list("day", flat=True))
+    wdays = np.array([working_days(month, holidays_days) for month in months], dtype=float)
+    month_index = {month: j for j, month in enumerate(months)}
+    charges = np.zeros((len(consultants), len(months)))
+    staffing = staffing_nature_matrix(consultants, months, projections, exclude_missions=exclude_missions)
+    for i, consultant in enumerate(consultants):
+        for month, natures_charge in staffing.get(consultant.id, {}).items():
+            if month in month_index:
+                charges[i, month_index[month]] = sum(natures_charge)
+    return np.maximum(0, wdays - charges).astype(int)
+
+
 def compute_consultant_freetime(consultants, missions, months, projections="full"):
     """Compute freetime except for missions we want to plan
     projections: none, balanced or full. Similar to pdc review concept. Use mission probability"""
+    consultants = list(consultants)
+    matrix = consultant_freetime_matrix(consultants, [month[0] for month in months], exclude_missions=missions, projections=projections)
     freetime = {}
-    holidays_days = PublicHoliday.objects.all().values_list("day", flat=True)
-    wdays = {month[0]: working_days(month[0], holidays_days) for month in months}
-    for consultant in consultants:
-        freetime[consultant.trigramme] = {}
-        for month in months:
-            current_staffings = consultant.staffing_set.filter(staffing_date=month[0], mission__probability__gt=0).exclude(mission__in=missions)
-            current_staffings = current_staffings.select_related()
-            if projections == "none":
-                current_staffings = current_staffings.filter(mission__probability=100)
-            charge = 0
-            for staffing in current_staffings:
-                if projections == "full":
-                    charge += staffing.charge
-                else:
-                    charge += staffing.charge * staffing.mission.probability / 100
-            freetime[consultant.trigramme][month[1]] = max(0, int(wdays[month[0]] - charge))
+    for i, consultant in enumerate(consultants):
+        freetime[consultant.trigramme] = {month[1]: int(matrix[i, j]) for j, month in enumerate(months)}
     return freetime
 
 
 def compute_consultant_rates(consultants, missions):
     """Get or estimate consultant rates for given missions"""
     rates = {}
+    rate_objectives = RateObjectiveIndex(consultants)
     for mission in missions:
         mission_rates = mission.consultant_rates()
         for consultant in consultants:
@@ -353,7 +410,7 @@ def compute_consultant_rates(consultants, missions):
             if consultant in mission_rates:
                 rates[consultant.trigramme][mission.mission_id()] = mission_rates[consultant][0]
             else:  # use objective rate if rate is not defined at mission level
-                consultant_rate = consultant.get_rate_objective(rate_type="DAILY_RATE")
+                consultant_rate = rate_objectives.get(consultant, rate_type="DAILY_RATE")
                 if consultant_rate:
                     rates[consultant.trigramme][mission.mission_id()] = consultant_rate.rate
                 else:
@@ -361,20 +418,32 @@ def compute_consultant_rates(consultants, missions):
     return rates
 
 
+def optimiser_objects(consultants_id, missions_id):
+    """Get consultants and missions of an optimiser job, in the given order
+    @return: consultants list, missions list"""
+    consultants = Consultant.objects.select_related("profil").in_bulk(consultants_id)
+    missions = Mission.objects.select_related("lead").with_mission_id().in_bulk(missions_id)
+    return [consultants[i] for i in consultants_id if i in consultants], [missions[i] for i in missions_id if i in missions]
+
+
 @transaction.atomic
-def solver_apply_forecast(solver, staffing, consultants, missions, staffing_dates, user):
-    """Apply solver solution to staffing forecast"""
+def solver_apply_forecast(solution, consultants, missions, staffing_dates, user):
+    """Apply solver solution to staffing forecast. Previous forecast of all missions is removed at once and
+    new one is bulk created.
+    @param solution: solver solution values. See solver_solution_values()"""
     now = datetime.now().replace(microsecond=0)  # Remove useless microsecond
+    # Remove previous staffing for those missions after first month
+    Staffing.objects.filter(mission__in=missions, staffing_date__gte=staffing_dates[0][0]).delete()
+    # Create new staffing according to solver solution
+    staffings = []
     for mission in missions:
         mission_id = mission.mission_id()
-        # Remove previous staffing for this mission after first month
-        Staffing.objects.filter(mission=mission, staffing_date__gte=staffing_dates[0][0]).delete()
-        # Create new staffing according to solver solution
         for consultant in consultants:
             for month in staffing_dates:
-                charge = solver.Value(staffing[consultant.trigramme][mission_id][month[1]])
+                charge = solution[consultant.trigramme][mission_id][month[1]]
                 if charge > 0:
-                    s = Staffing(mission=mission, consultant=consultant,
-                                 staffing_date=month[0], charge=charge,
-                                 update_date=now, last_user=str(user))
-                    s.save()
+                    staffings.append(Staffing(mission=mission, consultant=consultant,
+                                              staffing_date=month[0].replace(day=1), charge=charge,
+                                              update_date=now, last_user=str(user)))
+    Staffing.objects.bulk_create(staffings)
+    flush_mission_cache([mission.id for mission in missions], (MISSION_STAFFING_DEPENDENCY,))  # Bulk create does not trigger signals
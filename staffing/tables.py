@@ -51,7 +51,7 @@ class MissionsTableDT(MissionsViewsMixin, BaseDatatableView):
         qs = Mission.objects.all()
         qs = self._filter_on_subsidiary(qs)
         qs = self._filter_on_consultant(qs)
-        return qs.select_related("lead__client__organisation__company", "subsidiary")
+        return qs.select_related("lead__client__organisation__company", "subsidiary").with_mission_id()
 
     def filter_queryset(self, qs):
         """ simple search on some attributes"""
@@ -107,7 +107,7 @@ class ActiveMissionsTableDT(MissionsTableDT):
         qs = Mission.objects.filter(active=True)
         qs = self._filter_on_subsidiary(qs)
         qs = self._filter_on_consultant(qs)
-        return qs.select_related("lead__client__organisation__company", "subsidiary")
+        return qs.select_related("lead__client__organisation__company", "subsidiary").with_mission_id()
 
 
 class ClientCompanyActiveMissionsTablesDT(MissionsTableDT):
@@ -115,4 +115,4 @@ class ClientCompanyActiveMissionsTablesDT(MissionsTableDT):
         qs = Mission.objects.filter(active=True, lead__client__organisation__company__id=self.kwargs["clientcompany_id"])
         qs = self._filter_on_subsidiary(qs)
         qs = self._filter_on_consultant(qs)
-        return qs.select_related("lead__client__organisation__company", "subsidiary")
+        return qs.select_related("lead__client__organisation__company", "subsidiary").with_mission_id()
@@ -11,12 +11,17 @@ from celery import shared_task
 
 from django.urls import reverse
 from django.core.mail import send_mass_mail
+from django.core.cache import cache
+from django.conf import settings
 from django.utils.translation import gettext as _
 from django.template.loader import get_template
 
 from core.utils import get_parameter
 from people.models import Consultant
-from staffing.utils import gatherTimesheetData
+from staffing.models import Mission
+from staffing.utils import gatherTimesheetsData
+from staffing.optim import solve_pdc, solver_solution_values, compute_consultant_freetime, compute_consultant_rates, \
+    optimiser_objects, OPTIMISER_JOB_CACHE_KEY, OPTIM_NEWBIE_SENIOR_LIMIT, OPTIM_SENIOR_DIRECTOR_LIMIT
 
 
 @shared_task
@@ -39,15 +44,16 @@ def warn_for_incomplete_timesheet(warn_overbooking=False, days=None, month="last
         raise Exception("month parameter must be one of 'last' or 'current'")
 
     mails = []  # List of mail to be sent
-    for consultant in Consultant.objects.filter(active=True, subcontractor=False):
+    consultants = Consultant.objects.filter(active=True, subcontractor=False)
+    timesheets_data = gatherTimesheetsData(consultants, [currentMonth])
+    for consultant in consultants:
         recipients = []
         if not [m for m in consultant.forecasted_missions(currentMonth) if m.nature == "PROD"]:
             # No productive mission forecasted on current month
             # Consultant may have just started
             # No check needed. Skip it
             continue
-        missions = consultant.timesheet_missions(month=currentMonth)
-        timesheet_data, timesheet_total, warning = gatherTimesheetData(consultant, missions, currentMonth)
+        timesheet_data, timesheet_total, warning = timesheets_data[(consultant.id, currentMonth)]
         url = get_parameter("HOST") + reverse("people:consultant_home", args=[consultant.trigramme])
         url += "?year=%s&month=%s" % (currentMonth.year, currentMonth.month)
         url += "#tab-timesheet"
@@ -86,3 +92,64 @@ def warn_for_incomplete_timesheet(warn_overbooking=False, days=None, month="last
 
     # Send all emails in one time
     send_mass_mail(mails, fail_silently=False)
+
+
+@shared_task
+def optimise_pdc_job(job_id, consultants_id, missions_id, staffing_dates, missions_charge, missions_boundaries,
+                     predefined_assignment, exclusions, projections="balanced", solver_param=None, hint_job_id=None):
+    """Run staffing optimiser in background. Job progress and final solution are stored in cache
+    (see OPTIMISER_JOB_CACHE_KEY) so solution can be reviewed and applied without solving again
+    :param job_id: job identifier, used in cache key
+    :param consultants_id: list of consultants id to staff
+    :param missions_id: list of missions id to staff
+    :param staffing_dates: list of (month as iso formatted date, month label)
+    :param missions_charge, missions_boundaries, predefined_assignment, exclusions, solver_param: see solve_pdc
+    :param projections: none, balanced or full. See compute_consultant_freetime
+    :param hint_job_id: previous job whose solution is used as solver starting point (if still available)"""
+    cache_key = OPTIMISER_JOB_CACHE_KEY % job_id
+    job = cache.get(cache_key) or {}
+
+    def update_job(**kwargs):
+        job.update(kwargs)
+        cache.set(cache_key, job, settings.OPTIMISER_JOB_TIMEOUT)
+
+    def progress(solution_count, score, wall_time):
+        update_job(solution_count=solution_count, score=int(score), wall_time=wall_time)
+
+    hint_job = cache.get(OPTIMISER_JOB_CACHE_KEY % hint_job_id) if hint_job_id else None
+    hints = hint_job.get("solution") if hint_job else None
+    update_job(status="running", solution_count=0, score=None, wall_time=0, hinted=bool(hints))
+    try:
+        consultants, missions = optimiser_objects(consultants_id, missions_id)
+        staffing_dates = [(date.fromisoformat(month), label) for month, label in staffing_dates]
+        consultants_freetime = compute_consultant_freetime(consultants, missions, staffing_dates, projections=projections)
+        consultant_rates = compute_consultant_rates(consultants, missions)
+        missions_remaining = {m.mission_id(): int(1000 * m.remaining()) for m in missions}
+        solver, status, scores, staffing = solve_pdc([c.trigramme for c in consultants],
+                                                     [c.trigramme for c in consultants if OPTIM_NEWBIE_SENIOR_LIMIT < c.profil.level < OPTIM_SENIOR_DIRECTOR_LIMIT],
+                                                     [c.trigramme for c in consultants if c.profil.level >= OPTIM_SENIOR_DIRECTOR_LIMIT],
+                                                     [m.mission_id() for m in missions], [month[1] for month in staffing_dates],
+                                                     missions_charge, missions_remaining, missions_boundaries, consultants_freetime,
+                                                     predefined_assignment, exclusions, consultant_rates, solver_param, progress=progress,
+                                                     hints=hints)
+    except Exception:
+        update_job(status="error")
+        raise
+
+    if status:
+        update_job(status="done",
+                   solution=solver_solution_values(solver, staffing),
+                   scores=[(score.Name(), solver.Value(score)) for score in scores],
+                   score=sum(solver.Value(score) for score in scores),
+                   solver_status=solver.StatusName(), wall_time=solver.WallTime(),
+                   num_branches=solver.NumBranches(), num_conflicts=solver.NumConflicts(),
+                   consultants_freetime=consultants_freetime, consultant_rates=consultant_rates)
+    else:
+        update_job(status="failed", wall_time=solver.WallTime())
+
+
+@shared_task
+def warmup_missions_aggregates():
+    """Precompute active missions aggregates. Intended to be scheduled daily as done and forecasted work depend on current day"""
+    for mission in Mission.objects.filter(active=True):
+        mission.aggregates()
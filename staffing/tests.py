@@ -17,15 +17,20 @@ from django.core.cache import cache
 from django.urls import reverse
 from django.contrib.auth.models import User
 from django.forms import inlineformset_factory
+from django.db.models import Sum
 
-from staffing import utils
+from auditlog.models import LogEntry
+
+from staffing import utils, optim
 from leads.models import Lead
 from staffing.forms import MissionStaffingInlineFormset, StaffingForm
-from staffing.models import Mission, Staffing, Timesheet, FinancialCondition, PublicHoliday, HolidayBalanceType, HolidayBalance
-from staffing.optim import solve_pdc, display_solver_solution
+from staffing.models import Mission, Staffing, Timesheet, FinancialCondition, PublicHoliday, HolidayBalanceType, HolidayBalance, \
+    LunchTicket, MonthlyTurnover, refresh_monthly_turnover
+from staffing.optim import solve_pdc, build_pdc_model, solver_solution_values, display_solver_solution, consultant_freetime_matrix, compute_consultant_freetime, \
+    OPTIMISER_JOB_CACHE_KEY
 from staffing.utils import check_holiday_balance_overflow
 from people.models import Consultant, RateObjective
-from core.utils import previousMonth, nextMonth
+from core.utils import previousMonth, nextMonth, working_days
 from core.tests import PYDICI_FIXTURES, TEST_USERNAME, setup_test_user_features
 
 
@@ -173,6 +178,195 @@ class StaffingModelTest(TestCase):
         self.assertListEqual(check_holiday_balance_overflow([], c1, date(2026, 6, 1)), [])
         self.assertEqual(len(check_holiday_balance_overflow([], c1, date(2026, 7, 1))), 2)
 
+    def test_staffing_nature_matrix(self):
+        c1 = Consultant.objects.get(id=1)
+        month = date(2010, 2, 1)
+        holidays = Mission.objects.create(description="holidays", nature="HOLIDAYS", subsidiary_id=1, probability=100)
+        Staffing.objects.create(mission=holidays, consultant=c1, staffing_date=month, charge=2)
+        # Fixture prod mission 1 is 50% with 10 days forecasted
+        matrix = utils.staffing_nature_matrix(Consultant.objects.all(), [month], projection="balanced")
+        self.assertEqual(matrix[c1.id][month], (5, 0, 2))
+        matrix = utils.staffing_nature_matrix(Consultant.objects.all(), [month], projection="full")
+        self.assertEqual(matrix[c1.id][month], (10, 0, 2))
+        matrix = utils.staffing_nature_matrix(Consultant.objects.all(), [month], projection="none")
+        self.assertEqual(matrix[c1.id][month], (0, 0, 2))
+        matrix = utils.staffing_nature_matrix(Consultant.objects.all(), [month], exclude_missions=[holidays])
+        self.assertEqual(matrix[c1.id][month], (5, 0, 0))
+        self.assertNotIn(2, utils.staffing_nature_matrix([2], [month]))
+
+    def test_consultant_freetime(self):
+        consultants = list(Consultant.objects.filter(id__in=(1, 2)).order_by("id"))
+        months = [date(2010, 1, 1), date(2010, 2, 1)]
+        mission = Mission.objects.get(id=1)  # 50% mission with 10 days forecasted for consultant 1 on february
+        wdays = [working_days(month, PublicHoliday.objects.values_list("day", flat=True)) for month in months]
+        matrix = consultant_freetime_matrix(consultants, months)
+        self.assertEqual(matrix.shape, (2, 2))
+        self.assertEqual(matrix.tolist(), [[wdays[0], wdays[1] - 10], wdays])
+        self.assertEqual(consultant_freetime_matrix(consultants, months, projections="balanced")[0, 1], wdays[1] - 5)
+        self.assertEqual(consultant_freetime_matrix(consultants, months, exclude_missions=[mission]).tolist(), [wdays, wdays])
+        freetime = compute_consultant_freetime(consultants, [], [(month, str(month)) for month in months])
+        self.assertEqual(freetime[consultants[0].trigramme], {str(months[0]): wdays[0], str(months[1]): wdays[1] - 10})
+
+    def test_solver_apply_forecast(self):
+        c1, c2 = Consultant.objects.get(id=1), Consultant.objects.get(id=2)
+        mission = Mission.objects.get(id=1)
+        staffing_dates = [(date(2010, 2, 1), "feb"), (date(2010, 3, 1), "mar")]
+        Staffing.objects.create(mission=mission, consultant=c2, staffing_date=date(2010, 3, 1), charge=4)
+        Staffing.objects.create(mission=mission, consultant=c2, staffing_date=date(2010, 1, 1), charge=4)
+        self.assertEqual(mission.staffing_end_date(), date(2010, 3, 1))  # Fill cache
+        solution = {c1.trigramme: {mission.mission_id(): {"feb": 3, "mar": 0}},
+                    c2.trigramme: {mission.mission_id(): {"feb": 1, "mar": 0}}}
+        with self.assertNumQueries(5):  # savepoint, select (delete signals), delete, bulk insert, release savepoint
+            optim.solver_apply_forecast(solution, [c1, c2], [mission], staffing_dates, "me")
+        staffings = Staffing.objects.filter(mission=mission).order_by("staffing_date", "consultant_id")
+        self.assertEqual(list(staffings.values_list("consultant_id", "staffing_date", "charge", "last_user")),
+                         [(2, date(2010, 1, 1), 4, None), (1, date(2010, 2, 1), 3, "me"), (2, date(2010, 2, 1), 1, "me")])
+        self.assertEqual(mission.staffing_end_date(), date(2010, 2, 1))
+
+    def test_mission_aggregates(self):
+        mission = Mission.objects.get(id=1)
+        c1 = Consultant.objects.get(id=1)
+        done_days, done_amount = mission.done_work()
+        self.assertEqual(mission.aggregates()["done_work"], (done_days, done_amount))
+        with self.assertNumQueries(0):  # Cached
+            mission.done_work()
+            mission.forecasted_work()
+            mission.timesheet_end_date()
+        # Cache is flushed on timesheet, staffing and financial conditions changes
+        timesheet = Timesheet.objects.create(mission=mission, consultant=c1, working_date=date(2009, 1, 2), charge=1)
+        self.assertEqual(mission.done_work()[0], done_days + 1)
+        self.assertEqual(mission.timesheet_start_date(), date(2009, 1, 2))
+        timesheet.delete()
+        self.assertEqual(mission.done_work()[0], done_days)
+        Staffing.objects.create(mission=mission, consultant=c1, staffing_date=date(2030, 1, 1), charge=1)
+        self.assertEqual(mission.staffing_end_date(), date(2030, 1, 1))
+        mission.consultant_rates()
+        FinancialCondition.objects.filter(mission=mission, consultant=c1).delete()
+        FinancialCondition.objects.create(mission=mission, consultant=c1, daily_rate=1)
+        self.assertEqual(mission.consultant_rates()[c1][0], 1)
+        # Aggregates of previous days are not used
+        stale_aggregates = dict(mission.aggregates(), date=date(2000, 1, 1))
+        cache.set("Mission.aggregates%s" % mission.id, stale_aggregates)
+        self.assertEqual(mission.aggregates()["date"], date.today())
+
+    def test_monthly_turnover(self):
+        mission = Mission.objects.get(id=1)
+        c1 = Consultant.objects.get(id=1)
+        month = date(2011, 3, 1)
+        turnover = MonthlyTurnover.objects.filter(mission=mission, consultant=c1, month=month).values_list("days", "amount", "subsidiary", "subcontractor")
+        FinancialCondition.objects.filter(mission=mission, consultant=c1).delete()
+        # Fact table is updated on timesheet and financial conditions changes
+        Timesheet.objects.create(mission=mission, consultant=c1, working_date=month, charge=1)
+        Timesheet.objects.create(mission=mission, consultant=c1, working_date=date(2011, 3, 2), charge=0.5)
+        self.assertEqual(list(turnover.all()), [(1.5, 0, c1.company_id, False)])
+        FinancialCondition.objects.create(mission=mission, consultant=c1, daily_rate=1000)
+        self.assertEqual(list(turnover.all()), [(1.5, 1500, c1.company_id, False)])
+        c1.subcontractor = True
+        c1.save()
+        self.assertEqual(list(turnover.all()), [(1.5, 1500, c1.company_id, True)])
+        c1.subcontractor = False
+        c1.save()
+        # And after bulk timesheet changes
+        old_data = utils.gatherTimesheetData(c1, [mission], month)[0]
+        utils.saveTimesheetData(c1, month, {"charge_1_1": 2, "charge_1_2": None}, old_data)
+        self.assertEqual(list(turnover.all()), [(2, 2000, c1.company_id, False)])
+        # Incremental refresh gives the same result as a full rebuild
+        turnovers = MonthlyTurnover.objects.order_by("mission", "consultant", "month").values_list("mission", "consultant", "month", "days", "amount")
+        incremental_turnovers = list(turnovers.all())
+        refresh_monthly_turnover()
+        self.assertEqual(list(turnovers.all()), incremental_turnovers)
+        Timesheet.objects.filter(mission=mission, consultant=c1, working_date__gte=month).delete()
+        self.assertEqual(list(turnover.all()), [])
+
+    def test_turnover_matrix(self):
+        mission = Mission.objects.get(id=1)
+        c1 = Consultant.objects.get(id=1)
+        FinancialCondition.objects.filter(mission=mission, consultant=c1).delete()
+        FinancialCondition.objects.create(mission=mission, consultant=c1, daily_rate=1000)
+        Timesheet.objects.create(mission=mission, consultant=c1, working_date=date(2010, 3, 2), charge=2)
+        Timesheet.objects.create(mission=mission, consultant=c1, working_date=date(2010, 4, 1), charge=1)
+        Timesheet.objects.create(mission=mission, consultant=c1, working_date=date(2010, 4, 20), charge=1)
+        consultants = Consultant.objects.all()
+        months = [date(2010, 2, 1), date(2010, 3, 1), date(2010, 4, 1), date(2010, 5, 1)]
+        for billing_mode in ("TIME_SPENT", "FIXED_PRICE"):
+            mission.billing_mode = billing_mode
+            mission.price = 1  # Fixed price is overshoot
+            mission.save()
+            # Last month is partial
+            matrix = utils.turnover_matrix(consultants, months, end_date=date(2010, 4, 15))
+            self.assertAlmostEqual(matrix[c1.id][date(2010, 4, 1)], c1.get_turnover(date(2010, 4, 1), date(2010, 4, 15)))
+            for consultant in consultants:
+                for month in months[:2]:
+                    self.assertAlmostEqual(matrix[consultant.id].get(month, 0), consultant.get_turnover(month, nextMonth(month)))
+            self.assertNotIn(date(2010, 5, 1), matrix[c1.id])
+
+    def test_mission_id(self):
+        lead = Lead.objects.get(id=1)
+        missions = [Mission.objects.create(lead=lead, subsidiary_id=1, nature="PROD") for i in range(3)]
+        expected = {mission.id: lead.deal_id + chr(97 + i) for i, mission in enumerate(lead.mission_set.order_by("id"))}
+        with self.assertNumQueries(1):
+            self.assertEqual({m.id: m.mission_id() for m in lead.mission_set.select_related("lead").with_mission_id()}, expected)
+        # Rank does not depend on queryset filtering
+        self.assertEqual(Mission.objects.with_mission_id().get(id=missions[-1].id).mission_id(), expected[missions[-1].id])
+        self.assertEqual(Mission.objects.get(id=missions[-1].id).mission_id(), expected[missions[-1].id])
+
+    def test_gather_timesheets_data(self):
+        consultants = Consultant.objects.all()
+        months = [d.replace(day=1) for d in Timesheet.objects.dates("working_date", "month")]
+        data = utils.gatherTimesheetsData(consultants, months)
+        self.assertEqual(len(data), len(consultants) * len(months))
+        for consultant in consultants:
+            for month in months:
+                timesheet_data, timesheet_total, warning = data[(consultant.id, month)]
+                self.assertEqual((timesheet_data, timesheet_total, warning),
+                                 utils.gatherTimesheetData(consultant, consultant.timesheet_missions(month), month))
+                self.assertEqual(sum(timesheet_total.values()) - timesheet_total["ticket"],
+                                 sum(Timesheet.objects.filter(consultant=consultant, working_date__gte=month,
+                                                              working_date__lt=nextMonth(month)).values_list("charge", flat=True)))
+
+    def test_save_timesheet_data(self):
+        consultant = Consultant.objects.get(id=1)
+        user = User.objects.get(username=TEST_USERNAME)
+        month = date(2010, 2, 1)
+        mission = Mission.objects.get(id=1)
+        Timesheet.objects.filter(consultant=consultant).delete()
+        LunchTicket.objects.filter(consultant=consultant).delete()
+        Timesheet.objects.create(consultant=consultant, mission=mission, working_date=date(2010, 2, 1), charge=1)
+        Timesheet.objects.create(consultant=consultant, mission=mission, working_date=date(2010, 2, 2), charge=1)
+        LunchTicket.objects.create(consultant=consultant, lunch_date=date(2010, 2, 1))
+        old_data = utils.gatherTimesheetData(consultant, [mission], month)[0]
+        log_count = LogEntry.objects.get_for_object(mission).count()
+        data = {"charge_1_1": 0.5,  # Update
+                "charge_1_2": None,  # Removal
+                "charge_1_3": 1,  # Creation
+                "charge_1_4": None,  # Nothing
+                "lunch_ticket_1": False,  # Removal
+                "lunch_ticket_2": True}  # Creation
+        utils.saveTimesheetData(consultant, month, data, old_data, user=user)
+        timesheets = Timesheet.objects.filter(consultant=consultant).order_by("working_date")
+        self.assertEqual(list(timesheets.values_list("working_date", "charge")),
+                         [(date(2010, 2, 1), 0.5), (date(2010, 2, 3), 1)])
+        self.assertEqual(list(LunchTicket.objects.filter(consultant=consultant).values_list("lunch_date", flat=True)),
+                         [date(2010, 2, 2)])
+        # One audit log entry for the mission with all changes
+        self.assertEqual(LogEntry.objects.get_for_object(mission).count(), log_count + 1)
+        log = LogEntry.objects.get_for_object(mission).latest("timestamp")
+        self.assertEqual(log.actor, user)
+        self.assertEqual(sorted(log.changes_dict.values()), [["1.0", "0.5"], ["1.0", "None"], ["None", "1"]])
+        # Saving again the same data does nothing
+        utils.saveTimesheetData(consultant, month, data, utils.gatherTimesheetData(consultant, [mission], month)[0])
+        self.assertEqual(LogEntry.objects.get_for_object(mission).count(), log_count + 1)
+        # Removal cost does not depend on the number of removed timesheets
+        for n_days in (2, 20):
+            month = date(2010, 3, 1)
+            Timesheet.objects.bulk_create([Timesheet(consultant=consultant, mission=mission, working_date=month.replace(day=day), charge=1)
+                                           for day in range(1, n_days + 1)])
+            refresh_monthly_turnover([mission.id], [consultant.id], [month])
+            old_data = utils.gatherTimesheetData(consultant, [mission], month)[0]
+            with self.assertNumQueries(13):
+                utils.saveTimesheetData(consultant, month, {"charge_1_%s" % day: None for day in range(1, n_days + 1)}, old_data, user=user)
+            self.assertFalse(Timesheet.objects.filter(consultant=consultant, working_date__gte=month).exists())
+            self.assertFalse(MonthlyTurnover.objects.filter(consultant=consultant, month=month).exists())
 
 
 @override_settings(CELERY_TASK_ALWAYS_EAGER=True)
@@ -247,6 +441,70 @@ class StaffingViewsTest(TestCase):
                                        [11.9, 18.7], [4.3, 13],
                                        [915.4, 935, 927.3], [860, 928.6, 910.5]])
 
+    def test_prod_report(self):
+        self.client.force_login(self.test_user)
+        consultant = Consultant.objects.get(id=1)
+        RateObjective.objects.create(consultant=consultant, start_date=date(2010, 1, 1), rate=500, rate_type="DAILY_RATE")
+        RateObjective.objects.create(consultant=consultant, start_date=date(2010, 8, 1), rate=80, rate_type="PROD_RATE")
+        FinancialCondition.objects.create(consultant=consultant, mission=Mission.objects.get(id=2), daily_rate=800)
+        months = [date(2010, 5, 1), date(2010, 6, 1), date(2010, 7, 1), date(2010, 8, 1), date(2010, 9, 1)]
+        response = self.client.get(reverse("staffing:prod_report", kwargs={"year": 2010, "month": 9}))
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(reverse("staffing:prod_report_data", kwargs={"year": 2010, "month": 9}))
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["months"], [month.isoformat() for month in months])
+        consultant_data = [c for c in data["consultants"] if c["id"] == consultant.id][0]
+        self.assertEqual(consultant_data["turnover"], [consultant.get_turnover(month, nextMonth(month)) for month in months])
+        # Both objectives are needed
+        self.assertEqual(consultant_data["daily_rate_objective"], [0, 0, 0, 500, 500])
+        self.assertEqual(consultant_data["prod_rate_objective"], [0, 0, 0, 0.8, 0.8])
+        self.assertEqual(consultant_data["status"][:3], ["ok"] * 3)
+        self.assertEqual(data["total"]["turnover"], [sum(c["turnover"][j] for c in data["consultants"]) for j in range(len(months))])
+
+    def test_optimise_pdc(self):
+        self.client.force_login(self.test_user)
+        url = reverse("staffing:optimise_pdc")
+        staffing_dates = self.client.get(url).context["staffing_dates"]
+        mission = Mission.objects.get(id=1)
+        consultants = Consultant.objects.filter(trigramme__in=("SRE", "TCO"))
+        data = {"consultants": [c.id for c in consultants], "projections": "full",
+                "director_quota": 0, "senior_quota": 0, "newbie_quota": 0,
+                "planning_weight": 1, "freetime_weight": 1, "people_per_mission_weight": 1, "mission_per_people_weight": 1,
+                "form-TOTAL_FORMS": 1, "form-INITIAL_FORMS": 0, "form-0-mission": mission.id,
+                "form-0-charge_%s" % staffing_dates[0][1]: 3, "action_solve": ""}
+        # Job is run synchronously by celery in test
+        response = self.client.post(url, data)
+        self.assertEqual(response.status_code, 200)
+        job_id = response.context["job_id"]
+        job = response.context["job"]
+        self.assertEqual(job["status"], "done")
+        results = response.context["results"]
+        self.assertTrue(results)
+        response = self.client.get(reverse("staffing:optimise_pdc_status", args=[job_id]))
+        self.assertEqual(response.json()["status"], "done")
+        # Review and apply stored solution
+        response = self.client.get(url, {"job": job_id})
+        self.assertEqual(response.context["results"], results)
+        self.assertFalse(response.context["job"]["hinted"])
+        # Solve again with previous solution as hint
+        response = self.client.post(url, dict(data, job_id=job_id))
+        self.assertEqual(response.context["job"]["status"], "done")
+        self.assertTrue(response.context["job"]["hinted"])
+        with mock.patch("staffing.tasks.solve_pdc") as solve_pdc_mock:
+            response = self.client.post(url, {"job_id": job_id, "action_update": ""})
+            solve_pdc_mock.assert_not_called()
+        self.assertEqual(response.context["error"], "")
+        solution_total = sum(job["solution"][c.trigramme][mission.mission_id()][month[1]] for c in consultants for month in staffing_dates)
+        self.assertEqual(Staffing.objects.filter(mission=mission, staffing_date__gte=staffing_dates[0][0]).aggregate(Sum("charge"))["charge__sum"] or 0,
+                         solution_total)
+        # Unknown job
+        self.assertEqual(self.client.get(reverse("staffing:optimise_pdc_status", args=["unknown"])).status_code, 404)
+        # Job written by worker after its cache entry was evicted
+        cache.set(OPTIMISER_JOB_CACHE_KEY % "evicted", {"status": "done"})
+        self.assertEqual(self.client.get(reverse("staffing:optimise_pdc_status", args=["evicted"])).status_code, 404)
+        self.assertNotEqual(self.client.get(url, {"job": "evicted"}).context["error"], "")
+
     def test_holiday_csv_timesheet(self):
         # TODO: inject holidays days and timesheet on fixed month with holes and holidays in first and last open days
         self.client.force_login(self.test_user)
@@ -359,3 +617,27 @@ class OptimTest(TestCase):
         with mock.patch('sys.stdout', new=StringIO()):
             display_solver_solution(solver, scores, staffing, self.consultants, self.missions, self.months, self.missions_charge, self.consultants_freetime)
         self.assertEqual((sum(solver.Value(score) for score in scores)), 87)
+
+    def test_optim_hints(self):
+        args = (self.consultants, self.senior_consultants, self.director_consultants, self.missions, self.months,
+                self.missions_charge, self.missions_remaining, self.missions_boundaries, self.consultants_freetime,
+                self.predefined_assignment, self.exclusions, self.consultants_rates)
+        solver, status, scores, staffing = solve_pdc(*args)
+        solution = solver_solution_values(solver, staffing)
+        model, scores, staffing = build_pdc_model(*args, hints=solution)
+        self.assertEqual(len(model.Proto().solution_hint.vars), 2 * sum(1 for c in self.consultants for m in self.missions
+                                                                          for month in self.months if not isinstance(staffing[c][m][month], int)))
+        solver, status, scores, staffing = solve_pdc(*args, hints=solution)
+        self.assertEqual((sum(solver.Value(score) for score in scores)), 87)
+
+    def test_optim_model(self):
+        model, scores, staffing = build_pdc_model(self.consultants, self.senior_consultants, self.director_consultants,
+                                                  self.missions, self.months,
+                                                  self.missions_charge, self.missions_remaining, self.missions_boundaries,
+                                                  self.consultants_freetime, self.predefined_assignment, self.exclusions,
+                                                  self.consultants_rates)
+        # No variable for excluded consultant nor outside mission boundaries
+        self.assertEqual(staffing["JCF"]["M3"], {"jan": 0, "feb": 0, "mar": 0})
+        self.assertEqual([staffing[c]["M2"]["jan"] for c in self.consultants], [0] * 4)
+        self.assertEqual([staffing[c]["M3"]["mar"] for c in self.consultants], [0] * 4)
+        self.assertEqual(staffing["SRE"]["M1"]["jan"].Name(), "staffing[SRE,M1,jan]")
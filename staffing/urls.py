@@ -12,8 +12,11 @@ import staffing.api as a
 staffing_urls = [ re_path(r'^pdcreview/?$', v.pdc_review, name='pdcreview-index'),
                   re_path(r'^pdcreview/(?P<year>\d+)/(?P<month>\d+)/?$', v.pdc_review, name='pdcreview'),
                   re_path(r'^pdc_optim/$', v.optimise_pdc, name="optimise_pdc"),
+                  re_path(r'^pdc_optim/status/(?P<job_id>\w+)/$', v.optimise_pdc_status, name="optimise_pdc_status"),
                   re_path(r'^production-report/?$', v.prod_report, name='prod_report'),
                   re_path(r'^production-report/(?P<year>\d+)/(?P<month>\d+)/?$', v.prod_report, name='prod_report'),
+                  re_path(r'^production-report/data/?$', v.prod_report_data, name='prod_report_data'),
+                  re_path(r'^production-report/data/(?P<year>\d+)/(?P<month>\d+)/?$', v.prod_report_data, name='prod_report_data'),
                   re_path(r'^fixed-price-mission-report/?$', v.fixed_price_missions_report, name="fixed_price_missions_report"),
                   re_path(r'^missions/$', v.missions, name='missions'),
                   re_path(r'^missions/all$', v.missions, {'only_active': False}, name='all_missions'),
@@ -61,7 +64,10 @@ staffing_urls = [ re_path(r'^pdcreview/?$', v.pdc_review, name='pdcreview-index'
                   re_path(r'^datatable/clientcompany-missions/(?P<clientcompany_id>\d+)/data/$', t.ClientCompanyActiveMissionsTablesDT.as_view(), name='client_company_mission_table_DT'),
                   re_path(r'^turnover-pivotable/$', v.turnover_pivotable, name="turnover_pivotable"),
                   re_path(r'^turnover-pivotable/(?P<year>\d+)$', v.turnover_pivotable, name="turnover_pivotable_year"),
+                  re_path(r'^turnover-pivotable/data/$', v.turnover_pivotable_data, name="turnover_pivotable_data"),
+                  re_path(r'^turnover-pivotable/data/(?P<year>\d+)$', v.turnover_pivotable_data, name="turnover_pivotable_data_year"),
                   re_path(r'^lunch-tickets-pivotable$', v.lunch_tickets_pivotable, name="lunch_tickets_pivotable"),
+                  re_path(r'^lunch-tickets-pivotable/data$', v.lunch_tickets_pivotable_data, name="lunch_tickets_pivotable_data"),
                   re_path(r'^rate_objective_report/?$', v.rate_objective_report, name="rate_objective_report"),
                   re_path(r'^rates_report/?$', v.rates_report, name="rates_report"),
                   re_path(r'^graph/timesheet-rates/?$', v.graph_timesheet_rates_bar, name="graph_timesheet_rates_bar"),
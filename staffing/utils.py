@@ -8,77 +8,115 @@ appropriate to live in Staffing models or view
 """
 import time
 from datetime import date, datetime
+from collections import defaultdict
+
+import numpy as np
 
 from django.conf import settings
 from django.db import transaction
-from django.db.models import Sum
+from django.db.models import Sum, Case, When, Value, F, FloatField
+from django.db.models.functions import TruncMonth
 from django.utils.translation import gettext as _
 from django.utils import formats
-from django.core.cache import cache
 from django.core.exceptions import ValidationError
 
-from staffing.models import Timesheet, Mission, LunchTicket, PublicHoliday, Staffing, HolidayBalance
-from core.utils import month_days, nextMonth, daysOfMonth, to_int_or_round
-from people.models import TIMESHEET_IS_UP_TO_DATE_CACHE_KEY, CONSULTANT_IS_IN_HOLIDAYS_CACHE_KEY
+from auditlog.models import LogEntry
+
+from staffing.models import Timesheet, Mission, LunchTicket, PublicHoliday, Staffing, HolidayBalance, FinancialCondition, \
+    MonthlyTurnover, flush_mission_cache, refresh_monthly_turnover, MISSION_TIMESHEET_DEPENDENCY
+from core.utils import month_days, nextMonth, daysOfMonth, to_int_or_round, cache_invalidate, working_days, explicit_refresh
+from people.models import RateObjectiveIndex, CONSULTANT_TIMESHEET_DEPENDENCY
 
 
-def gatherTimesheetData(consultant, missions, month):
+def gatherTimesheetData(consultant, missions, month, holiday_days=None):
     """Gather existing timesheet timesheetData
+    @param holiday_days: list of public holidays of this month. Fetched from database if None
     @returns: (timesheetData, timesheetTotal, warning)
     timesheetData represent timesheet form post timesheetData as a dict
     timesheetTotal is a dict of total charge (key is mission id)
     warning is a list of 0 (ok) or 1 (surbooking) or 2 (no data). One entry per day"""
+    if holiday_days is None:
+        holiday_days = holidayDays(month)
+    data = gatherTimesheetsData([consultant], [month], missions=missions, holiday_days=holiday_days)
+    return data[(consultant.id, month)]
+
+
+def gatherTimesheetsData(consultants, months, missions=None, holiday_days=None):
+    """Gather existing timesheet data of many consultants and months at once.
+    Timesheets and lunch tickets are fetched with one query each whatever the number of consultants, months and missions
+    @param consultants: consultants queryset or list of consultants
+    @param months: list of months (first day of month as date)
+    @param missions: only consider those missions. None (default) means all missions
+    @param holiday_days: list of public holidays on those months. Fetched from database if None
+    @returns: dict with (consultant id, month) as key and (timesheetData, timesheetTotal, warning) as value. See gatherTimesheetData"""
+    months = sorted(set(months))
+    start, end = months[0], nextMonth(months[-1])
+    consultant_ids = [getattr(c, "id", c) for c in consultants]  # Accept consultant objects or ids
+    if holiday_days is None:
+        holiday_days = PublicHoliday.objects.filter(day__gte=start, day__lt=end).values_list("day", flat=True)
+    holiday_days = set(holiday_days)
+
     timesheetData = {}
     timesheetTotal = {}
-    warning = []
-    totalPerDay = [0] * month_days(month)
-    next_month = nextMonth(month)
-    for mission in missions:
-        timesheets = Timesheet.objects.select_related().filter(consultant=consultant).filter(mission=mission)
-        timesheets = timesheets.filter(working_date__gte=month).filter(working_date__lt=next_month)
-        for timesheet in timesheets:
-            timesheetData["charge_%s_%s" % (timesheet.mission.id, timesheet.working_date.day)] = timesheet.charge
-            if mission.id in timesheetTotal:
-                timesheetTotal[mission.id] += timesheet.charge
-            else:
-                timesheetTotal[mission.id] = timesheet.charge
-            totalPerDay[timesheet.working_date.day - 1] += timesheet.charge
-    # Gather lunck ticket data
-    totalTicket = 0
-    lunchTickets = LunchTicket.objects.filter(consultant=consultant)
-    lunchTickets = lunchTickets.filter(lunch_date__gte=month).filter(lunch_date__lt=next_month)
-    for lunchTicket in lunchTickets:
-        timesheetData["lunch_ticket_%s" % lunchTicket.lunch_date.day] = lunchTicket.no_ticket
-        totalTicket += 1
-    timesheetTotal["ticket"] = totalTicket
-    # Compute warnings (overbooking and no data)
-    for i in totalPerDay:
-        i = round(i, 4)  # We must round because using keyboard time input may lead to real numbers that are truncated
-        if i > 1:  # Surbooking
-            warning.append(1)
-        elif i == 1:  # Ok
-            warning.append(0)
-        else:  # warning (no data, or half day)
-            warning.append(2)
-    # Don't emit warning for no data during week ends and holidays
-    holiday_days = holidayDays(month)
-    for day in daysOfMonth(month):
-        if day.isoweekday() in (6, 7) or day in holiday_days:
-            warning[day.day - 1] = None
-
-    return timesheetData, timesheetTotal, warning
+    totalPerDay = {}
+    for consultant_id in consultant_ids:
+        for month in months:
+            timesheetData[(consultant_id, month)] = {}
+            timesheetTotal[(consultant_id, month)] = {}
+            totalPerDay[(consultant_id, month)] = [0] * month_days(month)
+
+    timesheets = Timesheet.objects.filter(consultant__in=consultant_ids, working_date__gte=start, working_date__lt=end)
+    if missions is not None:
+        timesheets = timesheets.filter(mission__in=missions)
+    for consultant_id, mission_id, working_date, charge in timesheets.values_list("consultant_id", "mission_id", "working_date", "charge").order_by():
+        key = (consultant_id, working_date.replace(day=1))
+        if key not in timesheetData:
+            continue  # Month between given months but not asked
+        timesheetData[key]["charge_%s_%s" % (mission_id, working_date.day)] = charge
+        timesheetTotal[key][mission_id] = timesheetTotal[key].get(mission_id, 0) + charge
+        totalPerDay[key][working_date.day - 1] += charge
+
+    # Gather lunch ticket data
+    totalTicket = dict((key, 0) for key in timesheetData)
+    lunchTickets = LunchTicket.objects.filter(consultant__in=consultant_ids, lunch_date__gte=start, lunch_date__lt=end)
+    for consultant_id, lunch_date, no_ticket in lunchTickets.values_list("consultant_id", "lunch_date", "no_ticket").order_by():
+        key = (consultant_id, lunch_date.replace(day=1))
+        if key not in timesheetData:
+            continue
+        timesheetData[key]["lunch_ticket_%s" % lunch_date.day] = no_ticket
+        totalTicket[key] += 1
+
+    result = {}
+    for key, dayTotals in totalPerDay.items():
+        timesheetTotal[key]["ticket"] = totalTicket[key]
+        # Compute warnings (overbooking and no data)
+        warning = []
+        for i in dayTotals:
+            i = round(i, 4)  # We must round because using keyboard time input may lead to real numbers that are truncated
+            if i > 1:  # Surbooking
+                warning.append(1)
+            elif i == 1:  # Ok
+                warning.append(0)
+            else:  # warning (no data, or half day)
+                warning.append(2)
+        # Don't emit warning for no data during week ends and holidays
+        for day in daysOfMonth(key[1]):
+            if day.isoweekday() in (6, 7) or day in holiday_days:
+                warning[day.day - 1] = None
+        result[key] = (timesheetData[key], timesheetTotal[key], warning)
+    return result
 
 
 @transaction.atomic
-def saveTimesheetData(consultant, month, data, oldData):
-    """Save user input timesheet in database"""
-    previousMissionId = 0
-    mission = None
-
-    # Invalidate consultant cache stuff related to timesheet data
-    cache.delete(TIMESHEET_IS_UP_TO_DATE_CACHE_KEY % consultant.__dict__)
-    cache.delete(CONSULTANT_IS_IN_HOLIDAYS_CACHE_KEY % consultant.__dict__)
-
+def saveTimesheetData(consultant, month, data, oldData, user=None):
+    """Save user input timesheet in database.
+    Only changed cells are considered. Changes are applied with bulk queries (one create, one update
+    and one delete at most for timesheets and lunch tickets) whatever the number of changed cells.
+    @param data: timesheet form cleaned data
+    @param oldData: timesheet data before user input, as returned by gatherTimesheetData
+    @param user: user that made the change. Timesheet changes are recorded in missions audit log"""
+    charges = {}  # New charge (None to remove) with (mission id, working date) as key
+    tickets = {}  # True to create/update, False to remove with lunch date as key
     for key, charge in data.items():
         if not charge and key not in oldData:
             # No charge in new and old data
@@ -87,33 +125,216 @@ def saveTimesheetData(consultant, month, data, oldData):
             # Data does not changed - skip it
             continue
         (foo, missionId, day) = key.split("_")
-        day = int(day)
-        working_date = month.replace(day=day)
+        working_date = month.replace(day=int(day))
         if missionId == "ticket":
-            # Lunch ticket handling
-            lunchTicket, created = LunchTicket.objects.get_or_create(consultant=consultant,
-                                                                     lunch_date=working_date)
-            if charge:
-                # Create/update new data
-                lunchTicket.no_ticket = True
-                lunchTicket.save()
-            else:
-                lunchTicket.delete()
+            tickets[working_date] = bool(charge)
+        else:
+            charges[(int(missionId), working_date)] = charge or None
+
+    # Lunch ticket handling
+    removed_tickets = [lunch_date for lunch_date, ticket in tickets.items() if not ticket]
+    if removed_tickets:
+        LunchTicket.objects.filter(consultant=consultant, lunch_date__in=removed_tickets).delete()
+    new_tickets = [lunch_date for lunch_date, ticket in tickets.items() if ticket]
+    if new_tickets:
+        lunch_tickets = LunchTicket.objects.filter(consultant=consultant, lunch_date__in=new_tickets)
+        existing_tickets = set(lunch_tickets.values_list("lunch_date", flat=True))
+        lunch_tickets.filter(no_ticket=False).update(no_ticket=True)
+        LunchTicket.objects.bulk_create([LunchTicket(consultant=consultant, lunch_date=lunch_date, no_ticket=True)
+                                         for lunch_date in new_tickets if lunch_date not in existing_tickets])
+
+    if not charges:
+        return
+
+    # Standard mission handling
+    missions = Mission.objects.in_bulk(set(mission_id for mission_id, working_date in charges))
+    existing_timesheets = Timesheet.objects.filter(consultant=consultant, mission__in=missions.keys(),
+                                                   working_date__gte=month, working_date__lt=nextMonth(month))
+    existing_timesheets = dict(((t.mission_id, t.working_date), t) for t in existing_timesheets)
+    created, updated, deleted = [], [], []
+    changes = defaultdict(dict)  # Audit log changes per mission
+    for (mission_id, working_date), charge in charges.items():
+        mission = missions[mission_id]
+        timesheet = existing_timesheets.get((mission_id, working_date))
+        if charge is None:
+            # remove data user just deleted
+            if timesheet is None:
+                continue
+            deleted.append(timesheet.id)
+        elif timesheet is None:
+            created.append(Timesheet(consultant=consultant, mission=mission, working_date=working_date, charge=charge))
         else:
-            # Standard mission handling
-            if missionId != previousMissionId:
-                mission = Mission.objects.get(id=missionId)
-                previousMissionId = missionId
-            timesheet, created = Timesheet.objects.get_or_create(consultant=consultant,
-                                                                 mission=mission,
-                                                                 working_date=working_date)
-            if charge:
-                # create/update new data
-                timesheet.charge = charge
-                timesheet.save()
-            else:
-                # remove data user just deleted
-                timesheet.delete()
+            timesheet.charge = charge
+            updated.append(timesheet)
+        label = _("timesheet of %(consultant)s on %(date)s") % {"consultant": consultant,
+                                                                "date": formats.date_format(working_date)}
+        changes[mission_id][label] = [str(oldData.get("charge_%s_%s" % (mission_id, working_date.day))), str(charge)]
+
+    if deleted:
+        with explicit_refresh():  # Caches and monthly turnover are refreshed once below
+            Timesheet.objects.filter(id__in=deleted).delete()
+    if updated:
+        Timesheet.objects.bulk_update(updated, ["charge"])
+    if created:
+        Timesheet.objects.bulk_create(created)
+    # Bulk operations and deletion in explicit refresh context do not refresh caches and monthly turnover
+    flush_mission_cache(missions.keys(), (MISSION_TIMESHEET_DEPENDENCY,))
+    cache_invalidate(CONSULTANT_TIMESHEET_DEPENDENCY % consultant.__dict__)
+    refresh_monthly_turnover(missions.keys(), [consultant.id], [month])
+
+    for mission_id, mission_changes in changes.items():
+        LogEntry.objects.log_create(instance=missions[mission_id], actor=user, action=LogEntry.Action.UPDATE,
+                                    changes=mission_changes)
+
+
+def projected_staffings(consultants, months, projection="balanced"):
+    """Staffing of consultants on given months filtered according to projection mode.
+    none only keeps 100% missions. balanced and full exclude null (0%) missions
+    @return: Staffing queryset"""
+    staffings = Staffing.objects.filter(consultant__in=consultants, staffing_date__gte=months[0], staffing_date__lte=months[-1])
+    if projection == "none":
+        staffings = staffings.filter(mission__probability=100)
+    else:
+        staffings = staffings.filter(mission__probability__gt=0)
+    return staffings
+
+
+def staffing_nature_matrix(consultants, months, projection="balanced", exclude_missions=None):
+    """Aggregate forecasted staffing per consultant, month and mission nature in a single query.
+    @param consultants: consultants queryset or list of consultants
+    @param months: list of months (first day of month as date) to consider
+    @param projection: none (only 100% missions), balanced (charge weighted by mission probability) or full (raw charge).
+                       Null (0%) probability missions are never considered
+    @param exclude_missions: missions that should not be considered. None (default) means all
+    @return: dict {consultant_id: {month: (prod, unprod, holidays)}}. Consultant and months without staffing are absent"""
+    staffings = projected_staffings(consultants, months, projection)
+    if exclude_missions:
+        staffings = staffings.exclude(mission__in=exclude_missions)
+
+    if projection == "full":
+        charge = F("charge")
+    else:
+        charge = F("charge") * F("mission__probability") / 100.0
+
+    natures = {}
+    for nature in ("PROD", "NONPROD", "HOLIDAYS"):
+        natures[nature.lower()] = Sum(Case(When(mission__nature=nature, then=charge), default=Value(0.0), output_field=FloatField()))
+
+    matrix = defaultdict(dict)
+    staffings = staffings.values_list("consultant_id", "staffing_date").annotate(**natures).order_by()
+    for consultant_id, month, prod, unprod, holidays in staffings:
+        matrix[consultant_id][month] = (prod or 0, unprod or 0, holidays or 0)
+    return matrix
+
+
+def turnover_matrix(consultants, months, end_date=None):
+    """Compute turnover of consultants on many months at once, like Consultant.get_turnover() does for one month.
+    Whole months are read from monthly turnover fact table and the month of end date from timesheets.
+    Fixed price missions margin is computed once per mission.
+    @param consultants: consultants queryset or list of consultants
+    @param months: list of months (first day of month as date) to consider
+    @param end_date: turnover is computed up to this date (excluded). Default is today
+    @return: dict {consultant_id: {month: turnover}}. Consultant and months without turnover are absent"""
+    if end_date is None:
+        end_date = date.today()
+    end_month = date(end_date.year, end_date.month, 1)
+    work = defaultdict(float)  # Done work amount per (consultant id, mission id, month)
+    turnovers = MonthlyTurnover.objects.filter(consultant__in=consultants, month__in=[m for m in months if m < end_month],
+                                               mission__nature="PROD")
+    for consultant_id, mission_id, month, amount in turnovers.values_list("consultant_id", "mission_id", "month", "amount"):
+        work[(consultant_id, mission_id, month)] += amount
+    if end_month in months and end_date > end_month:
+        # Current month is not complete
+        timesheets = Timesheet.objects.filter(consultant__in=consultants, mission__nature="PROD",
+                                              working_date__gte=end_month, working_date__lt=end_date)
+        timesheets = list(timesheets.values_list("consultant_id", "mission_id").annotate(Sum("charge")).order_by())
+        rates = FinancialCondition.objects.filter(consultant__in=consultants, mission__in={mission_id for consultant_id, mission_id, charge in timesheets})
+        rates = rates.order_by("id").values_list("consultant_id", "mission_id", "daily_rate")
+        rates = {(consultant_id, mission_id): daily_rate for consultant_id, mission_id, daily_rate in rates}
+        for consultant_id, mission_id, charge in timesheets:
+            work[(consultant_id, mission_id, end_month)] += charge * rates.get((consultant_id, mission_id), 0)
+
+    # Limit fixed price missions turnover to price in proportion to what have been done
+    ratios = {}
+    for mission in Mission.objects.filter(id__in={mission_id for consultant_id, mission_id, month in work}, billing_mode="FIXED_PRICE"):
+        done_work = mission.done_work_k()[1]
+        price = float(mission.price or 0)
+        if done_work and (done_work > price or (not mission.active and done_work < price)):
+            ratios[mission.id] = price / done_work
+
+    matrix = defaultdict(dict)
+    for (consultant_id, mission_id, month), amount in work.items():
+        matrix[consultant_id][month] = matrix[consultant_id].get(month, 0) + amount * ratios.get(mission_id, 1)
+    return matrix
+
+
+def prod_report_matrix(consultants, months, holiday_days=None):
+    """Compute production report figures on the consultant x month grid: done days, turnover, rate objectives,
+    forecasted turnover, deltas to objectives and status. Figures are gathered with a few grouped queries
+    and computed for the whole grid at once. Current month is considered up to today.
+    @param consultants: list of consultants
+    @param months: list of months (first day of month as date) to consider
+    @param holiday_days: list of public holidays on those months. Fetched from database if None
+    @return: dict of numpy arrays (consultants x months). Status is one of ok, ok_but_prod_date, ok_but_daily_rate,
+             ko, ko_but_prod_date or ko_but_daily_rate"""
+    if holiday_days is None:
+        holiday_days = PublicHoliday.objects.filter(day__gte=months[0], day__lt=nextMonth(months[-1])).values_list("day", flat=True)
+    consultants_index = {consultant.id: i for i, consultant in enumerate(consultants)}
+    months_index = {month: j for j, month in enumerate(months)}
+    shape = (len(consultants), len(months))
+
+    # Done days per nature
+    days = {nature: np.zeros(shape) for nature in ("PROD", "NONPROD", "HOLIDAYS")}
+    timesheets = Timesheet.objects.filter(consultant__in=consultants, charge__gt=0, working_date__gte=months[0],
+                                          working_date__lt=min(date.today(), nextMonth(months[-1])))
+    timesheets = timesheets.annotate(month=TruncMonth("working_date")).values_list("consultant_id", "month", "mission__nature")
+    for consultant_id, month, nature, charge in timesheets.annotate(Sum("charge")).order_by():
+        if month in months_index and nature in days:
+            days[nature][consultants_index[consultant_id], months_index[month]] = charge
+
+    turnover = np.zeros(shape)
+    for consultant_id, consultant_turnover in turnover_matrix(consultants, months).items():
+        for month, amount in consultant_turnover.items():
+            turnover[consultants_index[consultant_id], months_index[month]] = amount
+
+    # Rate objectives active on each month. Both are needed to define objectives
+    rate_objectives = RateObjectiveIndex(consultants)
+    daily_objectives = rate_objectives.resolve(consultants_index, months, rate_type="DAILY_RATE")
+    prod_objectives = rate_objectives.resolve(consultants_index, months, rate_type="PROD_RATE")
+    daily_rate_obj = np.zeros(shape)
+    prod_rate_obj = np.zeros(shape)
+    for consultant_id, i in consultants_index.items():
+        for j, month in enumerate(months):
+            daily, prod = daily_objectives[(consultant_id, month)], prod_objectives[(consultant_id, month)]
+            if daily and prod and daily.rate is not None and prod.rate is not None:
+                daily_rate_obj[i, j] = daily.rate
+                prod_rate_obj[i, j] = float(prod.rate) / 100
+
+    month_days = np.array([working_days(month, holidays=holiday_days, upToToday=True) for month in months])
+    available_days = month_days - days["HOLIDAYS"]
+    forecast = daily_rate_obj * prod_rate_obj * available_days
+    # Remove forecast for consultant that leave during the period
+    gone = (turnover == 0) & np.array([not consultant.active for consultant in consultants], dtype=bool).reshape(-1, 1)
+    forecast[gone] = 0
+    worked_days = days["PROD"] + days["NONPROD"]
+    prod_rate = np.divide(days["PROD"], worked_days, out=np.zeros(shape), where=worked_days > 0)
+    daily_rate = np.divide(turnover, days["PROD"], out=np.zeros(shape), where=days["PROD"] > 0)
+    done = turnover >= forecast
+    status = np.select([done & (prod_rate < prod_rate_obj), done & (daily_rate < daily_rate_obj), done,
+                        prod_rate >= prod_rate_obj, daily_rate >= daily_rate_obj],
+                       ["ok_but_prod_date", "ok_but_daily_rate", "ok", "ko_but_prod_date", "ko_but_daily_rate"], "ko")
+    daily_rate_delta = np.where(days["PROD"] > 0, (daily_rate - daily_rate_obj) * days["PROD"], 0)
+    prod_rate_delta = (prod_rate - prod_rate_obj) * daily_rate_obj * available_days
+    missing_data = forecast - turnover + prod_rate_delta + daily_rate_delta
+    for delta in (daily_rate_delta, prod_rate_delta, missing_data):
+        delta[gone] = 0
+
+    return {"prod_days": days["PROD"], "nonprod_days": days["NONPROD"], "holidays_days": days["HOLIDAYS"],
+            "turnover": turnover, "forecast": forecast,
+            "prod_rate": prod_rate, "prod_rate_objective": prod_rate_obj,
+            "daily_rate": daily_rate, "daily_rate_objective": daily_rate_obj,
+            "prod_rate_delta": prod_rate_delta, "daily_rate_delta": daily_rate_delta,
+            "missing_data": missing_data, "status": status}
 
 
 def updateHolidaysStaffing(consultant, month, missions, user):
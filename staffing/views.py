@@ -8,16 +8,17 @@ Pydici staffing views. Http request are processed here.
 from datetime import date, timedelta, datetime
 import csv
 import json
-from itertools import zip_longest, chain
+from itertools import zip_longest
 import codecs
 from collections import defaultdict
 from math import sqrt
 from io import StringIO
 import locale
+import uuid
 
 from django.core.cache import cache
 from django.shortcuts import render, redirect
-from django.http import HttpResponseRedirect, HttpResponse, Http404, HttpResponseForbidden
+from django.http import HttpResponseRedirect, HttpResponse, Http404, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.contrib.auth.decorators import permission_required
 from django.forms.models import inlineformset_factory
@@ -35,14 +36,16 @@ from django.utils.decorators import method_decorator
 from django.views.generic.edit import UpdateView
 from django.contrib import messages
 from django.conf import settings
-from django.template.loader import get_template
+from django.utils.datastructures import MultiValueDict
 
 from django_weasyprint import WeasyTemplateView
 from auditlog.models import LogEntry
 
-from staffing.models import Staffing, Mission, PublicHoliday, Timesheet, FinancialCondition, LunchTicket, HolidayBalance
-from people.models import Consultant, Subsidiary, RateObjective
+from staffing.models import Staffing, Mission, PublicHoliday, Timesheet, FinancialCondition, LunchTicket, HolidayBalance, \
+    MonthlyTurnover
+from people.models import Consultant, Subsidiary, RateObjective, RateObjectiveIndex
 from leads.models import Lead
+from crm.models import Company
 from people.models import ConsultantProfile
 from people.forms import ConsultantFilterTagForm
 from people.filters import ConsultantFilter, ConsultantFilterFormHelper, ConsultantFilterInlineFormHelper
@@ -50,15 +53,16 @@ from staffing.forms import ConsultantStaffingInlineFormset, MissionStaffingInlin
     TimesheetForm, MassStaffingForm, MissionContactsForm, StaffingForm
 from core.utils import working_days, nextMonth, previousMonth, daysOfMonth, previousWeek, nextWeek, monthWeekNumber, \
     to_int_or_round, COLORS, cumulateList, user_has_feature, get_parameter, \
-    get_fiscal_years_from_qs, get_fiscal_year
+    get_fiscal_years_from_qs, get_fiscal_year, pivotable_columnar_json
 from core.decorator import pydici_non_public, pydici_feature, PydiciNonPublicdMixin
 from staffing.utils import gatherTimesheetData, saveTimesheetData, saveFormsetAndLog, \
     sortMissions, holidayDays, staffingDates, time_string_for_day_percent, \
     timesheet_report_data, timesheet_report_data_grouped, check_timesheet_validity, compute_mission_consultant_rates, \
-    updateHolidaysStaffing, clean_mission_price
+    updateHolidaysStaffing, clean_mission_price, staffing_nature_matrix, projected_staffings, turnover_matrix, \
+    prod_report_matrix
 from staffing.forms import MissionForm, OptimiserForm, MissionOptimiserForm, MissionOptimiserFormsetHelper, HolidayBalanceForm
-from staffing.optim import solve_pdc, solver_solution_format, compute_consultant_freetime, compute_consultant_rates, solver_apply_forecast
-from staffing.optim import OPTIM_NEWBIE_SENIOR_LIMIT, OPTIM_SENIOR_DIRECTOR_LIMIT
+from staffing.optim import solver_solution_format, solver_apply_forecast, optimiser_objects, OPTIMISER_JOB_CACHE_KEY
+from staffing.tasks import optimise_pdc_job
 from people.tasks import compute_consultant_tasks
 from crm.utils import get_subsidiary_from_session
 from people.utils import subcontractor_is_user
@@ -201,10 +205,6 @@ def mission_staffing(request, mission_id):
     else:
         formset = StaffingFormSet(instance=mission)  # An unbound form
 
-    # flush mission cache
-    cache.delete("Mission.forecasted_work%s" % mission.id)
-    cache.delete("Mission.done_work%s" % mission.id)
-
     return render(request, 'staffing/mission_staffing.html',
                   {"formset": formset,
                    "mission": mission,
@@ -470,12 +470,11 @@ def pdc_review(request, year=None, month=None):
         start_date = date.today()
         start_date = start_date.replace(day=1)  # We use the first day to represent month
 
-    consultant_staffing = {}  # staffing data per month and per consultant
     total = {}  # total staffing data per month
     rates = []  # staffing rates per month
     available_month = {}  # available working days per month
     months = []  # list of month to be displayed
-    consultant_clients = {}  # Current consultant clients
+    consultant_clients = {}  # Current consultant clients (key is consultant id)
 
     month = start_date
     for i in range(n_month):
@@ -508,105 +507,40 @@ def pdc_review(request, year=None, month=None):
     else:
         wished_tag_form = ConsultantFilterTagForm(prefix="wish")
 
-    # Get consultants staffing
-    staffings = Staffing.objects.filter(consultant__in=consultants)
-    staffings = staffings.filter(staffing_date__gte=months[0], staffing_date__lte=months[-1])
+    consultants = consultants.select_related("staffing_manager", "profil")
+    consultants = dict((consultant.id, consultant) for consultant in consultants)  # Remove duplicates from tags joins
 
-    if projection in ("balanced", "full"):
-        # Only exclude null (0%) mission
-        staffings = staffings.filter(mission__probability__gt=0)
-    else:
-        # Only keep 100% mission
-        staffings = staffings.filter(mission__probability=100)
-
-    staffings = staffings.order_by("consultant", "staffing_date")
-    staffings = staffings.prefetch_related("consultant__staffing_manager")
-    staffings = staffings.prefetch_related("mission__lead__client__organisation__company")
-    consultants = consultants.prefetch_related("staffing_manager")
-
-    consultant = None
-    month = None
-    missions = set()
-    prod = []
-    unprod = []
-    holidays = []
-    # Iterate on staffing. Chain None as a flag for last loop to compute total
-    for staffing in chain(staffings, [None]):
-        if month is None or staffing is None or month != staffing.staffing_date or consultant != staffing.consultant:
-            # compute total for previous month and this consultant
-            if month or (staffing is None and consultant): # at first loop, no total to compute. Last loop, current_staffing is None
-                prod = sum(prod)
-                unprod = sum(unprod)
-                holidays = sum(holidays)
-                prod_round = to_int_or_round(prod)
-                unprod_round = to_int_or_round(unprod)
-                holidays_round = to_int_or_round(holidays)
-                available = available_month[month] - (prod + unprod + holidays)
-                available_displayed = to_int_or_round(available_month[month] - (prod_round + unprod_round + holidays_round))
-                consultant_staffing[consultant][month] = [prod_round, unprod_round, holidays_round, available_displayed]
-                total[month]["prod"] += prod
-                total[month]["unprod"] += unprod
-                total[month]["holidays"] += holidays
-                total[month]["available"] += available
-                total[month]["total"] += available_month[month]
-
-        if consultant and (staffing is None or consultant != staffing.consultant):
-            # end of line data for consultant - add client synthesis
-            consultant_clients[consultant] = set([m.lead.client.organisation.company for m in list(missions) if m.lead is not None])
-            missions = set()
-
-        if staffing is None:  # last month of last consultant. Exit loop
-            break
-
-        if consultant is None or consultant != staffing.consultant:
-            # Switch to new consultant and reset month
-            consultant = staffing.consultant
-            month = None
-            if consultant not in consultant_staffing:
-                consultant_staffing[consultant] = {}
-
-        if month != staffing.staffing_date:
-            # Switch to new month
-            month = staffing.staffing_date
-            prod = []
-            unprod = []
-            holidays = []
-
-        # Do staffing computation
-        nature = staffing.mission.nature
-        if nature == "PROD":
-            missions.add(staffing.mission)  # Store prod missions for this consultant
-            if projection == "full":
-                prod.append(staffing.charge)
-            else:
-                prod.append(staffing.charge * staffing.mission.probability / 100)
-        elif nature == "NONPROD":
-            if projection == "full":
-                unprod.append(staffing.charge)
-            else:
-                unprod.append(staffing.charge * staffing.mission.probability / 100)
-        elif nature == "HOLIDAYS":
-            if projection == "full":
-                holidays.append(staffing.charge)
-            else:
-                holidays.append(staffing.charge * staffing.mission.probability / 100)
+    # Get consultants staffing per month and mission nature
+    staffing_matrix = staffing_nature_matrix(consultants.keys(), months, projection)
+
+    # Get consultants prod missions clients
+    clients = projected_staffings(consultants.keys(), months, projection)
+    clients = clients.filter(mission__nature="PROD", mission__lead__isnull=False)
+    clients = list(clients.values_list("consultant_id", "mission__lead__client__organisation__company_id").distinct().order_by())
+    companies = Company.objects.in_bulk(set(company_id for consultant_id, company_id in clients))
+    for consultant_id, company_id in clients:
+        consultant_clients.setdefault(consultant_id, []).append(companies[company_id])
 
-    # Format consultant lines, fill holes with zero data, adjust available total and add client/company list
+    # Format consultant lines, fill holes with zero data, compute total and add client/company list
     data = []
-    for consultant in consultants:
-        if consultant not in consultant_staffing:
-            consultant_staffing[consultant] = {}
-    for consultant, staffing in consultant_staffing.items():
+    for consultant in consultants.values():
         consultant_data = []
         for month in months:
-            consultant_data.append(staffing.get(month, [0, 0, 0, available_month[month]]))
-            if month not in staffing:
-                # Adjust available total as we fill a hole
-                total[month]["available"] += available_month[month]
-                total[month]["total"] += available_month[month]
+            prod, unprod, holidays = staffing_matrix.get(consultant.id, {}).get(month, (0, 0, 0))
+            prod_round = to_int_or_round(prod)
+            unprod_round = to_int_or_round(unprod)
+            holidays_round = to_int_or_round(holidays)
+            available = available_month[month] - (prod + unprod + holidays)
+            available_displayed = to_int_or_round(available_month[month] - (prod_round + unprod_round + holidays_round))
+            consultant_data.append([prod_round, unprod_round, holidays_round, available_displayed])
+            total[month]["prod"] += prod
+            total[month]["unprod"] += unprod
+            total[month]["holidays"] += holidays
+            total[month]["available"] += available
+            total[month]["total"] += available_month[month]
         client_list = ", ".join(["<a href='%s'>%s</a>" %
                                  (reverse("crm:company_detail", args=[c.id]), escape(c)) for c in
-                                 consultant_clients.get(consultant, [])])
+                                 sorted(consultant_clients.get(consultant.id, []), key=str)])
         client_list = mark_safe("<div class='d-none d-sm-table-cell'>%s</div>" % client_list)
         consultant_data.append([client_list])
         data.append([consultant, consultant_data])
@@ -614,7 +548,7 @@ def pdc_review(request, year=None, month=None):
     # Compute indicator rates
     for month in months:
         rate = []
-        ndays = len(consultant_staffing) * available_month[month]  # Total days for this month
+        ndays = len(consultants) * available_month[month]  # Total days for this month
         for indicator in ("prod", "unprod", "holidays", "available"):
             if ndays == 0:  # no data...
                 if indicator == "available":
@@ -688,24 +622,10 @@ def pdc_detail(request, consultant_id, staffing_date):
                    "user": request.user})
 
 
-@pydici_non_public
-@pydici_feature("reports")
-def prod_report(request, year=None, month=None):
-    """Report production by each people and team for each month"""
-    months = []
-    n_month = 5
-    tooltip_template = get_template("staffing/_consultant_prod_tooltip.html")
-
+def prod_report_scope(request, year=None, month=None, n_month=5):
+    """Production report scope: consultants and months ending with given year and month (default to current month)
+    @return: consultant filter, consultants, months"""
     filter = ConsultantFilter(request.GET, queryset=Consultant.objects.filter(active=True, productive=True), request=request)
-
-    all_status = {"ok": "#43E707",
-                  "ko": "#E76F6F",
-                  "ok_but_daily_rate": "#CCE7B2",
-                  "ok_but_prod_date": "#A2E774",
-                  "ko_but_daily_rate": "#E7E36D",
-                  "ko_but_prod_date": "#F99E9E"}
-
-    # Get time frame
     if year and month:
         end_date = date(int(year), int(month), 1)
         if end_date > date.today():
@@ -714,101 +634,56 @@ def prod_report(request, year=None, month=None):
         end_date = date.today().replace(day=1)
 
     start_date = (end_date - timedelta(30 * n_month)).replace(day=1)
-
+    months = []
     current_date = start_date
     while current_date < end_date:
         current_date = nextMonth(current_date)
         months.append(current_date)
 
-    previous_slice_date = end_date - timedelta(days=(28 * n_month))
-    next_slice_date = end_date + timedelta(days=(31 * n_month))
-
-    # Filter on scope
     consultants = filter.qs.filter(timesheet__working_date__gte=start_date).distinct().select_related("staffing_manager")
+    return filter, list(consultants), months
 
-    holidays_days = PublicHoliday.objects.filter(day__gte=start_date, day__lte=nextMonth(end_date)).values_list("day", flat=True)
-    data = []
-    total_done = {}
-    total_forecasted = {}
-    delta_daily_rate = {}
-    delta_prod_rate = {}
-    delta_missing_data = {}
-
-    for month in months:
-        total_done[month] = total_forecasted[month] = delta_prod_rate[month] = delta_daily_rate[month] = delta_missing_data[month] = 0
 
-    for consultant in consultants:
-        consultant_data = []
-        for month in months:
-            upperBound = min(date.today(), nextMonth(month))
-            month_days = working_days(month, holidays=holidays_days, upToToday=True)
-            timesheets = Timesheet.objects.filter(consultant=consultant,
-                                                  charge__gt=0,
-                                                  working_date__gte=month,
-                                                  working_date__lt=upperBound)
-            consultant_days = dict(timesheets.values_list("mission__nature").order_by("mission__nature").annotate(Sum("charge")))
-
-            try:
-                daily_rate_obj = consultant.get_rate_objective(working_date=month, rate_type="DAILY_RATE").rate
-                prod_rate_obj = float(
-                    consultant.get_rate_objective(working_date=month, rate_type="PROD_RATE").rate) / 100
-                forecast = daily_rate_obj * prod_rate_obj * (month_days - consultant_days.get("HOLIDAYS",0))
-            except AttributeError:
-                prod_rate_obj = daily_rate_obj = forecast = 0  # At least one rate objective is missing
-            turnover = consultant.get_turnover(month, upperBound)
-            if turnover == 0 and not consultant.active:
-                forecast = 0  # Remove forecast for consultant that leave during the period
-            try:
-                prod_rate = consultant_days.get("PROD", 0) / (consultant_days.get("PROD", 0) + consultant_days.get("NONPROD", 0))
-            except ZeroDivisionError:
-                prod_rate = 0
-            if consultant_days.get("PROD", 0) > 0:
-                daily_rate = turnover / consultant_days["PROD"]
-            else:
-                daily_rate = 0
-            if turnover >= forecast:
-                if prod_rate < prod_rate_obj:
-                    status = all_status["ok_but_prod_date"]
-                elif daily_rate < daily_rate_obj:
-                    status = all_status["ok_but_daily_rate"]
-                else:
-                    status = all_status["ok"]
-            else:
-                if prod_rate >= prod_rate_obj:
-                    status = all_status["ko_but_prod_date"]
-                elif daily_rate >= daily_rate_obj:
-                    status = all_status["ko_but_daily_rate"]
-                else:
-                    status = all_status["ko"]
+@pydici_non_public
+@pydici_feature("reports")
+def prod_report(request, year=None, month=None):
+    """Report production by each people and team for each month. Figures are computed by prod_report_matrix"""
+    n_month = 5
+    all_status = {"ok": "#43E707",
+                  "ko": "#E76F6F",
+                  "ok_but_daily_rate": "#CCE7B2",
+                  "ok_but_prod_date": "#A2E774",
+                  "ko_but_daily_rate": "#E7E36D",
+                  "ko_but_prod_date": "#F99E9E"}
 
-            total_done[month] += turnover
-            total_forecasted[month] += forecast
-            if consultant_days.get("PROD", 0) > 0:
-                consultant_delta_daily_rate = (daily_rate - daily_rate_obj) * consultant_days.get("PROD", 0)
-            else:
-                consultant_delta_daily_rate = 0
-            consultant_delta_prod_rate = (prod_rate - prod_rate_obj) * daily_rate_obj * (month_days - consultant_days.get("HOLIDAYS", 0))
-            consultant_missing_data = forecast - turnover + consultant_delta_prod_rate + consultant_delta_daily_rate
-            if turnover == 0 and not consultant.active:
-                consultant_delta_prod_rate = consultant_delta_daily_rate = consultant_missing_data = 0
-            delta_missing_data[month] += consultant_missing_data
-            delta_daily_rate[month] += consultant_delta_daily_rate
-            delta_prod_rate[month] += consultant_delta_prod_rate
-            tooltip = tooltip_template.render({"daily_rate": daily_rate, "daily_rate_obj": daily_rate_obj,
-                                               "prod_rate": prod_rate * 100, "prod_rate_obj": prod_rate_obj * 100,
-                                               "prod_rate_delta": int(consultant_delta_prod_rate),
-                                               "daily_rate_delta": int(consultant_delta_daily_rate)})
-            # For each month : [status, [turnover, forecast ]]
-            consultant_data.append([status, tooltip, [formats.number_format(int(turnover)),
-                                                      formats.number_format(int(forecast))]])
+    filter, consultants, months = prod_report_scope(request, year, month, n_month)
+    end_date = months[-1]
+    previous_slice_date = end_date - timedelta(days=(28 * n_month))
+    next_slice_date = end_date + timedelta(days=(31 * n_month))
+    report = prod_report_matrix(consultants, months)
 
+    data = []
+    for i, consultant in enumerate(consultants):
+        consultant_data = []
+        for j, month in enumerate(months):
+            tooltip = {"daily_rate": float(report["daily_rate"][i, j]), "daily_rate_obj": float(report["daily_rate_objective"][i, j]),
+                       "prod_rate": float(report["prod_rate"][i, j] * 100), "prod_rate_obj": float(report["prod_rate_objective"][i, j] * 100),
+                       "prod_rate_delta": int(report["prod_rate_delta"][i, j]),
+                       "daily_rate_delta": int(report["daily_rate_delta"][i, j])}
+            # For each month : [status, tooltip data, [turnover, forecast ]]
+            consultant_data.append([all_status[report["status"][i, j]], tooltip,
+                                    [formats.number_format(int(report["turnover"][i, j])),
+                                     formats.number_format(int(report["forecast"][i, j]))]])
         data.append([consultant, consultant_data])
 
     # Add total
+    total_done = report["turnover"].sum(axis=0)
+    total_forecasted = report["forecast"].sum(axis=0)
+    delta_prod_rate = report["prod_rate_delta"].sum(axis=0)
+    delta_daily_rate = report["daily_rate_delta"].sum(axis=0)
+    delta_missing_data = report["missing_data"].sum(axis=0)
     total_data = []
-    for month in months:
-        forecast = total_forecasted.get(month, 0)
-        turnover = total_done.get(month, 0)
+    for turnover, forecast in zip(total_done, total_forecasted):
         if forecast > turnover:
             status = all_status["ko"]
         else:
@@ -821,17 +696,17 @@ def prod_report(request, year=None, month=None):
     for title, delta_rate in ((_("Prod rate delta"), delta_prod_rate),
                              (_("Daily rate delta"), delta_daily_rate)):
         delta_line_data = []
-        for month in months:
-            if delta_rate[month] > 0:
+        for delta in delta_rate:
+            if delta > 0:
                 status = all_status["ok"]
             else:
                 status = all_status["ko"]
-            delta_line_data.append([status, "", [formats.number_format(int(delta_rate[month])), "-"]])
+            delta_line_data.append([status, "", [formats.number_format(int(delta)), "-"]])
         delta_data.append([title, delta_line_data])
     # Add missing data
     missing_line_data = []
-    for month in months:
-        missing_data = int(delta_missing_data[month])
+    for missing_data in delta_missing_data:
+        missing_data = int(missing_data)
         if missing_data == 0:
             status = all_status["ok"]
         else:
@@ -841,12 +716,11 @@ def prod_report(request, year=None, month=None):
 
     # Prepare graph data
     graph_data = [["x"] + [m.isoformat() for m in months],
-                  ["prod_rate_delta"] + [int(i) for i in delta_prod_rate.values()],
-                  ["daily_rate_delta"] + [int(i) for i in delta_daily_rate.values()],
-                  ["objective_delta"] + [int(i+j) for i, j in zip(delta_daily_rate.values(), delta_prod_rate.values())],
+                  ["prod_rate_delta"] + [int(i) for i in delta_prod_rate],
+                  ["daily_rate_delta"] + [int(i) for i in delta_daily_rate],
+                  ["objective_delta"] + [int(i+j) for i, j in zip(delta_daily_rate, delta_prod_rate)],
                   ]
 
-
     return render(request, "staffing/prod_report.html",
                   {"data": data,
                    "delta_data": delta_data,
@@ -859,6 +733,23 @@ def prod_report(request, year=None, month=None):
                    "filter_form_helper": ConsultantFilterFormHelper()})
 
 
+@pydici_non_public
+@pydici_feature("reports")
+def prod_report_data(request, year=None, month=None):
+    """Production report figures as json for each consultant and month. See prod_report"""
+    filter, consultants, months = prod_report_scope(request, year, month)
+    report = prod_report_matrix(consultants, months)
+    data = {"months": [month.isoformat() for month in months],
+            "consultants": [],
+            "total": {key: report[key].sum(axis=0).tolist() for key in ("turnover", "forecast", "prod_rate_delta",
+                                                                         "daily_rate_delta", "missing_data")}}
+    for i, consultant in enumerate(consultants):
+        consultant_data = {"id": consultant.id, "trigramme": consultant.trigramme, "name": consultant.name}
+        consultant_data.update({key: values[i].tolist() for key, values in report.items()})
+        data["consultants"].append(consultant_data)
+    return JsonResponse(data)
+
+
 @pydici_non_public
 @pydici_feature("reports")
 def fixed_price_missions_report(request):
@@ -977,10 +868,10 @@ def consultant_timesheet(request, consultant_id, year=None, month=None, timeshee
     if "csv" in request.GET:
         return consultant_csv_timesheet(request, consultant, days, month, missions)
 
-    timesheetData, timesheetTotal, warning = gatherTimesheetData(consultant, missions, month)
-
     holiday_days = holidayDays(month=month)
 
+    timesheetData, timesheetTotal, warning = gatherTimesheetData(consultant, missions, month, holiday_days=holiday_days)
+
     # Shrink warning list to given week if week number is given
     if week:
         warning = warning[days[0].day - 1:days[-1].day]
@@ -996,7 +887,7 @@ def consultant_timesheet(request, consultant_id, year=None, month=None, timeshee
             with transaction.atomic():
                 sid = transaction.savepoint()
                 # Process the data in form.cleaned_data
-                saveTimesheetData(consultant, month, form.cleaned_data, timesheetData)
+                saveTimesheetData(consultant, month, form.cleaned_data, timesheetData, user=request.user)
                 staffings_updated = updateHolidaysStaffing(consultant, month, missions, request.user)
                 # Need to update forecastTotal
                 for mission, previous_charge, next_charge in staffings_updated:
@@ -1008,7 +899,7 @@ def consultant_timesheet(request, consultant_id, year=None, month=None, timeshee
                     transaction.savepoint_commit(sid)
                     compute_consultant_tasks.delay(consultant.id)  # update self tasks after timesheet update
                 # Recreate a new form for next update and compute again totals
-                timesheetData, timesheetTotal, warning = gatherTimesheetData(consultant, missions, month)
+                timesheetData, timesheetTotal, warning = gatherTimesheetData(consultant, missions, month, holiday_days=holiday_days)
                 form = TimesheetForm(days=days, missions=missions, holiday_days=holiday_days, showLunchTickets=not consultant.subcontractor,
                                  forecastTotal=forecastTotal, timesheetTotal=timesheetTotal, initial=timesheetData, warning=warning, timesheet_view=timesheet_view)
     else:
@@ -1041,9 +932,6 @@ def consultant_timesheet(request, consultant_id, year=None, month=None, timeshee
 
     if request.method == "POST":
         for mission in missions:
-            # flush mission cache
-            cache.delete("Mission.forecasted_work%s" % mission.id)
-            cache.delete("Mission.done_work%s" % mission.id)
             if mission.management_mode == "ELASTIC":
                 # Adjust mission and lead price according to done work if needed
                 m_days, m_amount = mission.done_work_k()
@@ -1103,18 +991,18 @@ def consultant_csv_timesheet(request, consultant, days, month, missions):
                      + [_(d.strftime("%a")) for d in days] + [_("total")])
 
     timestring_formatter = TIMESTRING_FORMATTER[settings.TIMESHEET_INPUT_METHOD]
+    timesheetData, timesheetTotal, warning = gatherTimesheetData(consultant, missions, month)
 
     for mission in missions:
         total = 0
         row = [mission, mission.mission_id()]
-        timesheets = Timesheet.objects.select_related().filter(consultant=consultant).filter(mission=mission)
         for day in days:
-            try:
-                timesheet = timesheets.get(working_date=day)
-                row.append(timestring_formatter(timesheet.charge))
-                total += timesheet.charge
-            except Timesheet.DoesNotExist:
+            charge = timesheetData.get("charge_%s_%s" % (mission.id, day.day))
+            if charge is None:
                 row.append("")
+            else:
+                row.append(timestring_formatter(charge))
+                total += charge
         row.append(formats.number_format(total))
         writer.writerow(row)
 
@@ -1362,7 +1250,7 @@ def all_timesheet(request, year=None, month=None):
     consultants = list(set([i["consultant"] for i in timesheets]))
     missions = list(set([i["mission"] for i in timesheets]))
     consultants = Consultant.objects.filter(id__in=consultants).order_by("name")
-    missions = sortMissions(Mission.objects.filter(id__in=missions))
+    missions = sortMissions(Mission.objects.filter(id__in=missions).select_related("lead").with_mission_id())
     charges = {}
 
     if "csv" in request.GET:
@@ -1405,11 +1293,9 @@ def all_timesheet(request, year=None, month=None):
         charges = None
 
     # Add days without lunch ticket
-    ticketData = []
-    for consultant in consultants:
-        lunchTickets = LunchTicket.objects.filter(consultant=consultant)
-        lunchTickets = lunchTickets.filter(lunch_date__gte=month).filter(lunch_date__lt=next_date)
-        ticketData.append(lunchTickets.count())
+    lunchTickets = LunchTicket.objects.filter(consultant__in=consultants, lunch_date__gte=month, lunch_date__lt=next_date)
+    lunchTickets = dict(lunchTickets.values_list("consultant").annotate(Count("id")).order_by())
+    ticketData = [lunchTickets.get(consultant.id, 0) for consultant in consultants]
 
     if charges:
         charges.append([_("Days without lunch ticket")] + ticketData)
@@ -1480,7 +1366,7 @@ def detailed_csv_timesheet(request, year=None, month=None):
 
     missions = Mission.objects.filter(Q(timesheet__working_date__gte=month, timesheet__working_date__lt=next_month) |
                                       Q(staffing__staffing_date__gte=month, staffing__staffing_date__lt=next_month))
-    missions = missions.distinct().order_by("lead")
+    missions = missions.distinct().order_by("lead").select_related("lead").with_mission_id()
 
     for mission in missions:
         for consultant in mission.consultants():
@@ -1742,10 +1628,11 @@ def rate_objective_report(request):
         consultants = consultants.filter(company=subsidiary)
     working_date_current = date.today()
     working_date_next_year = date.today() + timedelta(365)
+    rate_objectives = RateObjectiveIndex(consultants)
     for consultant in consultants:
         for horizon, working_date in ((_("current"), working_date_current), (_("next"), working_date_next_year)):
             for rate_type, rate_label in RateObjective.RATE_TYPE:
-                rate_objective = consultant.get_rate_objective(working_date=working_date, rate_type=rate_type)
+                rate_objective = rate_objectives.get(consultant, working_date, rate_type=rate_type)
                 data.append({
                     _("consultant"): consultant.name,
                     _("subsidiary"): str(consultant.company),
@@ -1939,7 +1826,6 @@ def mission_consultant_rate(request, mission_id, consultant_id):
         if change:
             try:
                 condition.save()
-                cache.delete("Mission.consultant_rates%s" % mission.id)  # flush rate cache
             except ValueError:
                 return HttpResponse(status=400)
             if mission.responsible:
@@ -2038,7 +1924,8 @@ class MissionUpdate(PydiciNonPublicdMixin, UpdateView):
 @pydici_non_public
 @pydici_feature("staffing_mass")
 def optimise_pdc(request):
-    """Propose optimised mission staffing according to business rules"""
+    """Propose optimised mission staffing according to business rules.
+    Optimisation runs in background (see optimise_pdc_job). Once done, solution is displayed and can be applied to forecast"""
     if date.today().day  > 20:
         start_date = nextMonth(date.today())
     else:
@@ -2051,12 +1938,36 @@ def optimise_pdc(request):
     missions_remaining_results = []
     error = ""
     MissionOptimiserFormset = formset_factory(MissionOptimiserForm, extra=3, can_delete=True)
-    solver = None
-
-    if request.method == "POST":
+    job_id = request.POST.get("job_id") or request.GET.get("job")
+    job = None
+    form_data = None  # Data of previous form used to create a new one for further editing
+
+    if job_id:
+        job = cache.get(OPTIMISER_JOB_CACHE_KEY % job_id)
+        if job and job.get("user") == request.user.username:
+            # Use job months to keep consistent with its solution
+            staffing_dates = [(date.fromisoformat(month), label) for month, label in job["staffing_dates"]]
+            form_data = job["form_data"]
+        else:
+            job = job_id = None
+            error = _("Optimisation result is not available anymore. Solve it again")
+
+    if request.method == "POST" and "action_update" in request.POST:
+        if job and job["status"] == "done":
+            # Apply solution without solving again
+            consultants, missions = optimiser_objects(job["consultants_id"], job["missions_id"])
+            solver_apply_forecast(job["solution"], consultants, missions, staffing_dates, request.user)
+        else:
+            form_data = request.POST
+    elif request.method == "POST":
+        # Previous solution is used as a starting point for the new one
+        hint_job_id = job_id if job and job["status"] == "done" else None
+        job = job_id = form_data = None
+        error = ""
         form = OptimiserForm(request.POST, subsidiary=get_subsidiary_from_session(request))
         formset = MissionOptimiserFormset(request.POST, form_kwargs={"staffing_dates": staffing_dates})
         if form.is_valid() and formset.is_valid():
+            form_data = MultiValueDict(dict(request.POST.lists()))
             # Process the data in form.cleaned_data
             solver_param = {"director_quota": int(form["director_quota"].value()),
                             "senior_quota": int(form["senior_quota"].value()),
@@ -2070,11 +1981,9 @@ def optimise_pdc(request):
             exclusions = {}
             missions_boundaries = {}
             missions = []
-            missions_id = []
             for mission_form in formset.cleaned_data:
                 if mission_form and not mission_form["DELETE"]:
                     missions_charge[mission_form["mission"].mission_id()] = {month[1]:mission_form["charge_%s" % month[1]] or 0 for month in staffing_dates}
-                    missions_id.append(mission_form["mission"].mission_id())
                     missions.append(mission_form["mission"])
                     missions_boundaries[mission_form["mission"].mission_id()] = {"start": formats.date_format(mission_form["mission"].start_date, format="b y") if mission_form["mission"].start_date else None,
                                                                                  "end": formats.date_format(mission_form["mission"].end_date, format="b y") if mission_form["mission"].end_date else None}
@@ -2087,31 +1996,22 @@ def optimise_pdc(request):
                         if not set(c.trigramme for c in mission_form["exclusions"]).issubset(set(c.trigramme for c in form.cleaned_data["consultants"])):
                             error = _("Excluded consultant must be in consultant list")
 
-            consultants_freetime = compute_consultant_freetime(form.cleaned_data["consultants"], missions, staffing_dates, projections=form.cleaned_data["projections"])
-            consultant_rates = compute_consultant_rates(form.cleaned_data["consultants"], missions)
-            missions_remaining = {m.mission_id():int(1000 * m.remaining()) for m in missions}
             if not error:
-                solver, status, scores, staffing = solve_pdc([c.trigramme for c in form.cleaned_data["consultants"]],
-                                                             [c.trigramme for c in form.cleaned_data["consultants"] if OPTIM_NEWBIE_SENIOR_LIMIT < c.profil.level < OPTIM_SENIOR_DIRECTOR_LIMIT],
-                                                             [c.trigramme for c in form.cleaned_data["consultants"] if c.profil.level >= OPTIM_SENIOR_DIRECTOR_LIMIT],
-                                                             missions_id, [month[1] for month in staffing_dates],
-                                                             missions_charge, missions_remaining, missions_boundaries, consultants_freetime,
-                                                             predefined_assignment, exclusions, consultant_rates, solver_param)
-                if status:
-                    scores_data = [(score.Name(), solver.Value(score)) for score in scores]
-                    total_score = sum(solver.Value(score) for score in scores)
-                    results, missions_remaining_results = solver_solution_format(solver, staffing, form.cleaned_data["consultants"], missions, staffing_dates,
-                                                                                 missions_charge, consultants_freetime, consultant_rates)
-
-                    if "action_update" in request.POST:
-                        solver_apply_forecast(solver, staffing, form.cleaned_data["consultants"], missions, staffing_dates, request.user)
-                else:
-                    error = _("There's no solution. Add consultants, remove mission, exclusions or relax experience ratio constraint")
-            # recreate a new formset for further editing with updated charge, based on previous one, removing previous extra forms
-            formset = MissionOptimiserFormset(initial=[i for i in formset.cleaned_data if i and not i["DELETE"]], form_kwargs={"staffing_dates": staffing_dates})
-            # recreate a new form for further editing with updated consultants list.
-            form = OptimiserForm(initial=form.cleaned_data, subsidiary=get_subsidiary_from_session(request))
-    else:
+                # Solve it in background
+                job_id = uuid.uuid4().hex
+                consultants_id = [c.id for c in form.cleaned_data["consultants"]]
+                job_staffing_dates = [(month.isoformat(), label) for month, label in staffing_dates]
+                cache.set(OPTIMISER_JOB_CACHE_KEY % job_id,
+                          {"status": "pending", "user": request.user.username, "form_data": form_data,
+                           "staffing_dates": job_staffing_dates, "consultants_id": consultants_id,
+                           "missions_id": [m.id for m in missions], "missions_charge": missions_charge},
+                          settings.OPTIMISER_JOB_TIMEOUT)
+                optimise_pdc_job.delay(job_id, consultants_id, [m.id for m in missions], job_staffing_dates, missions_charge,
+                                       missions_boundaries, predefined_assignment, exclusions,
+                                       projections=form.cleaned_data["projections"], solver_param=solver_param,
+                                       hint_job_id=hint_job_id)
+                job = cache.get(OPTIMISER_JOB_CACHE_KEY % job_id)  # Job may already be finished
+    elif not job:
         # An unbound form with optional initial data
         consultants = []
         missions = []
@@ -2142,6 +2042,26 @@ def optimise_pdc(request):
         formset = MissionOptimiserFormset(form_kwargs={"staffing_dates": staffing_dates},
                                           initial=[{"mission":m } for m in missions], **formset_initial_extra)
 
+    if form_data is not None:
+        form = OptimiserForm(form_data, subsidiary=get_subsidiary_from_session(request))
+        formset = MissionOptimiserFormset(form_data, form_kwargs={"staffing_dates": staffing_dates})
+        if form.is_valid() and formset.is_valid():
+            # recreate a new formset for further editing with updated charge, based on previous one, removing previous extra forms
+            formset = MissionOptimiserFormset(initial=[i for i in formset.cleaned_data if i and not i["DELETE"]], form_kwargs={"staffing_dates": staffing_dates})
+            # recreate a new form for further editing with updated consultants list.
+            form = OptimiserForm(initial=form.cleaned_data, subsidiary=get_subsidiary_from_session(request))
+
+    if job and job["status"] == "done":
+        consultants, missions = optimiser_objects(job["consultants_id"], job["missions_id"])
+        scores_data = job["scores"]
+        total_score = job["score"]
+        results, missions_remaining_results = solver_solution_format(job["solution"], consultants, missions, staffing_dates,
+                                                                     job["missions_charge"], job["consultants_freetime"], job["consultant_rates"])
+    elif job and job["status"] == "failed":
+        error = _("There's no solution. Add consultants, remove mission, exclusions or relax experience ratio constraint")
+    elif job and job["status"] == "error":
+        error = _("Optimisation failed")
+
     return render(request, "staffing/optimise_pdc.html",
                   {"form": form,
                    "formset": formset,
@@ -2151,22 +2071,59 @@ def optimise_pdc(request):
                    "results": results,
                    "missions_remaining_results": missions_remaining_results,
                    "error": error,
-                   "solver" : solver,
+                   "job": job,
+                   "job_id": job_id,
                    "staffing_dates": staffing_dates})
 
 
+@pydici_non_public
+@pydici_feature("staffing_mass")
+def optimise_pdc_status(request, job_id):
+    """Optimiser job progress. This view is intended to be called in ajax"""
+    job = cache.get(OPTIMISER_JOB_CACHE_KEY % job_id)
+    if not job or job.get("user") != request.user.username:
+        raise Http404
+    return JsonResponse({"status": job["status"],
+                         "solution_count": job.get("solution_count", 0),
+                         "score": job.get("score"),
+                         "wall_time": job.get("wall_time", 0)})
+
+
 @pydici_non_public
 @pydici_feature("reports")
-@cache_page(60 * 60 * 24)
 def turnover_pivotable(request, year=None):
-    """Turnover analysis (per people and mission) based on timesheet production"""
+    """Turnover analysis (per people and mission) based on timesheet production.
+    Data is loaded asynchronously. See turnover_pivotable_data"""
+    missions = Mission.objects.filter(nature="PROD")
+    if not missions:
+        return HttpResponse()
+    years = get_fiscal_years_from_qs(missions, "lead__creation_date")
+    if year is None and years:
+        year = years[-1]
+    year = int(year)
+    data_url = reverse("staffing:turnover_pivotable_data_year", kwargs={"year": year})
+    current_subsidiary = get_subsidiary_from_session(request)
+    if current_subsidiary:
+        data_url += "?subsidiary_id=%s" % current_subsidiary.id  # Distinct url for cache
+    return render(request, "staffing/turnover_pivotable.html", {"data_url": data_url,
+                                                                "derivedAttributes": "{}",
+                                                                "years": years,
+                                                                "selected_year": year})
+
+
+@pydici_non_public
+@pydici_feature("reports")
+@cache_page(60 * 60 * 24)
+def turnover_pivotable_data(request, year=None):
+    """Turnover pivot data as columnar json.
+    Data is not streamed as cache_page cannot store streaming responses"""
     data = []
     month = int(get_parameter("FISCAL_YEAR_MONTH"))
     missions = Mission.objects.filter(nature="PROD")
     total_turnover = defaultdict(int)
 
     if not missions:
-        return HttpResponse()
+        return HttpResponse("".join(pivotable_columnar_json(data)), content_type="application/json")
 
     subsidiaries = Subsidiary.objects.all()
     current_subsidiary = get_subsidiary_from_session(request)
@@ -2181,12 +2138,17 @@ def turnover_pivotable(request, year=None):
     start = date(year, month, 1)
     end = date(year + 1, month, 1)
     end = min(end, date.today().replace(day=1))
-    missions = missions.filter(timesheet__working_date__gte=start, timesheet__working_date__lt=end)
-
-    missions = missions.distinct()
+    turnovers = MonthlyTurnover.objects.filter(mission__nature="PROD", month__gte=start, month__lt=end)
+    missions = missions.filter(id__in=turnovers.values("mission_id"))
     missions = missions.select_related("responsible", "lead__client__contact", "lead__client__organisation__company", "subsidiary",
                          "lead__business_broker__company", "lead__business_broker__contact", "marketing_product")
 
+    # Days and turnover per mission, month, consultant subsidiary and subcontractor kind
+    mission_turnovers = defaultdict(lambda: defaultdict(list))
+    for mission_id, month, subsidiary_id, subcontractor, days, amount in turnovers.values_list("mission_id", "month", "subsidiary_id", "subcontractor")\
+            .annotate(Sum("days"), Sum("amount")).order_by("month"):
+        mission_turnovers[mission_id][month].append((subsidiary_id, subcontractor, days, amount))
+
     for mission in missions:
         mission_data = {_("deal id"): mission.lead.deal_id if mission.lead else mission.id,
                         _("name"): mission.short_name(),
@@ -2199,27 +2161,29 @@ def turnover_pivotable(request, year=None):
                         _("Marketing product"): mission.marketing_product.description if mission.marketing_product else _("Undefined"),
                         _("Business sector"): mission.lead.client.organisation.business_sector.name if mission.lead and mission.lead.client.organisation.business_sector else _("Undefined"),
                         _("Renewal"): mission.lead.renewal if mission.lead else _("Undefined")}
-        for month in mission.timesheet_set.dates("working_date", "month", order="ASC"):
+        for month, month_turnovers in mission_turnovers[mission.id].items():
             fiscal_year = get_fiscal_year(month)
-            if year != "all" and (month < start or month >= end):
-                continue  # Skip mission if outside period
-            next_month = nextMonth(month)
+            own_days = own_turnover = external_days = external_turnover = internal_days = internal_turnover = 0
+            subsidiary_turnovers = defaultdict(int)
+            for subsidiary_id, subcontractor, days, amount in month_turnovers:
+                if subcontractor:
+                    external_days += days
+                    external_turnover += amount
+                elif subsidiary_id == mission.subsidiary_id:
+                    own_days += days
+                    own_turnover += amount
+                else:
+                    internal_days += days
+                    internal_turnover += amount
+                    subsidiary_turnovers[subsidiary_id] += amount
             if (current_subsidiary and current_subsidiary.id == mission.subsidiary.id) or current_subsidiary is None:
                 mission_month_data = mission_data.copy()
-                own_days, own_turnover = mission.done_work_period(month, next_month, include_external_subcontractor=False,
-                                                                               include_internal_subcontractor=False)
-                days_with_external_subcontractor, turnover_with_external_subcontractor = mission.done_work_period(month, next_month,
-                                                                                    include_external_subcontractor=True,
-                                                                                    include_internal_subcontractor=False)
-                days_with_internal_subcontractor, turnover_with_internal_subcontractor = mission.done_work_period(month, next_month,
-                                                                                    include_external_subcontractor=False,
-                                                                                    include_internal_subcontractor=True)
-                mission_month_data[_("turnover (€)")] = turnover_with_external_subcontractor + turnover_with_internal_subcontractor - own_turnover
-                mission_month_data[_("days")] = days_with_external_subcontractor + days_with_internal_subcontractor - own_days
-                mission_month_data[_("external subcontractor turnover (€)")] = turnover_with_external_subcontractor - own_turnover
-                mission_month_data[_("external subcontractor days")] = days_with_external_subcontractor - own_days
-                mission_month_data[_("internal subcontractor turnover (€)")] = turnover_with_internal_subcontractor - own_turnover
-                mission_month_data[_("internal subcontractor days")] = days_with_internal_subcontractor - own_days
+                mission_month_data[_("turnover (€)")] = own_turnover + external_turnover + internal_turnover
+                mission_month_data[_("days")] = own_days + external_days + internal_days
+                mission_month_data[_("external subcontractor turnover (€)")] = external_turnover
+                mission_month_data[_("external subcontractor days")] = external_days
+                mission_month_data[_("internal subcontractor turnover (€)")] = internal_turnover
+                mission_month_data[_("internal subcontractor days")] = internal_days
                 mission_month_data[_("own turnover (€)")] = own_turnover
                 mission_month_data[_("own days")] = own_days
                 mission_month_data[_("month")] = month.isoformat()
@@ -2227,14 +2191,13 @@ def turnover_pivotable(request, year=None):
                 data.append(mission_month_data)
                 total_turnover[mission_month_data[_("client company")]] += mission_month_data[_("turnover (€)")]
             # Handle internal subcontractor for this mission
-            for subsidiary in subsidiaries.exclude(id=mission.subsidiary_id):
-                subsidiary_month_data = mission_data.copy()
-                subsidiary_month_data[_("subsidiary")] = str(subsidiary)
-                subsidiary_month_data[_("month")] = month.isoformat()
-                subsidiary_month_data[_("fiscal year")] = fiscal_year
-                subsidiary_turnover = int(mission.done_work_period(month, next_month, include_external_subcontractor=False,
-                                                                   filter_on_subsidiary=subsidiary)[1])
-                if subsidiary_turnover > 0:
+            for subsidiary in subsidiaries:
+                subsidiary_turnover = int(subsidiary_turnovers[subsidiary.id])
+                if subsidiary.id != mission.subsidiary_id and subsidiary_turnover > 0:
+                    subsidiary_month_data = mission_data.copy()
+                    subsidiary_month_data[_("subsidiary")] = str(subsidiary)
+                    subsidiary_month_data[_("month")] = month.isoformat()
+                    subsidiary_month_data[_("fiscal year")] = fiscal_year
                     subsidiary_month_data[_("own turnover (€)")] = subsidiary_turnover
                     data.append(subsidiary_month_data)
 
@@ -2246,18 +2209,27 @@ def turnover_pivotable(request, year=None):
         else:
             d[_("top client company")] = _("others")
 
-    return render(request, "staffing/turnover_pivotable.html", { "data": json.dumps(data),
-                                                    "derivedAttributes": "{}",
-                                                    "years": years,
-                                                    "selected_year": year})
+    return HttpResponse("".join(pivotable_columnar_json(data)), content_type="application/json")
 
 
 @pydici_non_public
 @pydici_feature("reports")
 def lunch_tickets_pivotable(request):
-    """report due tickets on last 12 months
+    """report due tickets on last 12 months. Data is loaded asynchronously. See lunch_tickets_pivotable_data"""
+    return render(request, "staffing/lunch_tickets_pivotable.html", {"data_url": reverse("staffing:lunch_tickets_pivotable_data"),
+                                                                     "derivedAttributes": "{}"})
+
+
+@pydici_non_public
+@pydici_feature("reports")
+def lunch_tickets_pivotable_data(request):
+    """Stream due tickets on last 12 months as columnar json
     We consider working days of current month and holidays and days without tickets of previous one"""
-    data = []
+    return StreamingHttpResponse(pivotable_columnar_json(lunch_tickets_pivotable_rows()), content_type="application/json")
+
+
+def lunch_tickets_pivotable_rows():
+    """Generate lunch tickets pivot rows. See lunch_tickets_pivotable_data"""
     start_date = (date.today() - timedelta(30*12)).replace(day=1)
 
     no_tickets = LunchTicket.objects.filter(lunch_date__gte=start_date, no_ticket=True).annotate(month=TruncMonth("lunch_date")).order_by()
@@ -2286,14 +2258,10 @@ def lunch_tickets_pivotable(request):
             item[_("days off previous month")] = days_off.get((consultant["consultant_id"], month), 0)
             item[_("days without tickets previous month")] = no_tickets.get((consultant["consultant_id"], month), 0)
             item[_("deserved tickets")] = w_days - item[_("days off previous month")]  - item[_("days without tickets previous month")]
-            data.append(item)
+            yield item
         # Increment month for next loop
         month = next_month
 
-    # LunchTicket.
-    return render(request, "staffing/lunch_tickets_pivotable.html", {"data": json.dumps(data),
-                                                                "derivedAttributes": "{}"})
-
 
 @pydici_non_public
 @pydici_feature("reports")
@@ -2416,9 +2384,19 @@ def graph_profile_rates(request):
         turnover[profil] = {}
         avgDailyRate[profil] = {}
 
+    months = []
     month = timesheetStartDate
     while month < timesheetEndDate:
-        upperBound = min(date.today(), nextMonth(month))
+        months.append(month)
+        month = nextMonth(month)
+    consultants_turnover = turnover_matrix(consultants, months)
+    consultants_days = defaultdict(dict)  # Production days per consultant and month
+    timesheets = Timesheet.objects.filter(consultant__in=consultants, working_date__gte=timesheetStartDate, working_date__lt=date.today(),
+                                          mission__nature="PROD").annotate(month=TruncMonth("working_date"))
+    for consultant_id, month, charge in timesheets.values_list("consultant_id", "month").annotate(Sum("charge")).order_by():
+        consultants_days[consultant_id][month] = charge
+
+    for month in months:
         isoTimesheetMonths.append(month.isoformat())
         monthGlobalNDays = 0
         monthGlobalTurnover = 0
@@ -2427,8 +2405,8 @@ def graph_profile_rates(request):
                 nDays[consultant.profil.id][month] = 0
             if month not in turnover[consultant.profil_id]:
                 turnover[consultant.profil_id][month] = 0
-            nDays[consultant.profil_id][month] += Timesheet.objects.filter(consultant=consultant, working_date__gte=month, working_date__lt=upperBound, mission__nature="PROD").aggregate(Sum("charge"))["charge__sum"] or 0
-            turnover[consultant.profil_id][month] += consultant.get_turnover(month, upperBound)
+            nDays[consultant.profil_id][month] += consultants_days[consultant.id].get(month, 0)
+            turnover[consultant.profil_id][month] += consultants_turnover[consultant.id].get(month, 0)
 
         for profil, profilName in profils.items():
             if profil in nDays:
@@ -2442,7 +2420,6 @@ def graph_profile_rates(request):
             globalDailyRate.append(round(monthGlobalTurnover / monthGlobalNDays))
         else:
             globalDailyRate.append(None)
-        month = nextMonth(month)
 
     if not isoTimesheetMonths or set(globalDailyRate) == {None}:
         return HttpResponse('')
@@ -2486,6 +2463,7 @@ def graph_consultant_rates(request, consultant_id):
         return HttpResponse("")
 
     # Avg daily rate / month and objective rate
+    rate_objectives = RateObjectiveIndex([consultant])
     for refDate in kdates:
         next_month = nextMonth(refDate)
         prodRate = consultant.get_production_rate(refDate, next_month)
@@ -2497,10 +2475,10 @@ def graph_consultant_rates(request, consultant_id):
             turnover = consultant.get_turnover(refDate, next_month)
             dailyRateData.append(int(turnover / wdays))
             isoRateDates.append(refDate.isoformat())
-        rate = consultant.get_rate_objective(working_date=refDate, rate_type="DAILY_RATE")
+        rate = rate_objectives.get(consultant, refDate, rate_type="DAILY_RATE")
         if rate and wdays:
             dailyRateObj.append(rate.rate)
-        rate = consultant.get_rate_objective(working_date=refDate, rate_type="PROD_RATE")
+        rate = rate_objectives.get(consultant, refDate, rate_type="PROD_RATE")
         if rate and wdays:
             prodRateObj.append(rate.rate)
 